@@ -1,8 +1,58 @@
 import streamlit as st
-import google.generativeai as genai
-from google.generativeai.types import HarmCategory, HarmBlockThreshold
-from PIL import Image
-import io
+import os
+import tempfile
+import time
+import uuid
+
+from translator_core import (
+    CACHE_DB_PATH,
+    FALLBACK_MODELS,
+    HISTORY_DB_PATH,
+    HISTORY_PAGE_SIZE,
+    MEMORY_DB_PATH,
+    VIDEO_EXTENSIONS,
+    FolderWatch,
+    JobQueue,
+    Metrics,
+    ModelScheduler,
+    TranslationCache,
+    TranslationHistory,
+    TranslationJob,
+    TranslationMemory,
+    api_key_id,
+    build_prompt_parts,
+    build_srt,
+    cached_image_result,
+    cached_result,
+    chunk_text,
+    create_router,
+    detect_subtitle_changes,
+    find_similar,
+    format_bytes,
+    format_srt_time,
+    generate_with_fallback,
+    get_instruction_and_settings,
+    iter_video_frames,
+    join_chunk_texts,
+    load_image,
+    make_cache_id,
+    make_cache_key,
+    make_chunk_cache_ids,
+    make_thumbnail,
+    merge_chunk_results,
+    needs_tiling,
+    parse_provider_specs,
+    reuse_result,
+    scan_image,
+    split_segments,
+    summarize_latency,
+    summarize_memory,
+    translate_image_file,
+    translate_image_pack_job,
+    translate_text_chunks,
+    translate_with_memory,
+    video_reader_available,
+)
 
 # --- 頁面設定 ---
 st.set_page_config(
@@ -21,19 +71,65 @@ if 'uploader_key' not in st.session_state:
 if 'text_key' not in st.session_state:
     st.session_state.text_key = 0
 
+# 感知雜湊記憶：保存先前批次已翻譯圖片的雜湊與結果，供跨批次沿用
+if 'phash_memory' not in st.session_state:
+    st.session_state.phash_memory = []
+
+# 背景翻譯工作：以工作階段 ID 對應全域工作佇列中的工作，重新執行時可接回進行中的翻譯
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+
+for key in ['image_job', 'text_job', 'video_job']:
+    if key not in st.session_state:
+        st.session_state[key] = None
+
+if 'shown_notices' not in st.session_state:
+    st.session_state.shown_notices = set()
+
+if 'finished_jobs' not in st.session_state:
+    st.session_state.finished_jobs = set()
+
 def clear_files():
     st.session_state.uploader_key += 1
+    st.session_state.image_job = None
+    st.session_state.video_job = None
     
 def clear_text():
     st.session_state.text_key += 1
+    st.session_state.text_job = None
+
+# 資料夾監看只能選擇伺服器端設定的根目錄：st.secrets 的 watch_roots，或環境變數中以路徑分隔符號分隔的清單
+WATCH_ROOTS_ENV = "SCREENSHOT_WATCH_ROOTS"
+
+def get_watch_roots():
+    try:
+        configured = st.secrets.get("watch_roots", [])
+    except Exception:
+        configured = []
+    if isinstance(configured, str):
+        configured = [configured]
+    roots = []
+    for root in list(configured) + os.environ.get(WATCH_ROOTS_ENV, "").split(os.pathsep):
+        root = str(root).strip()
+        if root and os.path.isdir(root) and os.path.realpath(root) not in roots:
+            roots.append(os.path.realpath(root))
+    return roots
+
+def resolve_inside(base, relative):
+    # 解析符號連結與 .. 後仍須位於 base 之內，否則回傳 None
+    path = os.path.realpath(os.path.join(base, relative))
+    return path if os.path.commonpath([base, path]) == base else None
+
+watch_roots = get_watch_roots()
 
 # --- 側邊欄：設定區 ---
 with st.sidebar:
     st.title("⚙️ 設定面板")
     
+    # 未設定允許的監看根目錄時不提供資料夾監看模式
     app_mode = st.radio(
         "選擇工作模式",
-        ["📸 圖片截圖翻譯", "✍️ 純文字翻譯"],
+        ["📸 圖片截圖翻譯", "✍️ 純文字翻譯"] + (["📂 資料夾監看"] if watch_roots else []) + ["🎬 影片字幕翻譯", "🗂️ 翻譯紀錄"],
         index=0
     )
     
@@ -45,6 +141,14 @@ with st.sidebar:
     
     api_key = st.text_input("請輸入 Gemini API 金鑰", type="password", help="請至 Google AI Studio 獲取金鑰")
     
+    with st.expander("🔀 其他模型供應商 (litellm)"):
+        provider_text = st.text_area(
+            "額外模型（每行一個）",
+            placeholder="openai/gpt-4o-mini\nopenai/qwen2.5-vl | http://localhost:8000/v1 | sk-local",
+            help="格式：litellm 模型名稱 | API Base（選填）| API 金鑰（選填）。未填金鑰時使用 litellm 讀取的環境變數。"
+        )
+        latency_routing = st.toggle("依延遲與成功率自動選擇供應商", value=True)
+    
     st.divider()
     
     source_lang = st.selectbox(
@@ -59,6 +163,105 @@ with st.sidebar:
         index=0
     )
     
+    use_streaming = st.toggle("⚡ 串流顯示翻譯", value=True, help="翻譯內容一邊生成一邊顯示，不必等待整段完成。")
+    
+    use_pacing = st.toggle("🚦 依額度自動節流", value=True, help="依各模型的 RPM/TPM 上限自動排隊送出請求，避免觸發 429 額度錯誤。")
+    
+    use_cache = st.toggle("🗄️ 使用翻譯快取", value=True, help="相同的圖片或文字（且設定相同）將直接取用先前的翻譯結果，不再調用 API。")
+    
+    use_history = st.toggle("📜 保存翻譯紀錄", value=True, help="每次翻譯的結果都會存進本機資料庫，可在「🗂️ 翻譯紀錄」模式中搜尋原文與譯文，不必重新翻譯。")
+    
+    with st.expander("🏁 對沖請求（降低長尾延遲）"):
+        use_hedging = st.toggle(
+            "回應過慢時改送備用模型", value=False,
+            help="請求超過該模型近期延遲的百分位仍未回應（串流模式以首字延遲判斷）時，另送一份到下一個健康的模型，先成功者勝出，另一個請求取消。"
+        )
+        hedge_percentile = st.slider("觸發百分位", min_value=50, max_value=99, value=90, help="例如 90 代表超過近期 90% 請求的延遲才另送一份。")
+        hedge_budget = st.slider("額外請求上限 (%)", min_value=1, max_value=50, value=10, help="對沖送出的額外請求不超過總請求數的此比例。")
+    
+    if app_mode in ["📸 圖片截圖翻譯", "📂 資料夾監看", "🎬 影片字幕翻譯"]:
+        if app_mode == "🎬 影片字幕翻譯":
+            with st.expander("🎬 字幕偵測", expanded=True):
+                sample_fps = st.slider(
+                    "每秒取樣影格數", min_value=0.5, max_value=10.0, value=2.0, step=0.5,
+                    help="字幕通常會停留一秒以上，每秒取樣 2 張已足夠；數值越大時間軸越精準，但分析越久。"
+                )
+                subtitle_region = st.slider(
+                    "字幕區域（畫面高度 %）", min_value=0, max_value=100, value=(65, 100), step=5,
+                    help="只比對並送出這個範圍內的畫面，預設為畫面下方三分之一。"
+                )
+                subtitle_threshold = st.slider(
+                    "字幕變化門檻（漢明距離）", min_value=0, max_value=16, value=6,
+                    help="字幕區域的雜湊差異超過此值才視為新的一句；背景變化大而誤判換句時可調高。"
+                )
+        
+        max_workers = st.slider(
+            "同時翻譯張數",
+            min_value=1, max_value=10, value=4,
+            help="同時送出的圖片請求數量；數值越大整批完成越快，但也更快消耗每分鐘額度。"
+        )
+        
+        images_per_request = st.slider(
+            "每次請求圖片數",
+            min_value=1, max_value=8, value=1,
+            help="將多張圖片合併成一次 API 請求，減少每分鐘請求數（RPM）消耗；數值越大單次請求越久。"
+        )
+        
+        max_images = st.number_input(
+            "單批最多圖片數",
+            min_value=1, max_value=1000, value=100, step=10,
+            help="圖片逐張解碼，畫面只顯示壓縮縮圖，伺服器記憶體不會隨張數增加；上限只用來避免一次誤送過多請求。"
+        )
+        
+        with st.expander("♻️ 相似截圖合併"):
+            use_dedup = st.toggle("合併近乎相同的截圖", value=True, help="以感知雜湊 (dHash) 比對，相似的截圖只送出一張，其餘沿用其翻譯。")
+            dedup_threshold = st.slider(
+                "相似度門檻（漢明距離）",
+                min_value=0, max_value=16, value=4,
+                help="64 位元雜湊中允許不同的位元數；數值越大越容易判定為相似。"
+            )
+        
+        with st.expander("🧱 長截圖切塊"):
+            use_tiling = st.toggle("自動切割超長截圖", value=True, help="高度超過寬度 3 倍的條漫或長截圖會切成上下重疊的區塊同時翻譯，再依閱讀順序合併並去除重複的行；一般手機截圖整張送出。")
+            tile_height = st.slider("每塊高度 (px)", min_value=1000, max_value=6000, value=2400, step=200)
+            tile_overlap = st.slider("重疊高度 (px)", min_value=0, max_value=600, value=200, step=50)
+        
+        with st.expander("🔍 文字區域偵測"):
+            use_text_detect = st.toggle(
+                "略過無字圖片並裁切到文字範圍", value=True,
+                help="送出前先在本機分析圖片的邊緣密度：沒有文字的圖片不調用 API，其餘只送出文字所在的區域。"
+            )
+            text_padding = st.slider("文字範圍外留白 (px)", min_value=0, max_value=200, value=32, step=8)
+        
+        with st.expander("🖼️ 圖片前處理"):
+            use_preprocess = st.toggle("上傳前壓縮圖片", value=True, help="縮小並重新編碼圖片，降低上傳時間與 Token 成本。")
+            prep_max_edge = st.slider("最長邊上限 (px)", min_value=512, max_value=4096, value=2048, step=128)
+            prep_grayscale = st.toggle("轉為灰階", value=False)
+            prep_format = st.selectbox("輸出格式", ["JPEG", "WEBP"], index=0)
+            prep_quality = st.slider("壓縮品質", min_value=50, max_value=95, value=85)
+    elif app_mode == "✍️ 純文字翻譯":
+        max_workers = st.slider(
+            "同時翻譯段落數",
+            min_value=1, max_value=10, value=4,
+            help="長文會依段落與句子切分，各段同時送出翻譯後再依原順序組合。"
+        )
+        
+        chunk_tokens = st.slider(
+            "每段 Token 上限",
+            min_value=200, max_value=4000, value=1000, step=100,
+            help="超過此長度的文字會被切成多段；段落越小完成越快，但上下文越少。"
+        )
+        
+        with st.expander("🧠 翻譯記憶"):
+            use_memory = st.toggle(
+                "逐行比對翻譯記憶", value=True,
+                help="依語境記住每一行原文的譯文；相同或高度相似的行（如選單、技能名稱、重複台詞）直接沿用，只送出其餘的行，並把已知術語附在提示中維持用語一致。"
+            )
+            memory_similarity = st.slider(
+                "近似相符門檻", min_value=0.80, max_value=1.00, value=0.92, step=0.01,
+                help="設為 1.00 時只沿用完全相同的行（數字不同仍會自動替換）。"
+            )
+    
     st.info("💡 提示：選擇正確的語境能顯著提升翻譯的自然度。")
 
 # --- 動態 CSS 主題控制 ---
@@ -90,43 +293,781 @@ st.markdown(theme_css, unsafe_allow_html=True)
 st.title("🏮 多模態截圖翻譯大師")
 st.subheader(f"當前模式：{app_mode}")
 
-# --- 共用：初始化指令與安全設定 ---
-def get_instruction_and_settings(is_image=True):
-    safety_settings = {
-        HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-        HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-        HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-        HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-    }
-    
-    if is_image:
-        base_instruction = "你是一個專業的翻譯專家。請先辨識圖片中的文字（OCR），然後將其翻譯成「繁體中文（台灣）」。\n"
+# --- 共用：感知雜湊 (dHash) 相似截圖偵測 ---
+PHASH_MEMORY_LIMIT = 200
+
+def remember_phash(image_hash, name, setting_id, result):
+    memory = st.session_state.phash_memory
+    memory.append({"hash": image_hash, "name": name, "setting_id": setting_id, "result": result})
+    if len(memory) > PHASH_MEMORY_LIMIT:
+        del memory[:len(memory) - PHASH_MEMORY_LIMIT]
+
+@st.cache_resource
+def get_translation_cache():
+    return TranslationCache(CACHE_DB_PATH)
+
+@st.cache_resource
+def get_translation_memory():
+    return TranslationMemory(MEMORY_DB_PATH)
+
+@st.cache_resource
+def get_translation_history():
+    return TranslationHistory(HISTORY_DB_PATH)
+
+def owner_id():
+    # 翻譯紀錄與資料夾監看的擁有者：有 Gemini 金鑰時以金鑰識別（重新整理頁面後仍能接回），否則為目前的工作階段
+    return api_key_id(api_key) if api_key else st.session_state.session_id
+
+def record_history(history, owner, entry_key, kind, name, result, source="", image_hash=None, thumbnail=None):
+    # 只保存實際有譯文的結果；沿用其他圖片翻譯的結果不重複記錄
+    # 在背景執行緒中呼叫，owner 需在開始翻譯時先取得；圖片的原文取自模型回應中辨識出的文字
+    if history is None or result["status"] not in ["ok", "filtered"] or not result["text"] or result.get("reused_from"):
+        return
+    history.add(
+        owner, entry_key, kind, name, result["text"], result["model"], context, source_lang,
+        source or result.get("source") or "", image_hash, thumbnail
+    )
+
+@st.cache_resource
+def get_metrics():
+    # 整個部署共用一份統計，跨使用者工作階段與重新執行累計
+    return Metrics()
+
+@st.cache_resource
+def get_model_scheduler(key_id):
+    # 以 API 金鑰的雜湊區分，不同金鑰的額度各自獨立，且狀態跨 Streamlit 重新執行保留
+    return ModelScheduler(FALLBACK_MODELS)
+
+@st.cache_resource
+def get_backend_router(key_id, provider_specs, _api_key=None):
+    # 金鑰本身不參與快取鍵（以 key_id 區分），只交給路由器建立專屬的 Gemini 連線；
+    # 不使用全域的 genai.configure，背景工作不會改用其他工作階段最後設定的金鑰
+    return create_router(get_model_scheduler(key_id) if key_id else None, provider_specs, _api_key)
+
+def build_router():
+    # 依側邊欄設定取得（或建立）本次使用的路由器；Gemini 金鑰以雜湊區分
+    router = get_backend_router(api_key_id(api_key) if api_key else None, parse_provider_specs(provider_text), api_key or None)
+    router.latency_aware = latency_routing
+    router.set_pacing(use_pacing)
+    router.set_hedging(hedge_percentile / 100 if use_hedging else None, hedge_budget / 100)
+    router.metrics = get_metrics()
+    return router
+
+def render_image_result(result, original_bytes):
+    render_result(result, is_image=True)
+    region = result.get("text_region")
+    if region:
+        width, height = region["original_size"]
+        if region["box"] is None:
+            st.caption(f"🔍 本機偵測未發現文字，省下 {width}×{height} 像素、{format_bytes(original_bytes)} 的上傳（偵測 {region['elapsed_ms']:.0f} ms）")
+        elif region["box"] != (0, 0, width, height):
+            left, top, right, bottom = region["box"]
+            saved = 1 - (right - left) * (bottom - top) / (width * height)
+            st.caption(
+                f"✂️ 已裁切至文字範圍 {right - left}×{bottom - top}，省下 {saved:.0%} 像素"
+                f"（偵測 {region['elapsed_ms']:.0f} ms）"
+            )
+    if result.get("tiles"):
+        st.caption(f"🧱 長截圖已切成 {result['tiles']} 塊同時翻譯，並合併去除重疊的重複內容")
+    if result.get("packed"):
+        st.caption(f"🧩 與其他 {result['packed'] - 1} 張圖片合併為同一次請求")
+    elif result.get("pack_retry"):
+        st.caption("🔁 合併請求未能解析此圖片的結果，已自動單張重新翻譯")
+    prep = result.get("preprocess")
+    if prep:
+        st.caption(
+            f"📦 原始 {prep['original_size'][0]}×{prep['original_size'][1]}，{format_bytes(original_bytes)}"
+            f" → 送出 {prep['sent_size'][0]}×{prep['sent_size'][1]}，{format_bytes(prep['sent_bytes'])}"
+            f"（節省 {max(0, 1 - prep['sent_bytes'] / max(original_bytes, 1)):.0%}，前處理 {prep['elapsed_ms']:.0f} ms）"
+        )
+
+def render_result(result, is_image=True):
+    for notice in result["notices"]:
+        st.toast(notice)
+    
+    if result.get("reused_from"):
+        st.caption(f"♻️ 與「{result['reused_from']}」高度相似，沿用其翻譯結果（未調用 API）")
+    
+    if result["status"] == "ok":
+        st.write(result["text"])
+        if result["cached"]:
+            st.caption(f"⚡ 來自翻譯快取（{result['model']}），未調用 API")
+    elif result["status"] == "filtered":
+        if is_image:
+            st.warning(f"⚠️ 內容觸發 {result['model']} 安全過濾機制，無法完整輸出。")
+        else:
+            st.warning(f"⚠️ 內容觸發 {result['model']} 安全過濾機制。")
+        if result["text"]:
+            st.write(result["text"])
+        else:
+            st.info("無法顯示翻譯結果。")
+    elif result["status"] == "no_text":
+        st.info("🈳 圖片中沒有偵測到文字，已略過翻譯。")
+    elif result["status"] == "blocked":
+        if is_image:
+            st.error("❌ 翻譯被攔截：內容可能包含敏感描述，請調整語境或圖片再試。")
+        else:
+            st.error("❌ 翻譯被攔截：文字內容觸發安全過濾。")
+    elif result["status"] == "exhausted":
+        st.error("❌ 所有備用模型的免費額度均已耗盡！請稍後再試。")
     else:
-        base_instruction = "你是一個專業的翻譯專家。請將以下文字翻譯成「繁體中文（台灣）」。\n"
+        st.error(f"❌ API 調用出錯：{result['error']}")
+    
+    if result.get("ttft") is not None and not result.get("reused_from"):
+        st.caption(f"⏱️ 首字延遲 {result['ttft']:.2f} 秒｜總耗時 {result['latency']:.2f} 秒（{result['model']}）")
+    
+    if result.get("tokens_saved") and not result.get("reused_from"):
+        st.caption(f"🧊 輸入中有 {result['tokens_saved']:,} Token 命中上下文快取")
+    
+    hedge = result.get("hedge")
+    if hedge and not result.get("reused_from"):
+        if hedge["winner"] == hedge["primary"]:
+            st.caption(f"🏁 {hedge['primary']} 超過 {hedge['delay']:.1f} 秒未回應而另送對沖請求，最後仍由原模型先完成")
+        else:
+            st.caption(f"🏁 {hedge['primary']} 超過 {hedge['delay']:.1f} 秒未回應，改由 {hedge['winner']} 先完成（估計省下 {hedge['saved']:.1f} 秒）")
+
+def render_streaming(placeholder, partial):
+    placeholder.markdown(partial + " ▌")
+
+# --- 共用：背景翻譯工作（不受重新執行影響，畫面以輪詢方式逐步顯示結果） ---
+JOB_POLL_SECONDS = 0.5
+
+@st.cache_resource
+def get_job_queue():
+    return JobQueue()
+
+def current_job_by_id(job_id):
+    return get_job_queue().get(st.session_state.session_id, job_id)
+
+def current_job(state_key):
+    return current_job_by_id(st.session_state.get(state_key))
+
+def without_repeated_notices(key, result):
+    # 輪詢時同一結果會重複顯示，切換模型等提示只跳出一次
+    shown = st.session_state.shown_notices
+    if key in shown:
+        return dict(result, notices=[])
+    shown.add(key)
+    return result
+
+def first_time_finished(job):
+    # 工作完成後的收尾（記錄相似截圖、完成動畫）每個工作只執行一次
+    if not job.done() or job.id in st.session_state.finished_jobs:
+        return False
+    st.session_state.finished_jobs.add(job.id)
+    return True
+
+def image_options():
+    # 回傳 (前處理, 長截圖切塊, 文字區域偵測) 設定，停用的項目為 None；三者都會列入快取鍵，
+    # 只影響速度的設定（如並行數）不放在這裡，調整後仍能命中快取
+    prep_options = None
+    if use_preprocess:
+        prep_options = {
+            "max_edge": prep_max_edge,
+            "grayscale": prep_grayscale,
+            "fmt": prep_format,
+            "quality": prep_quality,
+        }
+    
+    tile_options = None
+    if use_tiling:
+        tile_options = {"tile_height": tile_height, "overlap": tile_overlap}
+    
+    text_options = {"padding": text_padding} if use_text_detect else None
+    return prep_options, tile_options, text_options
+
+def start_image_job(uploaded_files):
+    # 狀態追蹤：各供應商的延遲統計與各模型的額度冷卻、節流狀態，跨批次與重新執行保留
+    router = build_router()
+    metrics = router.metrics
+    base_instruction, safety_settings = get_instruction_and_settings(context, is_image=True)
+    prompt_parts = build_prompt_parts(base_instruction, source_lang)
+    
+    cache = get_translation_cache() if use_cache else None
+    history = get_translation_history() if use_history else None
+    owner = owner_id()
+    prep_options, tile_options, text_options = image_options()
+    
+    cache_ids = [
+        make_cache_id(f.getvalue(), source_lang, context, base_instruction, repr((prep_options, tile_options, text_options)))
+        for f in uploaded_files
+    ]
+    
+    # 相同的圖片與設定視為同一個工作：執行中再次按下「開始翻譯」只會重新顯示進度，不會重送
+    setting_id = make_cache_id(b"", source_lang, context, base_instruction, repr((prep_options, tile_options, text_options)))
+    job_id = make_cache_id(
+        "\n".join(cache_ids), source_lang, context, base_instruction,
+        repr((use_dedup, dedup_threshold, images_per_request, use_streaming))
+    )
+    running = current_job_by_id(job_id)
+    if running is not None and not running.done():
+        return running
+    
+    # 逐張解碼：只保留原始尺寸、雜湊與壓縮縮圖，翻譯時才在背景執行緒中重新解碼完整圖片
+    scans = []
+    for uploaded_file in uploaded_files:
+        with metrics.span("decode"):
+            scans.append(scan_image(uploaded_file.getvalue(), with_hash=use_dedup or use_history))
+    # 雜湊在開啟翻譯紀錄時也會計算；只有開啟相似截圖合併時才用來分組
+    image_hashes = [scan["hash"] if use_dedup else None for scan in scans]
+    job = TranslationJob(job_id, len(uploaded_files), max_workers, meta={
+        "names": [f.name for f in uploaded_files],
+        "sizes": [f.size for f in uploaded_files],
+        "dimensions": [scan["size"] for scan in scans],
+        "thumbnails": [scan["thumbnail"] for scan in scans],
+        "hashes": image_hashes,
+        "setting_id": setting_id,
+    })
+    
+    # 相似截圖分組：先比對先前批次，再比對本批次中已選定的代表圖片
+    duplicates = {}
+    representatives = []
+    prior = [
+        (entry["hash"], entry) for entry in st.session_state.phash_memory
+        if entry["setting_id"] == setting_id
+    ] if use_dedup else []
+    batch_reps = []
+    
+    for i, image_hash in enumerate(image_hashes):
+        if image_hash is not None:
+            entry = find_similar(image_hash, prior, dedup_threshold)
+            if entry:
+                job.set_result(i, reuse_result(entry["result"], entry["name"]))
+                continue
+            
+            rep = find_similar(image_hash, batch_reps, dedup_threshold)
+            if rep is not None:
+                duplicates.setdefault(rep, []).append(i)
+                continue
+            batch_reps.append((image_hash, i))
+        representatives.append(i)
+    
+    def finish(i, result):
+        job.set_result(i, result)
+        record_history(history, owner, cache_ids[i], "image", job.meta["names"][i], result, image_hash=scans[i]["hash"], thumbnail=scans[i]["thumbnail"])
+        succeeded = result["status"] in ["ok", "filtered", "no_text"]
+        for j in duplicates.get(i, []):
+            job.set_result(j, reuse_result(result, job.meta["names"][i]) if succeeded else result)
+    
+    # 快取命中的圖片直接完成，其餘依「每次請求圖片數」分組送出；需要切塊的長截圖各自單獨處理
+    to_send = []
+    tall = []
+    for i in representatives:
+        with metrics.span("cache_lookup"):
+            result = cached_image_result(cache, cache_ids[i], router.model_names())
+        if result is not None:
+            finish(i, result)
+        elif tile_options and needs_tiling(scans[i]["size"], tile_height, tile_overlap):
+            tall.append(i)
+        else:
+            to_send.append(i)
+    packs = [to_send[k:k + images_per_request] for k in range(0, len(to_send), images_per_request)]
+    packs += [[i] for i in tall]
+    job.meta["requests"] = len(packs)
+    
+    def pack_task(pack, datas):
+        # 每個工作只持有自己那組圖片的原始檔案；完整解析度的像素在送出後立即釋放
+        def task():
+            on_chunk = None
+            if use_streaming:
+                on_chunk = lambda position, partial: job.set_partial(pack[position], partial)
+            images = []
+            try:
+                for data in datas:
+                    with metrics.span("decode"):
+                        images.append(load_image(data))
+                results = translate_image_pack_job(
+                    images,
+                    prompt_parts,
+                    safety_settings,
+                    router,
+                    cache,
+                    [cache_ids[i] for i in pack],
+                    prep_options,
+                    on_chunk,
+                    tile_options,
+                    text_options,
+                    max_workers
+                )
+            finally:
+                for img in images:
+                    img.close()
+            for i, result in zip(pack, results):
+                finish(i, result)
+        return task
+    
+    for pack in packs:
+        job.add_task(pack_task(pack, [uploaded_files[i].getvalue() for i in pack]))
+    return get_job_queue().submit(st.session_state.session_id, job)
+
+def show_image_job(job):
+    polling = not job.done()
+    
+    @st.fragment(run_every=JOB_POLL_SECONDS if polling else None)
+    def job_view():
+        partials, results = job.snapshot()
+        meta = job.meta
+        metrics = get_metrics()
+        
+        st.progress(len(results) / job.total)
+        if job.done():
+            st.text("✅ 所有翻譯任務已完成！" if not job.cancelled else f"⏹️ 已停止，完成 {len(results)}/{job.total} 張")
+        else:
+            st.text(
+                f"正在同時翻譯（共 {meta['requests']} 組，最多 {job.max_workers} 個並行），"
+                f"已完成 {len(results)}/{job.total} 張；調整設定或切換頁面不會中斷翻譯。"
+            )
+            if st.button("⏹️ 停止尚未開始的翻譯", key=f"cancel_{job.id}"):
+                job.cancel()
+        for message in job.errors:
+            st.error(f"❌ 系統錯誤：{message}")
+        
+        for i, name in enumerate(meta["names"]):
+            with st.expander(f"🖼️ {name} - 翻譯結果", expanded=True):
+                col_img, col_txt = st.columns([1, 1])
+                with col_img, metrics.span("render_image"):
+                    # 只傳送壓縮縮圖到瀏覽器，大量圖片時頁面仍然輕量
+                    width, height = meta["dimensions"][i]
+                    st.image(meta["thumbnails"][i], caption=f"原始圖片（{width}×{height}）", use_container_width=True)
+                
+                with col_txt:
+                    st.markdown("**翻譯內容：**")
+                    if i in results:
+                        with metrics.span("render_result"):
+                            render_image_result(without_repeated_notices((job.id, i), results[i]), meta["sizes"][i])
+                    elif i in partials:
+                        render_streaming(st.empty(), partials[i])
+                    elif job.done():
+                        st.info("⏹️ 已停止，未送出翻譯。")
+                    else:
+                        st.info("⏳ 等待翻譯中...")
         
-    base_instruction += "輸出格式：僅輸出翻譯後的純文字，不要包含任何開場白或解釋。請僅翻譯當前提供的內容，避免回顧過去的對話。\n"
-    
-    if context == "小說/網文":
-        base_instruction += "語境：小說。請保持角色對話語氣，使用台灣繁體中文用語，確保流暢且符合文學感。"
-    elif context == "遊戲截圖":
-        base_instruction += "語境：遊戲。請注意遊戲術語一致性，翻譯應簡潔有力。"
-    elif context == "技術文件":
-        base_instruction += "語境：技術。確保專有名詞準確，語氣正式嚴謹。"
+        if job.done():
+            latency_summary = summarize_latency([r for r in results.values() if not r.get("reused_from")])
+            if latency_summary:
+                st.caption(latency_summary)
+            if polling:
+                # 輪詢中發現工作完成：重新執行整個頁面以停止輪詢並執行收尾
+                st.rerun()
+    
+    job_view()
+    
+    if first_time_finished(job):
+        _, results = job.snapshot()
+        any_success = False
+        for i, result in results.items():
+            if result["status"] not in ["ok", "filtered", "no_text"]:
+                continue
+            any_success = True
+            if job.meta["hashes"][i] is not None and not result.get("reused_from"):
+                remember_phash(job.meta["hashes"][i], job.meta["names"][i], job.meta["setting_id"], result)
+        if any_success:
+            st.balloons()
+
+def start_text_job(input_text):
+    router = build_router()
+    base_instruction, safety_settings = get_instruction_and_settings(context, is_image=False)
+    prompt_parts = build_prompt_parts(base_instruction, source_lang)
+    
+    cache = get_translation_cache() if use_cache else None
+    history = get_translation_history() if use_history else None
+    owner = owner_id()
+    cache_id = make_cache_id(input_text, source_lang, context, base_instruction)
+    job_id = make_cache_id(
+        input_text, source_lang, context, base_instruction,
+        repr((use_memory, memory_similarity, chunk_tokens, use_streaming))
+    )
+    job = TranslationJob(job_id, 1, 1)
+    
+    def finish(result):
+        record_history(history, owner, cache_id, "text", None, result, source=input_text)
+        job.set_result("result", result)
+    
+    with router.metrics.span("cache_lookup"):
+        result = cached_result(cache, cache_id, router.model_names())
+    if result is not None:
+        finish(result)
+        return get_job_queue().submit(st.session_state.session_id, job)
+    
+    def cache_complete(result):
+        if cache is not None and result.get("complete") and result["status"] == "ok":
+            cache.put(make_cache_key(cache_id, result["model"]), result["model"], result["text"])
+    
+    if use_memory:
+        # 翻譯記憶：逐行比對，相符的行立即完成，其餘分組並行送出；譯文依原本的行結構組合
+        memory = get_translation_memory()
+        segments = split_segments(input_text, chunk_tokens)
+        job.meta = {"units": segments, "unit_name": "行", "retry_source": "翻譯記憶"}
+        
+        def task():
+            segment_results = translate_with_memory(
+                segments,
+                prompt_parts,
+                safety_settings,
+                router,
+                memory,
+                context,
+                memory_similarity,
+                chunk_tokens,
+                max_workers,
+                job.set_partial if use_streaming else None,
+                job.set_result
+            )
+            result = merge_chunk_results(segments, segment_results)
+            result["memory_stats"] = summarize_memory(segment_results)
+            cache_complete(result)
+            finish(result)
     else:
-        base_instruction += "語境：一般。提供準確自然的翻譯。"
+        with router.metrics.span("chunking"):
+            chunks = chunk_text(input_text, chunk_tokens)
+        
+        if len(chunks) > 1:
+            # 長文：各段並行翻譯，結果依原順序即時組合顯示；失敗的段落自動重送
+            job.meta = {"units": chunks, "unit_name": "段", "retry_source": "快取"}
+            chunk_ids = make_chunk_cache_ids(chunks, source_lang, context, base_instruction)
+            
+            def task():
+                chunk_results = translate_text_chunks(
+                    chunks,
+                    prompt_parts,
+                    safety_settings,
+                    router,
+                    cache,
+                    chunk_ids,
+                    max_workers,
+                    job.set_partial if use_streaming else None,
+                    job.set_result
+                )
+                result = merge_chunk_results(chunks, chunk_results)
+                cache_complete(result)
+                finish(result)
+        else:
+            def task():
+                finish(generate_with_fallback(
+                    prompt_parts + [input_text],
+                    safety_settings,
+                    router,
+                    cache,
+                    cache_id,
+                    (lambda partial: job.set_partial("text", partial)) if use_streaming else None
+                ))
+    
+    job.add_task(task)
+    return get_job_queue().submit(st.session_state.session_id, job)
+
+def show_text_job(job):
+    polling = not job.done()
+    
+    @st.fragment(run_every=JOB_POLL_SECONDS if polling else None)
+    def job_view():
+        partials, results = job.snapshot()
+        units = job.meta.get("units")
+        for message in job.errors:
+            st.error(f"❌ 系統錯誤：{message}")
+        
+        result = results.get("result")
+        if result is None:
+            st.markdown("### 📝 翻譯結果：")
+            if units:
+                # 各段（行）依原順序組合：已完成的顯示譯文，串流中的顯示目前文字
+                finished = [k for k in range(len(units)) if k in results]
+                st.progress(len(finished) / len(units))
+                st.text(f"共 {len(units)} {job.meta['unit_name']}，最多 {max_workers} 個同時翻譯；調整設定或切換頁面不會中斷翻譯。")
+                texts = []
+                for k in range(len(units)):
+                    if k in results:
+                        unit = results[k]
+                        ok = unit["status"] in ["ok", "filtered"] and unit["text"]
+                        texts.append(unit["text"].strip() if ok else f"〔第 {k + 1} {job.meta['unit_name']}翻譯失敗〕")
+                    else:
+                        texts.append(partials.get(k, "⏳"))
+                render_streaming(st.empty(), join_chunk_texts(units, texts))
+            elif "text" in partials:
+                render_streaming(st.empty(), partials["text"])
+            elif not job.done():
+                st.info("⏳ 正在翻譯中...")
+        else:
+            if result["status"] in ["ok", "filtered"] or units:
+                st.markdown("### 📝 翻譯結果：")
+            render_result(without_repeated_notices((job.id, "result"), result), is_image=False)
+            
+            stats = result.get("memory_stats")
+            if stats:
+                st.caption(
+                    f"🧠 翻譯記憶：完全相符 {stats['exact']} 行、近似相符 {stats['fuzzy']} 行，"
+                    f"送出翻譯 {stats['sent']} 行"
+                )
+            if units:
+                failed = [k + 1 for k in range(len(units)) if results[k]["status"] not in ["ok", "filtered"]]
+                if failed:
+                    st.error(
+                        f"❌ 第 {'、'.join(map(str, failed))} {job.meta['unit_name']}翻譯失敗。"
+                        f"再次按下「開始翻譯」時，已完成的{job.meta['unit_name']}會直接取自{job.meta['retry_source']}，"
+                        f"只重送失敗的{job.meta['unit_name']}。"
+                    )
+            if result["status"] in ["ok", "filtered"]:
+                st.success("✅ 翻譯完成！")
+        
+        if polling and job.done():
+            st.rerun()
+    
+    job_view()
+    
+    if first_time_finished(job):
+        result = job.snapshot()[1].get("result")
+        if result and result["status"] in ["ok", "filtered"]:
+            st.balloons()
+
+# --- 共用：資料夾監看（整個行程共用，關閉頁面後仍持續翻譯，直到按下停止） ---
+WATCH_REFRESH_SECONDS = 1.0
+WATCH_SHOW_EXPANDED = 3
+
+# 資料夾路徑 -> {"watch": FolderWatch, "owner": 擁有者}；只有開始監看的擁有者能查看與停止
+@st.cache_resource
+def get_folder_watches():
+    return {}
+def start_folder_watch(folder, log_path, recursive):
+    router = build_router()
+    base_instruction, safety_settings = get_instruction_and_settings(context, is_image=True)
+    prompt_parts = build_prompt_parts(base_instruction, source_lang)
+    cache = get_translation_cache() if use_cache else None
+    history = get_translation_history() if use_history else None
+    owner = owner_id()
+    prep_options, tile_options, text_options = image_options()
+    
+    def translate(path, data):
+        cache_id = make_cache_id(data, source_lang, context, base_instruction, repr((prep_options, tile_options, text_options)))
+        result = translate_image_file(
+            data, prompt_parts, safety_settings, router, cache, cache_id, prep_options, tile_options, text_options, max_workers
+        )
+        if history is not None:
+            scan = scan_image(data, with_hash=True)
+            record_history(history, owner, cache_id, "image", path, result, image_hash=scan["hash"], thumbnail=scan["thumbnail"])
+        return result
+    
+    # 翻譯設定在開始監看時固定，調整側邊欄後需停止再重新開始
+    watch = FolderWatch(folder, log_path, translate, max_workers, recursive)
+    watch.start()
+    get_folder_watches()[folder] = {"watch": watch, "owner": owner_id()}
+    return watch
+
+def show_folder_watch(watch):
+    running = watch.running()
+    
+    @st.fragment(run_every=WATCH_REFRESH_SECONDS if running else None)
+    def watch_view():
+        recent, stats, errors = watch.snapshot()
+        if watch.running():
+            st.text(
+                f"👀 監看中（{watch.mode()}）：已翻譯 {stats['finished']} 張、失敗 {stats['failed']} 張、"
+                f"處理中 {stats['queued'] - stats['finished'] - stats['failed']} 張、等待寫入完成 {stats['settling']} 張；"
+                f"紀錄中已完成的 {stats['restored']} 張不會重新翻譯。"
+            )
+        else:
+            st.text(f"⏹️ 已停止監看：本次翻譯 {stats['finished']} 張、失敗 {stats['failed']} 張。")
+        st.caption(f"結果紀錄：{watch.log_path}")
+        for message in errors:
+            st.error(f"❌ 系統錯誤：{message}")
+        
+        for k, item in enumerate(recent):
+            record = item["record"]
+            with st.expander(f"🖼️ {os.path.relpath(record['file'], watch.folder)} - {record['finished_at']}", expanded=k < WATCH_SHOW_EXPANDED):
+                col_img, col_txt = st.columns([1, 1])
+                with col_img:
+                    if item["thumbnail"]:
+                        st.image(item["thumbnail"], use_container_width=True)
+                with col_txt:
+                    result = without_repeated_notices((record["file"], record["mtime_ns"]), item["result"])
+                    render_image_result(result, record["size"])
+    
+    watch_view()
+
+SUBTITLE_SHOW_SEGMENTS = 200
+
+def start_video_job(uploaded_file):
+    router = build_router()
+    metrics = router.metrics
+    base_instruction, safety_settings = get_instruction_and_settings(context, is_image=True)
+    prompt_parts = build_prompt_parts(base_instruction, source_lang)
+    
+    cache = get_translation_cache() if use_cache else None
+    history = get_translation_history() if use_history else None
+    owner = owner_id()
+    # 送出的已是裁切好的字幕文字範圍，不再切塊或偵測文字
+    prep_options, _, _ = image_options()
+    region = (subtitle_region[0] / 100, subtitle_region[1] / 100)
+    
+    data = uploaded_file.getvalue()
+    job_id = make_cache_id(
+        data, source_lang, context, base_instruction,
+        repr((prep_options, sample_fps, region, subtitle_threshold, images_per_request, use_streaming))
+    )
+    running = current_job_by_id(job_id)
+    if running is not None and not running.done():
+        return running
+    
+    # OpenCV 只能從檔案路徑讀取影片，先寫入暫存檔，分析完成後刪除
+    with tempfile.NamedTemporaryFile(suffix=os.path.splitext(uploaded_file.name)[1], delete=False) as f:
+        f.write(data)
+        video_path = f.name
+    
+    job = TranslationJob(job_id, 0, max_workers, meta={
+        "name": uploaded_file.name,
+        "sampled": 0,
+        "position": 0.0,
+        "segments": None,
+    })
+    
+    def on_frame(count, timestamp):
+        job.meta["sampled"] = count
+        job.meta["position"] = timestamp
+    
+    def analyze():
+        try:
+            with metrics.span("video_scan"):
+                segments = detect_subtitle_changes(
+                    iter_video_frames(video_path, sample_fps), region, subtitle_threshold, 1.0 / sample_fps, on_frame
+                )
+        finally:
+            os.remove(video_path)
+        
+        # 畫面與翻譯紀錄只需要字幕裁切的縮圖；完整的裁切圖片只由各自的翻譯工作持有
+        thumbnails = [make_thumbnail(segment["image"]) for segment in segments]
+        
+        # 字幕內容相同的片段（重複的台詞）沿用第一次出現時的翻譯
+        duplicates = {}
+        for i, segment in enumerate(segments):
+            if segment["same_as"] is not None:
+                duplicates.setdefault(segment["same_as"], []).append(i)
+        
+        def finish(i, result):
+            job.set_result(i, result)
+            record_history(
+                history, owner, cache_ids[i], "video", f"{uploaded_file.name} {format_srt_time(segments[i]['start'])}", result,
+                image_hash=segments[i]["hash"], thumbnail=thumbnails[i]
+            )
+            succeeded = result["status"] in ["ok", "filtered", "no_text"]
+            for j in duplicates.get(i, []):
+                job.set_result(j, reuse_result(result, f"#{i + 1}") if succeeded else result)
+        
+        cache_ids = {}
+        to_send = []
+        for i, segment in enumerate(segments):
+            if segment["same_as"] is not None:
+                continue
+            image = segment["image"]
+            cache_ids[i] = make_cache_id(image.tobytes(), source_lang, context, base_instruction, repr((image.size, prep_options)))
+            with metrics.span("cache_lookup"):
+                result = cached_image_result(cache, cache_ids[i], router.model_names())
+            if result is not None:
+                finish(i, result)
+            else:
+                to_send.append(i)
+        packs = [to_send[k:k + images_per_request] for k in range(0, len(to_send), images_per_request)]
         
-    return base_instruction, safety_settings
-
-# 定義動態切換的模型清單 (加入容錯命名組合)
-FALLBACK_MODELS = [
-    'gemini-3-flash-preview',         
-    'gemini-3.1-pro-preview',
-    'gemini-3.1-flash-lite-preview',
-    'gemini-2.5-flash',          
-    'gemini-2.5-pro',    
-    'gemini-2.0-flash',             
-    'gemini-2.0-flash-lite'            
-]
+        def pack_task(pack):
+            def task():
+                on_chunk = None
+                if use_streaming:
+                    on_chunk = lambda position, partial: job.set_partial(pack[position], partial)
+                results = translate_image_pack_job(
+                    [segments[i]["image"] for i in pack],
+                    prompt_parts,
+                    safety_settings,
+                    router,
+                    cache,
+                    [cache_ids[i] for i in pack],
+                    prep_options,
+                    on_chunk
+                )
+                for i, result in zip(pack, results):
+                    finish(i, result)
+            return task
+        
+        job.meta["segments"] = [
+            {"start": s["start"], "end": s["end"], "same_as": s["same_as"], "thumbnail": thumbnail}
+            for s, thumbnail in zip(segments, thumbnails)
+        ]
+        job.meta["sent"] = len(to_send)
+        job.meta["requests"] = len(packs)
+        job.total = len(segments)
+        for pack in packs:
+            job.add_task(pack_task(pack))
+    
+    job.add_task(analyze)
+    return get_job_queue().submit(st.session_state.session_id, job)
+
+def subtitle_cues(segments, results):
+    return [
+        (segment["start"], segment["end"], results[i]["text"])
+        for i, segment in enumerate(segments)
+        if i in results and results[i]["status"] in ["ok", "filtered"]
+    ]
+
+def show_video_job(job):
+    polling = not job.done()
+    
+    @st.fragment(run_every=JOB_POLL_SECONDS if polling else None)
+    def job_view():
+        partials, results = job.snapshot()
+        meta = job.meta
+        segments = meta["segments"]
+        
+        if segments is None:
+            if job.done():
+                st.text("⏹️ 已停止分析。")
+            else:
+                st.text(f"🎞️ 正在分析影格：已取樣 {meta['sampled']} 張（{meta['position']:.1f} 秒）")
+        else:
+            saved = 1 - meta["sent"] / meta["sampled"] if meta["sampled"] else 0
+            st.caption(
+                f"取樣 {meta['sampled']} 張影格，偵測到 {len(segments)} 句字幕，"
+                f"實際送出 {meta['sent']} 張（{meta['requests']} 次請求），省下 {saved:.0%} 的影格；"
+                f"重複的字幕與快取命中直接沿用。"
+            )
+            st.progress(len(results) / job.total if job.total else 1.0)
+            if job.done():
+                st.text("✅ 字幕翻譯完成！" if not job.cancelled else f"⏹️ 已停止，完成 {len(results)}/{job.total} 句")
+            else:
+                st.text(f"正在翻譯字幕（最多 {job.max_workers} 個並行），已完成 {len(results)}/{job.total} 句。")
+        if not job.done() and st.button("⏹️ 停止尚未開始的翻譯", key=f"cancel_{job.id}"):
+            job.cancel()
+        for message in job.errors:
+            st.error(f"❌ 系統錯誤：{message}")
+        
+        if segments is not None and job.done():
+            srt = build_srt(subtitle_cues(segments, results))
+            if srt:
+                st.download_button(
+                    "💾 下載 SRT 字幕", srt, file_name=os.path.splitext(meta["name"])[0] + ".srt", mime="application/x-subrip"
+                )
+                with st.expander("📝 SRT 預覽"):
+                    st.code(srt, language=None)
+            else:
+                st.info("沒有可輸出的字幕。")
+        
+        if segments:
+            with st.expander(f"🖼️ 字幕影格（{len(segments)} 句）", expanded=not job.done()):
+                for i, segment in enumerate(segments[:SUBTITLE_SHOW_SEGMENTS]):
+                    col_img, col_txt = st.columns([1, 1])
+                    with col_img:
+                        st.image(segment["thumbnail"], caption=f"#{i + 1}　{format_srt_time(segment['start'])} → {format_srt_time(segment['end'])}")
+                    with col_txt:
+                        if i in results:
+                            render_result(without_repeated_notices((job.id, i), results[i]))
+                        elif i in partials:
+                            render_streaming(st.empty(), partials[i])
+                        elif job.done():
+                            st.info("⏹️ 已停止，未送出翻譯。")
+                        else:
+                            st.info("⏳ 等待翻譯中...")
+                if len(segments) > SUBTITLE_SHOW_SEGMENTS:
+                    st.caption(f"只顯示前 {SUBTITLE_SHOW_SEGMENTS} 句，完整內容請下載 SRT。")
+        
+        if job.done() and polling:
+            st.rerun()
+    
+    job_view()
 
 # ==========================================
 # 模式 A：圖片截圖翻譯 
@@ -135,7 +1076,7 @@ if app_mode == "📸 圖片截圖翻譯":
     col1, col2 = st.columns([3, 1])
     with col1:
         uploaded_files = st.file_uploader(
-            "請上傳截圖 (最多 10 張)", 
+            f"請上傳截圖 (最多 {max_images} 張)", 
             type=["png", "jpg", "jpeg"], 
             accept_multiple_files=True,
             key=f"uploader_{st.session_state.uploader_key}"
@@ -147,90 +1088,33 @@ if app_mode == "📸 圖片截圖翻譯":
             pass
 
     if uploaded_files:
-        if len(uploaded_files) > 10:
-            st.warning("⚠️ 目前僅支援最多 10 張圖片，將只處理前 10 張。")
-            uploaded_files = uploaded_files[:10]
+        if len(uploaded_files) > max_images:
+            st.warning(f"⚠️ 目前設定單批最多 {max_images} 張圖片，將只處理前 {max_images} 張。")
+            uploaded_files = uploaded_files[:max_images]
 
         if st.button("🚀 開始翻譯"):
-            if not api_key:
+            if not api_key and not parse_provider_specs(provider_text):
                 st.error("❌ 請先在側邊欄輸入有效的 Gemini API 金鑰。")
             else:
                 try:
-                    genai.configure(api_key=api_key)
-                    base_instruction, safety_settings = get_instruction_and_settings(is_image=True)
-
-                    progress_bar = st.progress(0)
-                    status_text = st.empty()
-                    
-                    # 狀態追蹤：紀錄當前使用的模型索引
-                    current_model_idx = 0
-                    
-                    for i, uploaded_file in enumerate(uploaded_files):
-                        status_text.text(f"正在處理第 {i+1}/{len(uploaded_files)} 張：{uploaded_file.name}")
-                        img = Image.open(uploaded_file)
-                        
-                        with st.expander(f"🖼️ {uploaded_file.name} - 翻譯結果", expanded=True):
-                            col_img, col_txt = st.columns([1, 1])
-                            with col_img:
-                                st.image(img, caption="原始圖片", use_container_width=True)
-                            
-                            with col_txt:
-                                st.markdown("**翻譯內容：**")
-                                
-                                success = False
-                                while current_model_idx < len(FALLBACK_MODELS) and not success:
-                                    model_name = FALLBACK_MODELS[current_model_idx]
-                                    model = genai.GenerativeModel(model_name)
-                                    
-                                    try:
-                                        response = model.generate_content(
-                                            [base_instruction, f"來源語言：{source_lang}", img],
-                                            safety_settings=safety_settings
-                                        )
-                                        success = True
-                                        
-                                        if response.candidates and response.candidates[0].finish_reason in [3, 4, 8]:
-                                            st.warning(f"⚠️ 內容觸發 {model_name} 安全過濾機制，無法完整輸出。")
-                                            try:
-                                                st.write(response.text)
-                                            except:
-                                                st.info("無法顯示翻譯結果。")
-                                        else:
-                                            st.write(response.text)
-                                            
-                                    except Exception as api_err:
-                                        err_str = str(api_err).lower()
-                                        if "429" in err_str or "quota" in err_str or "exhausted" in err_str:
-                                            st.toast(f"🔄 {model_name} 額度耗盡，自動切換至下一個模型...")
-                                            current_model_idx += 1
-                                        elif "finish_reason" in err_str:
-                                            st.error("❌ 翻譯被攔截：內容可能包含敏感描述，請調整語境或圖片再試。")
-                                            break
-                                        else:
-                                            st.error(f"❌ API 調用出錯：{str(api_err)}")
-                                            break
-                                
-                                if not success and current_model_idx >= len(FALLBACK_MODELS):
-                                    st.error("❌ 所有備用模型的免費額度均已耗盡！請稍後再試。")
-                                    break # 中斷後續圖片的處理
-                        
-                        progress_bar.progress((i + 1) / len(uploaded_files))
-                    
-                    if success:
-                        status_text.text("✅ 所有翻譯任務已完成！")
-                        st.balloons()
-
+                    st.session_state.image_job = start_image_job(uploaded_files).id
                 except Exception as e:
                     st.error(f"❌ 系統錯誤：{str(e)}")
                     st.info("請檢查 API 金鑰或網路連線。")
-    else:
+    
+    # 不論是否剛按下按鈕、上傳欄位是否仍有檔案（例如切換模式後回來）都顯示本工作階段最近一次的工作；
+    # 名稱與縮圖都來自工作本身，重新執行時翻譯仍在背景進行
+    job = current_job("image_job")
+    if job is not None:
+        show_image_job(job)
+    elif not uploaded_files:
         st.info("📸 請上傳圖片以開始翻譯任務。")
 
 
 # ==========================================
 # 模式 B：純文字翻譯 
 # ==========================================
-else:
+elif app_mode == "✍️ 純文字翻譯":
     input_text = st.text_area(
         "請輸入要翻譯的原文內容：", 
         height=250, 
@@ -246,57 +1130,237 @@ else:
             pass
 
     if start_btn:
-        if not api_key:
+        if not api_key and not parse_provider_specs(provider_text):
             st.error("❌ 請先在側邊欄輸入有效的 Gemini API 金鑰。")
         elif not input_text.strip():
             st.warning("⚠️ 請先輸入需要翻譯的文字。")
         else:
             try:
-                genai.configure(api_key=api_key)
-                base_instruction, safety_settings = get_instruction_and_settings(is_image=False)
-                
-                with st.spinner("正在翻譯中..."):
-                    current_model_idx = 0
-                    success = False
-                    
-                    while current_model_idx < len(FALLBACK_MODELS) and not success:
-                        model_name = FALLBACK_MODELS[current_model_idx]
-                        model = genai.GenerativeModel(model_name)
-                        
-                        try:
-                            response = model.generate_content(
-                                [base_instruction, f"來源語言：{source_lang}", input_text],
-                                safety_settings=safety_settings
-                            )
-                            success = True
-                            
-                            st.markdown("### 📝 翻譯結果：")
-                            if response.candidates and response.candidates[0].finish_reason in [3, 4, 8]:
-                                st.warning(f"⚠️ 內容觸發 {model_name} 安全過濾機制。")
-                                try:
-                                    st.write(response.text)
-                                except:
-                                    st.info("無法顯示翻譯結果。")
-                            else:
-                                st.write(response.text)
-                                
-                        except Exception as api_err:
-                            err_str = str(api_err).lower()
-                            if "429" in err_str or "quota" in err_str or "exhausted" in err_str:
-                                st.toast(f"🔄 {model_name} 額度耗盡，自動切換至下一個模型...")
-                                current_model_idx += 1
-                            elif "finish_reason" in err_str:
-                                st.error("❌ 翻譯被攔截：文字內容觸發安全過濾。")
-                                break
-                            else:
-                                st.error(f"❌ API 調用出錯：{str(api_err)}")
-                                break
-
-                    if success:
-                        st.success("✅ 翻譯完成！")
-                        st.balloons()
-                    elif current_model_idx >= len(FALLBACK_MODELS):
-                        st.error("❌ 所有備用模型的免費額度均已耗盡！請稍後再試。")
-                
+                st.session_state.text_job = start_text_job(input_text).id
+            except Exception as e:
+                st.error(f"❌ 系統錯誤：{str(e)}")
+    
+    job = current_job("text_job")
+    if job is not None:
+        show_text_job(job)
+
+# ==========================================
+# 模式 C：資料夾監看 
+# ==========================================
+elif app_mode == "📂 資料夾監看":
+    col_root, col_dir, col_log = st.columns([1, 1, 1])
+    with col_root:
+        watch_root = st.selectbox("監看的根目錄", watch_roots, help="由伺服器設定（watch_roots 或 SCREENSHOT_WATCH_ROOTS）")
+    with col_dir:
+        watch_dir = st.text_input("子資料夾", placeholder="相對於根目錄，留空時監看根目錄本身")
+    with col_log:
+        watch_log = st.text_input("結果紀錄檔名 (JSONL)", value="translations.jsonl", help="寫入監看的資料夾中")
+    watch_recursive = st.toggle("包含子資料夾", value=True)
+    
+    # 資料夾與紀錄檔都必須位於設定的根目錄之內
+    watch_folder = resolve_inside(watch_root, watch_dir.strip())
+    log_path = resolve_inside(watch_folder, watch_log.strip() or "translations.jsonl") if watch_folder else None
+    entry = get_folder_watches().get(watch_folder) if watch_folder else None
+    watch = entry["watch"] if entry is not None and entry["owner"] == owner_id() else None
+    
+    if watch is not None and watch.running():
+        if st.button("⏹️ 停止監看", type="secondary"):
+            watch.stop()
+            st.rerun()
+    elif st.button("👀 開始監看"):
+        if not api_key and not parse_provider_specs(provider_text):
+            st.error("❌ 請先在側邊欄輸入有效的 Gemini API 金鑰。")
+        elif watch_folder is None or not os.path.isdir(watch_folder):
+            st.warning("⚠️ 找不到這個資料夾，子資料夾必須位於設定的根目錄之內。")
+        elif log_path is None or not log_path.lower().endswith(".jsonl") or os.path.isdir(log_path):
+            st.warning("⚠️ 結果紀錄必須是監看資料夾中的 .jsonl 檔案。")
+        elif entry is not None and entry["watch"].running():
+            st.warning("⚠️ 這個資料夾已由其他使用者監看中。")
+        else:
+            try:
+                watch = start_folder_watch(watch_folder, log_path, watch_recursive)
             except Exception as e:
                 st.error(f"❌ 系統錯誤：{str(e)}")
+    
+    if watch is not None:
+        show_folder_watch(watch)
+    else:
+        st.info("📂 選擇資料夾後開始監看，新截圖寫入完成後會自動翻譯。")
+
+# ==========================================
+# 模式 D：影片字幕翻譯 
+# ==========================================
+elif app_mode == "🎬 影片字幕翻譯":
+    # 影片需要 OpenCV（opencv-python-headless），未安裝時只接受以 Pillow 讀取的 GIF
+    video_enabled = video_reader_available()
+    col1, col2 = st.columns([3, 1])
+    with col1:
+        uploaded_video = st.file_uploader(
+            "請上傳螢幕錄影或 GIF" if video_enabled else "請上傳 GIF",
+            type=([ext.lstrip(".") for ext in VIDEO_EXTENSIONS] if video_enabled else []) + ["gif"],
+            key=f"video_uploader_{st.session_state.uploader_key}"
+        )
+        if not video_enabled:
+            st.caption("ℹ️ 伺服器未安裝 opencv-python-headless，目前只能上傳 GIF。")
+    with col2:
+        st.write("") 
+        st.write("") 
+        if st.button("🗑️ 一鍵清空", type="secondary", on_click=clear_files):
+            pass
+    
+    if uploaded_video:
+        if st.button("🚀 開始翻譯"):
+            if not api_key and not parse_provider_specs(provider_text):
+                st.error("❌ 請先在側邊欄輸入有效的 Gemini API 金鑰。")
+            else:
+                try:
+                    st.session_state.video_job = start_video_job(uploaded_video).id
+                except Exception as e:
+                    st.error(f"❌ 系統錯誤：{str(e)}")
+    
+    job = current_job("video_job")
+    if job is not None:
+        show_video_job(job)
+    elif not uploaded_video:
+        st.info("🎬 請上傳影片，只有字幕改變的影格會送出翻譯，完成後可下載 SRT 字幕檔。")
+
+# ==========================================
+# 模式 E：翻譯紀錄 
+# ==========================================
+else:
+    history = get_translation_history()
+    # 只顯示目前 API 金鑰（未輸入金鑰時為目前工作階段）保存的紀錄
+    owner = owner_id()
+    col_query, col_context = st.columns([3, 1])
+    with col_query:
+        history_query = st.text_input("搜尋原文或譯文", placeholder="輸入關鍵字，多個關鍵字以空白分隔")
+    with col_context:
+        history_context = st.selectbox("語境", ["全部", "一般", "小說/網文", "遊戲截圖", "技術文件"])
+    filter_context = None if history_context == "全部" else history_context
+    
+    # 先只查詢筆數決定頁數，再讀取目前這一頁；數萬筆紀錄時每次重新執行仍只讀取一頁的資料與縮圖
+    _, total = history.search(owner, history_query, filter_context, limit=0)
+    pages = max(1, -(-total // HISTORY_PAGE_SIZE))
+    col_page, col_count = st.columns([1, 3])
+    with col_page:
+        # 搜尋條件改變時回到第一頁
+        page = st.number_input(
+            "頁碼", min_value=1, max_value=pages, value=1, step=1,
+            key=f"history_page_{history_query}_{history_context}"
+        )
+    with col_count:
+        st.write("")
+        st.caption(f"共 {total} 筆紀錄，第 {page}/{pages} 頁")
+    
+    entries, _ = history.search(owner, history_query, filter_context, (page - 1) * HISTORY_PAGE_SIZE)
+    kind_icons = {"image": "🖼️", "text": "✍️", "video": "🎬"}
+    for entry in entries:
+        title = entry["name"] or entry["source"].strip().split("\n")[0][:40]
+        finished_at = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["created_at"]))
+        with st.expander(f"{kind_icons.get(entry['kind'], '📄')} {title} - {finished_at}"):
+            thumbnail = history.thumbnail(owner, entry["id"])
+            if thumbnail:
+                col_img, col_txt = st.columns([1, 2])
+                with col_img:
+                    st.image(thumbnail, use_container_width=True)
+            else:
+                col_txt = st.container()
+            with col_txt:
+                if entry["source"]:
+                    st.markdown("**原文：**")
+                    st.text(entry["source"])
+                st.markdown("**翻譯內容：**")
+                st.write(entry["text"])
+                st.caption(f"{entry['model']}｜語境：{entry['context']}｜來源語言：{entry['source_lang']}")
+    if not entries:
+        if history_query.strip() or filter_context:
+            st.info("🗂️ 沒有符合條件的翻譯紀錄。")
+        else:
+            st.info("🗂️ 尚無翻譯紀錄，翻譯完成的結果會自動保存在這裡；紀錄依 API 金鑰分開保存。")
+
+# --- 側邊欄：快取統計（放在最後，才能反映本次執行的命中數） ---
+if use_cache:
+    with st.sidebar:
+        with st.expander("🗄️ 翻譯快取統計"):
+            cache = get_translation_cache()
+            stats = cache.stats
+            st.caption(
+                f"記憶體命中：{stats['memory_hits']}　磁碟命中：{stats['disk_hits']}　未命中：{stats['misses']}"
+            )
+            st.caption(f"記憶體項目：{len(cache.memory)}　磁碟項目：{cache.disk_size()}")
+            if st.button("清除快取", key="clear_cache"):
+                cache.clear()
+
+# --- 側邊欄：翻譯紀錄統計 ---
+if use_history:
+    with st.sidebar:
+        with st.expander("📜 翻譯紀錄"):
+            history = get_translation_history()
+            st.caption(f"已保存 {history.size(owner_id())} 筆翻譯紀錄")
+            if st.button("清除翻譯紀錄", key="clear_history"):
+                history.clear(owner_id())
+
+# --- 側邊欄：翻譯記憶統計 ---
+if app_mode == "✍️ 純文字翻譯" and use_memory:
+    with st.sidebar:
+        with st.expander("🧠 翻譯記憶統計"):
+            memory = get_translation_memory()
+            st.caption(f"「{context}」語境：{memory.size(context)} 行　全部語境：{memory.size()} 行")
+            st.caption(
+                f"完全相符：{memory.stats['exact']}　近似相符：{memory.stats['fuzzy']}　未命中：{memory.stats['misses']}"
+            )
+            if st.button(f"清除「{context}」的翻譯記憶", key="clear_memory"):
+                memory.clear(context)
+
+# --- 側邊欄：模型排程與供應商路由狀態 ---
+if api_key or parse_provider_specs(provider_text):
+    with st.sidebar:
+        with st.expander("🚦 模型排程狀態"):
+            router = build_router()
+            for route in router.ranked():
+                p50, success_rate = route.stats()
+                latency_text = f"p50 {p50:.2f} 秒" if p50 is not None else "p50 —"
+                rate_text = f"成功率 {success_rate:.0%}" if success_rate is not None else "成功率 —"
+                st.markdown(f"**{route.name}**　{latency_text}　{rate_text}　（近 {len(route.samples)} 次）")
+                for row in route.scheduler.snapshot():
+                    if row["cooldown"] > 0:
+                        status = f"⏳ 冷卻中（{row['cooldown']:.0f} 秒）"
+                    else:
+                        status = "✅ 可用"
+                    st.caption(
+                        f"{row['model']}：{status}　本分鐘剩餘 {row['rpm_left']:.1f} 次　"
+                        f"成功 {row['successes']}　額度錯誤 {row['quota_hits']}"
+                    )
+            if st.button("重設冷卻狀態", key="reset_scheduler"):
+                for route in router.routes:
+                    route.scheduler.reset()
+
+# --- 側邊欄：效能診斷（各階段耗時、Token 用量，可匯出 JSON 與 Prometheus 格式） ---
+with st.sidebar:
+    with st.expander("📊 效能診斷"):
+        metrics = get_metrics()
+        snap = metrics.snapshot()
+        if not snap["stages"]:
+            st.caption("尚無資料，翻譯後會顯示各階段耗時與 Token 用量。")
+        for stage, entry in sorted(snap["stages"].items(), key=lambda item: -item[1]["total_seconds"]):
+            st.caption(
+                f"{stage}：{entry['count']} 次　平均 {entry['avg_seconds'] * 1000:.0f} ms　"
+                f"p95 {entry['p95_seconds'] * 1000:.0f} ms　累計 {entry['total_seconds']:.1f} 秒"
+            )
+        for name, entry in snap["models"].items():
+            st.caption(
+                f"**{name}**：{entry['requests']} 次　輸入 {entry['prompt_tokens']:,} Token　"
+                f"輸出 {entry['output_tokens']:,} Token　快取 {entry['cached_tokens']:,} Token"
+            )
+        if snap["counters"]:
+            st.caption("　".join(f"{event} {value}" for event, value in sorted(snap["counters"].items())))
+        pool = build_router().pool_stats()
+        if pool["built"]:
+            st.caption(
+                f"模型實例：建立 {pool['built']} 個、重複使用 {pool['reused']} 次、"
+                f"上下文快取 {pool['context_caches']} 個"
+            )
+        st.download_button("下載 JSON", metrics.to_json(), file_name="metrics.json", mime="application/json")
+        st.download_button("下載 Prometheus", metrics.to_prometheus(), file_name="metrics.prom", mime="text/plain")
+        if st.button("重設統計", key="reset_metrics"):
+            metrics.reset()
@@ -0,0 +1,464 @@
+# 效能測試：以本機模擬的 Gemini 伺服器驅動圖片與文字翻譯流程，不消耗真實額度
+#
+# 模擬伺服器位於 genai.GenerativeModel 的位置，真實的 GeminiBackend、模型排程、備用模型切換、
+# 多圖合併、前處理與長文切段流程都照常執行，只有網路請求被替換成可設定的延遲、額度錯誤與安全過濾。
+#
+# 用法範例：
+#   python benchmark.py -o bench.json
+#   python benchmark.py --batch-sizes 1,10 --concurrency 1,8 --quota-rate 0.1 --filter-rate 0.05 -o bench.json
+#   python benchmark.py -o new.json --compare bench.json
+import argparse
+import io
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from PIL import Image, ImageDraw
+
+from translator_core import (
+    FALLBACK_MODELS,
+    BackendRouter,
+    GeminiBackend,
+    GeminiModelPool,
+    ModelScheduler,
+    ProviderRoute,
+    build_prompt_parts,
+    chunk_text,
+    estimate_text_tokens,
+    estimate_tokens,
+    get_instruction_and_settings,
+    translate_image_pack_job,
+    translate_text_chunks,
+)
+
+SAMPLE_SENTENCES = [
+    "오늘은 정말 바쁜 하루였어요.",
+    "내일 다시 연락드릴게요!",
+    "이 아이템은 상점에서 구매할 수 있습니다.",
+    "퀘스트를 완료하면 보상을 받을 수 있어요.",
+    "そろそろ出発しましょうか？",
+    "本日のメンテナンスは午後三時に終了します。",
+    "Please restart the application to apply the update.",
+]
+
+# --- 模擬 Gemini 伺服器 ---
+class FakeCandidate:
+    def __init__(self, finish_reason):
+        self.finish_reason = finish_reason
+
+class FakeChunk:
+    def __init__(self, text):
+        self.text = text
+
+class FakeUsage:
+    def __init__(self, prompt_token_count, candidates_token_count):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.cached_content_token_count = 0
+
+class FakeResponse:
+    def __init__(self, text, finish_reason, pieces=None, usage_metadata=None):
+        self._text = text
+        self.candidates = [FakeCandidate(finish_reason)] if finish_reason is not None else []
+        self.pieces = pieces or []
+        self.usage_metadata = usage_metadata
+
+    @property
+    def text(self):
+        if self._text is None:
+            # 與 SDK 相同：請求整體被攔截時存取 .text 會拋出含 finish_reason 的例外
+            raise ValueError("The `response.text` quick accessor requires a valid `Part`, but none were returned. finish_reason: 3")
+        return self._text
+
+    def __iter__(self):
+        return iter(self.pieces)
+
+class FakeGeminiServer:
+    def __init__(self, latency_median=0.4, latency_sigma=0.4, tokens_per_second=120, quota_rate=0.0,
+                 quota_retry=2, filter_rate=0.0, blocked_rate=0.0, seed=0):
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.tokens_per_second = tokens_per_second
+        self.quota_rate = quota_rate
+        self.quota_retry = quota_retry
+        self.filter_rate = filter_rate
+        self.blocked_rate = blocked_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stats = {"requests": 0, "quota_errors": 0, "filtered": 0, "blocked": 0, "bytes_uploaded": 0}
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.stats[key] += amount
+
+    def sample(self):
+        # 每次請求抽一次：首字延遲（對數常態分佈）與回應類型
+        with self.lock:
+            latency = self.rng.lognormvariate(math.log(self.latency_median), self.latency_sigma)
+            roll = self.rng.random()
+            filter_reason = self.rng.choice([3, 4, 8])
+        if roll < self.quota_rate:
+            return latency, "quota", None
+        if roll < self.quota_rate + self.blocked_rate:
+            return latency, "blocked", None
+        if roll < self.quota_rate + self.blocked_rate + self.filter_rate:
+            return latency, "filtered", filter_reason
+        return latency, "ok", 1
+
+    def model(self, model_name, system_instruction=None):
+        return FakeGenerativeModel(self, model_name, system_instruction)
+
+class FakeGenerativeModel:
+    def __init__(self, server, model_name, system_instruction=None):
+        self.server = server
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+
+    def generate_content(self, contents, safety_settings=None, stream=False):
+        server = self.server
+        # system_instruction 每次請求仍會隨請求送出並計入輸入 Token
+        if self.system_instruction:
+            contents = [self.system_instruction] + list(contents)
+        server.count("requests")
+        server.count("bytes_uploaded", payload_bytes(contents))
+        latency, outcome, finish_reason = server.sample()
+
+        if outcome == "quota":
+            # 額度錯誤通常很快回應
+            time.sleep(latency / 10)
+            server.count("quota_errors")
+            raise Exception(f"429 Resource has been exhausted (e.g. check quota). retry in {server.quota_retry}s")
+
+        time.sleep(latency)
+        if outcome == "blocked":
+            server.count("blocked")
+            return FakeResponse(None, None)
+
+        text = fake_translation(self.model_name, contents)
+        if outcome == "filtered":
+            server.count("filtered")
+            text = text[:len(text) // 2]
+        usage = FakeUsage(estimate_tokens(contents), estimate_text_tokens(text))
+
+        # 依輸出長度模擬生成時間；串流時分段送出
+        pieces = [text[k:k + 40] for k in range(0, len(text), 40)]
+        piece_delay = 40 / 2 / server.tokens_per_second
+        if not stream:
+            time.sleep(piece_delay * len(pieces))
+            return FakeResponse(text, finish_reason, usage_metadata=usage)
+
+        def generate():
+            for piece in pieces:
+                time.sleep(piece_delay)
+                yield FakeChunk(piece)
+        return FakeResponse(text, finish_reason, generate(), usage)
+
+def payload_bytes(contents):
+    total = 0
+    for part in contents:
+        if isinstance(part, str):
+            total += len(part.encode("utf-8"))
+        elif isinstance(part, dict):
+            total += len(part["data"])
+        else:
+            # SDK 會將 PIL 圖片編碼後上傳，這裡以 PNG 計算大小
+            buffer = io.BytesIO()
+            part.save(buffer, format="PNG")
+            total += buffer.tell()
+    return total
+
+def fake_translation(model_name, contents):
+    # 多圖合併請求依「圖片 k：」標籤輸出對應的分隔標記，讓 split_pack_response 正常拆分
+    labels = [part for part in contents if isinstance(part, str) and part.startswith("圖片 ") and part.endswith("：")]
+    if labels:
+        return "\n".join(f"===圖片 {k}===\n〔{model_name}〕第 {k} 張圖片的模擬翻譯。" for k in range(1, len(labels) + 1))
+    if any(not isinstance(part, str) for part in contents):
+        return f"〔{model_name}〕模擬翻譯的第一行。\n模擬翻譯的第二行。\n模擬翻譯的第三行。"
+    return f"〔{model_name}〕" + contents[-1]
+
+# --- 測試資料 ---
+def make_screenshot(size, seed):
+    # 淺色背景加上數行深色文字方塊，讓本機文字偵測與壓縮的行為接近真實截圖
+    rng = random.Random(seed)
+    img = Image.new("RGB", size, (245, 245, 245))
+    draw = ImageDraw.Draw(img)
+    width, height = size
+    line_height = max(12, height // 60)
+    for _ in range(rng.randint(8, 20)):
+        x = rng.randrange(width // 2)
+        y = rng.randrange(height - line_height)
+        for word in range(rng.randint(3, 12)):
+            w = rng.randint(line_height, line_height * 4)
+            draw.rectangle([x, y, x + w, y + line_height - 4], fill=(rng.randint(0, 60),) * 3)
+            x += w + line_height // 2
+    return img
+
+def make_text(chars, seed):
+    rng = random.Random(seed)
+    paragraphs = []
+    length = 0
+    while length < chars:
+        paragraph = " ".join(rng.choice(SAMPLE_SENTENCES) for _ in range(rng.randint(2, 6)))
+        paragraphs.append(paragraph)
+        length += len(paragraph) + 2
+    return "\n\n".join(paragraphs)
+
+def parse_list(text, cast=int):
+    return [cast(item) for item in text.split(",") if item.strip()]
+
+def parse_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+# --- 測試情境 ---
+def make_router(server, pacing, hedge=None):
+    # 每個情境使用全新的排程狀態，避免上一個情境的冷卻影響結果
+    scheduler = ModelScheduler(FALLBACK_MODELS)
+    pool = GeminiModelPool(server.model)
+    route = ProviderRoute("Gemini", scheduler, lambda name: GeminiBackend(name, pool), pool)
+    router = BackendRouter([route])
+    router.set_pacing(pacing)
+    if hedge:
+        router.set_hedging(*hedge)
+    return router
+
+def summarize(name, params, server, router, wall, completions, results):
+    # latency／ttft 為每個請求本身的耗時（取自結果，合併送出的圖片共用同一次請求的值）；
+    # completion 為各項目自情境開始到完成的時間，會包含排隊等待並行名額的時間
+    statuses = {}
+    for result in results:
+        statuses[result["status"]] = statuses.get(result["status"], 0) + 1
+    latencies = [result["latency"] for result in results if result.get("latency") is not None]
+    ttfts = [result["ttft"] for result in results if result.get("ttft") is not None]
+    record = {
+        "name": name,
+        **params,
+        "items": len(completions),
+        "wall_seconds": round(wall, 4),
+        "throughput": round(len(completions) / wall, 4) if wall else None,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+        "ttft_p50": percentile(ttfts, 50),
+        "ttft_p95": percentile(ttfts, 95),
+        "completion_p50": percentile(completions, 50),
+        "completion_p95": percentile(completions, 95),
+        "completion_p99": percentile(completions, 99),
+        "requests": server.stats["requests"],
+        "bytes_uploaded": server.stats["bytes_uploaded"],
+        "quota_errors": server.stats["quota_errors"],
+        # 最終結果不是由第一順位模型產生的項目數，即發生過備用模型切換
+        "fallbacks": sum(1 for result in results if result["model"] and result["model"] != FALLBACK_MODELS[0]),
+        "statuses": statuses,
+    }
+    snap = router.metrics.snapshot()
+    record["hedges"] = snap["counters"].get("hedges", 0)
+    record["hedge_wins"] = snap["counters"].get("hedge_wins", 0)
+    record["prompt_tokens"] = sum(entry["prompt_tokens"] for entry in snap["models"].values())
+    record["output_tokens"] = sum(entry["output_tokens"] for entry in snap["models"].values())
+    # 各階段累計耗時（背景執行緒並行執行，總和可能超過 wall_seconds）
+    record["stage_seconds"] = {stage: round(entry["total_seconds"], 4) for stage, entry in snap["stages"].items()}
+    for key in ["latency_p50", "latency_p95", "latency_p99", "ttft_p50", "ttft_p95", "completion_p50", "completion_p95", "completion_p99"]:
+        if record[key] is not None:
+            record[key] = round(record[key], 4)
+    return record
+
+def run_image_scenario(server, images, concurrency, images_per_request, prep_options, text_options, stream, pacing, hedge=None):
+    server.reset()
+    router = make_router(server, pacing, hedge)
+    base_instruction, safety_settings = get_instruction_and_settings("一般", is_image=True)
+    prompt_parts = build_prompt_parts(base_instruction, "自動偵測")
+    packs = [list(range(k, min(k + images_per_request, len(images)))) for k in range(0, len(images), images_per_request)]
+    on_chunk = (lambda position, partial: None) if stream else None
+
+    completions = []
+    results = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [
+            executor.submit(
+                translate_image_pack_job,
+                [images[i] for i in pack],
+                prompt_parts,
+                safety_settings,
+                router,
+                None,
+                None,
+                prep_options,
+                on_chunk,
+                None,
+                text_options
+            )
+            for pack in packs
+        ]
+        for future in as_completed(futures):
+            finished = time.perf_counter() - start
+            for result in future.result():
+                completions.append(finished)
+                results.append(result)
+    return router, time.perf_counter() - start, completions, results
+
+def run_text_scenario(server, text, concurrency, chunk_tokens, stream, pacing, hedge=None):
+    server.reset()
+    router = make_router(server, pacing, hedge)
+    base_instruction, safety_settings = get_instruction_and_settings("一般", is_image=False)
+    prompt_parts = build_prompt_parts(base_instruction, "自動偵測")
+    chunks = chunk_text(text, chunk_tokens)
+
+    completions = []
+    start = time.perf_counter()
+    results = translate_text_chunks(
+        chunks,
+        prompt_parts,
+        safety_settings,
+        router,
+        max_workers=concurrency,
+        on_partial=(lambda k, partial: None) if stream else None,
+        on_result=lambda k, result: completions.append(time.perf_counter() - start),
+    )
+    return router, time.perf_counter() - start, completions, results
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_comparison(report, baseline_path):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {scenario["name"]: scenario for scenario in json.load(f)["scenarios"]}
+    print(f"\n與 {baseline_path} 比較：", file=sys.stderr)
+    for scenario in report["scenarios"]:
+        old = baseline.get(scenario["name"])
+        if not old or not old["throughput"] or not old.get("latency_p95") or not scenario["latency_p95"]:
+            continue
+        throughput = scenario["throughput"] / old["throughput"] - 1
+        p95 = scenario["latency_p95"] / old["latency_p95"] - 1
+        print(f"  {scenario['name']}：吞吐量 {throughput:+.1%}，p95 延遲 {p95:+.1%}", file=sys.stderr)
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="以本機模擬的 Gemini 伺服器測試翻譯流程的吞吐量與延遲，結果輸出為 JSON。")
+    parser.add_argument("-o", "--output", default="benchmark.json", help="輸出的 JSON 檔案")
+    parser.add_argument("--compare", help="與先前輸出的 JSON 比較吞吐量與 p95 延遲")
+    parser.add_argument("--mode", default="all", choices=["all", "image", "text"])
+    parser.add_argument("--batch-sizes", default="1,4,10", help="每批圖片張數，以逗號分隔")
+    parser.add_argument("--resolutions", default="1080x1920,1440x3200", help="圖片解析度，以逗號分隔")
+    parser.add_argument("--concurrency", default="1,4", help="並行數，以逗號分隔")
+    parser.add_argument("--images-per-request", type=int, default=1)
+    parser.add_argument("--text-lengths", default="2000,8000", help="長文字數，以逗號分隔")
+    parser.add_argument("--chunk-tokens", type=int, default=1000)
+    parser.add_argument("--no-preprocess", action="store_true")
+    parser.add_argument("--no-text-detect", action="store_true")
+    parser.add_argument("--stream", action="store_true", help="以串流模式調用")
+    parser.add_argument("--pacing", action="store_true", help="啟用 RPM/TPM 節流（預設關閉以測量最大吞吐量）")
+    parser.add_argument("--latency-median", type=float, default=0.4, help="首字延遲中位數（秒）")
+    parser.add_argument("--latency-sigma", type=float, default=0.4, help="首字延遲對數常態分佈的 sigma")
+    parser.add_argument("--tokens-per-second", type=float, default=120)
+    parser.add_argument("--quota-rate", type=float, default=0.0, help="回應 429 額度錯誤的機率")
+    parser.add_argument("--quota-retry", type=float, default=2, help="額度錯誤建議的重試秒數")
+    parser.add_argument("--filter-rate", type=float, default=0.0, help="回應 finish_reason 3/4/8（安全過濾）的機率")
+    parser.add_argument("--blocked-rate", type=float, default=0.0, help="整個請求被攔截的機率")
+    parser.add_argument("--hedge", type=int, default=0, help="對沖請求的觸發百分位（如 90），0 為停用")
+    parser.add_argument("--hedge-budget", type=int, default=10, help="對沖額外請求占總請求數的上限 (%%)")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    server = FakeGeminiServer(
+        latency_median=args.latency_median,
+        latency_sigma=args.latency_sigma,
+        tokens_per_second=args.tokens_per_second,
+        quota_rate=args.quota_rate,
+        quota_retry=args.quota_retry,
+        filter_rate=args.filter_rate,
+        blocked_rate=args.blocked_rate,
+        seed=args.seed,
+    )
+    prep_options = None
+    if not args.no_preprocess:
+        prep_options = {"max_edge": 2048, "grayscale": False, "fmt": "JPEG", "quality": 85}
+    text_options = None if args.no_text_detect else {"padding": 32}
+    hedge = (args.hedge / 100, args.hedge_budget / 100) if args.hedge > 0 else None
+
+    scenarios = []
+    def report(record):
+        scenarios.append(record)
+        def seconds(value):
+            return f"{value:.2f} 秒" if value is not None else "-"
+        print(
+            f"{record['name']}：{record['throughput']:.2f} 項/秒，請求延遲 p50 {seconds(record['latency_p50'])}、"
+            f"p95 {seconds(record['latency_p95'])}，完成時間 p95 {seconds(record['completion_p95'])}，"
+            f"請求 {record['requests']} 次，額度錯誤 {record['quota_errors']} 次",
+            file=sys.stderr
+        )
+
+    if args.mode in ["all", "image"]:
+        for resolution in parse_list(args.resolutions, parse_size):
+            pool = [make_screenshot(resolution, args.seed + k) for k in range(max(parse_list(args.batch_sizes)))]
+            for batch in parse_list(args.batch_sizes):
+                for concurrency in parse_list(args.concurrency):
+                    router, wall, completions, results = run_image_scenario(
+                        server, pool[:batch], concurrency, args.images_per_request,
+                        prep_options, text_options, args.stream, args.pacing, hedge
+                    )
+                    params = {
+                        "kind": "image",
+                        "batch": batch,
+                        "resolution": f"{resolution[0]}x{resolution[1]}",
+                        "concurrency": concurrency,
+                        "images_per_request": args.images_per_request,
+                    }
+                    name = f"image/{params['resolution']}/b{batch}/c{concurrency}/p{args.images_per_request}"
+                    report(summarize(name, params, server, router, wall, completions, results))
+
+    if args.mode in ["all", "text"]:
+        for length in parse_list(args.text_lengths):
+            text = make_text(length, args.seed)
+            for concurrency in parse_list(args.concurrency):
+                router, wall, completions, results = run_text_scenario(
+                    server, text, concurrency, args.chunk_tokens, args.stream, args.pacing, hedge
+                )
+                params = {"kind": "text", "chars": len(text), "concurrency": concurrency, "chunk_tokens": args.chunk_tokens}
+                name = f"text/{length}/c{concurrency}/t{args.chunk_tokens}"
+                report(summarize(name, params, server, router, wall, completions, results))
+
+    result = {
+        "commit": git_commit(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            key: value for key, value in vars(args).items() if key not in ["output", "compare"]
+        },
+        "scenarios": scenarios,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"已寫入 {args.output}", file=sys.stderr)
+
+    if args.compare:
+        print_comparison(result, args.compare)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
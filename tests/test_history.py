@@ -0,0 +1,58 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from translator_core import TranslationHistory, join_ocr_response, split_ocr_response, with_ocr_source
+
+class SplitOcrResponseTest(unittest.TestCase):
+    def test_source_and_translation_are_separated(self):
+        text = "===原文===\nこんにちは\n世界\n===譯文===\n你好\n世界"
+        self.assertEqual(split_ocr_response(text), ("こんにちは\n世界", "你好\n世界"))
+        self.assertEqual(split_ocr_response(join_ocr_response(*split_ocr_response(text))), ("こんにちは\n世界", "你好\n世界"))
+
+    def test_response_without_markers_is_translation(self):
+        self.assertEqual(split_ocr_response(" 你好 "), ("", "你好"))
+        self.assertEqual(join_ocr_response("", "你好"), "你好")
+
+    def test_partial_stream_hides_source(self):
+        self.assertEqual(split_ocr_response("===原文===\nこんに"), ("こんに", ""))
+
+    def test_result_keeps_other_fields(self):
+        result = with_ocr_source({"status": "ok", "text": "===原文===\nA\n===譯文===\n甲", "model": "m"})
+        self.assertEqual((result["source"], result["text"], result["model"]), ("A", "甲", "m"))
+
+class TranslationHistoryOwnerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "history.sqlite3")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_entries_are_separated_by_owner(self):
+        history = TranslationHistory(self.path)
+        history.add("alice", "key", "image", "a.png", "譯文甲", "m", "一般", "日文", source="原文甲")
+        history.add("bob", "key", "image", "a.png", "譯文乙", "m", "一般", "日文")
+        entries, total = history.search("alice", "原文甲")
+        self.assertEqual((total, entries[0]["text"]), (1, "譯文甲"))
+        self.assertEqual(history.search("bob", "原文甲")[1], 0)
+        
+        history.clear("alice")
+        self.assertEqual((history.size("alice"), history.size("bob")), (0, 1))
+
+    def test_existing_database_gains_owner_column(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute(
+            "CREATE TABLE history (id INTEGER PRIMARY KEY, entry_key TEXT UNIQUE, kind TEXT, name TEXT, image_hash TEXT, "
+            "source TEXT, text TEXT, model TEXT, context TEXT, source_lang TEXT, created_at REAL)"
+        )
+        conn.execute("INSERT INTO history (entry_key, text, created_at) VALUES ('old', '舊紀錄', 0)")
+        conn.commit()
+        conn.close()
+        history = TranslationHistory(self.path)
+        history.add("alice", "key", "text", None, "譯文", "m", "一般", "日文", source="原文")
+        self.assertEqual(history.size("alice"), 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,16 @@
+import unittest
+
+from translator_core import TranslationJob
+
+class TranslationJobTest(unittest.TestCase):
+    def test_tasks_added_after_cancel_are_dropped(self):
+        job = TranslationJob("job", total=1)
+        job.add_task(lambda: None)
+        job.cancel()
+        job.add_task(lambda: None)
+        self.assertEqual(len(job.pending), 0)
+        self.assertEqual(job._next_tasks(), [])
+        self.assertTrue(job.done())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+
+from translator_core import adapt_numbers, estimate_text_tokens, join_chunk_texts, parse_segment_response, split_segments
+
+class ParseSegmentResponseTest(unittest.TestCase):
+    def test_each_marker_keeps_text_until_next_marker(self):
+        text = "【1】第一行\n【2】第二行的上半\n第二行的下半\n【3】第三行"
+        self.assertEqual(parse_segment_response(text, 3), {1: "第一行", 2: "第二行的上半\n第二行的下半", 3: "第三行"})
+
+    def test_missing_empty_and_out_of_range_markers_are_left_out(self):
+        text = "【1】 甲\n【2】\n【5】多出來的\n【1】重複"
+        self.assertEqual(parse_segment_response(text, 3), {1: "甲"})
+
+    def test_single_line_without_marker_uses_whole_response(self):
+        self.assertEqual(parse_segment_response("  只有一行  ", 1), {1: "只有一行"})
+        self.assertEqual(parse_segment_response("沒有編號", 2), {})
+
+class AdaptNumbersTest(unittest.TestCase):
+    def test_same_numbers_keep_translation(self):
+        self.assertEqual(adapt_numbers("獲得 100 金幣", "獲得 100 金幣", "Got 100 gold"), "Got 100 gold")
+
+    def test_changed_numbers_are_replaced_in_order(self):
+        self.assertEqual(adapt_numbers("Lv 5 → 1,200 EXP", "Lv 3 → 800 EXP", "等級 3 → 800 經驗"), "等級 5 → 1,200 經驗")
+
+    def test_unmatched_numbers_return_none(self):
+        self.assertIsNone(adapt_numbers("獲得 200 金幣", "獲得 100 金幣", "得到一百金幣"))
+        self.assertIsNone(adapt_numbers("1 2", "1", "1"))
+
+class SplitSegmentsTest(unittest.TestCase):
+    def test_lines_and_blank_lines_round_trip(self):
+        text = "第一行\n第二行\n\n第三行"
+        segments = split_segments(text)
+        self.assertEqual([segment for segment, _ in segments], ["第一行", "第二行", "第三行"])
+        self.assertEqual(join_chunk_texts(segments, [segment for segment, _ in segments]), text)
+
+    def test_over_budget_line_is_split_within_budget(self):
+        line = "這是一個很長的句子，用來測試切分。" * 20
+        segments = split_segments("標題\n" + line, max_tokens=50)
+        self.assertGreater(len(segments), 2)
+        self.assertTrue(all(estimate_text_tokens(segment) <= 50 for segment, _ in segments))
+        self.assertEqual(join_chunk_texts(segments, [segment for segment, _ in segments]), "標題\n" + line)
+
+    def test_english_pieces_rejoin_with_spaces(self):
+        line = " ".join(f"Sentence number {k} is here." for k in range(40))
+        segments = split_segments(line, max_tokens=30)
+        self.assertGreater(len(segments), 1)
+        self.assertEqual(join_chunk_texts(segments, [segment for segment, _ in segments]), line)
+
+if __name__ == "__main__":
+    unittest.main()
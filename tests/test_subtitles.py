@@ -0,0 +1,39 @@
+import unittest
+from unittest import mock
+
+from PIL import Image, ImageDraw
+
+import translator_core
+from translator_core import detect_subtitle_changes
+
+def make_frame(with_text):
+    # 字幕區域在畫面下方；有字幕的影格畫上一排類似文字筆畫的短線
+    frame = Image.new("RGB", (640, 360), (90, 90, 90))
+    if with_text:
+        draw = ImageDraw.Draw(frame)
+        for x in range(120, 520, 12):
+            draw.rectangle([x, 300, x + 5, 330], fill=(255, 255, 255))
+    return frame
+
+def make_frames(pattern, interval=0.5):
+    return [(k * interval, make_frame(with_text)) for k, with_text in enumerate(pattern)]
+
+class DetectSubtitleChangesTest(unittest.TestCase):
+    def test_line_repeated_three_times_reuses_first_segment(self):
+        frames = make_frames([True, False, True, False, True])
+        segments = detect_subtitle_changes(frames, threshold=6, interval=0.5)
+        self.assertEqual([segment["same_as"] for segment in segments], [None, 0, 0])
+
+    def test_repeat_closest_to_a_duplicate_points_at_original(self):
+        # 第三次出現的字幕與第二次最接近：same_as 仍須指向實際送出翻譯的片段，否則該句永遠沒有結果
+        hashes = iter([0b0, 0b11, 0b111])
+        frames = make_frames([True, False, True, False, True])
+        with mock.patch.object(translator_core, "dhash", lambda img: next(hashes)):
+            segments = detect_subtitle_changes(frames, threshold=3, interval=0.5)
+        self.assertEqual([segment["same_as"] for segment in segments], [None, 0, 0])
+        for segment in segments:
+            if segment["same_as"] is not None:
+                self.assertIsNone(segments[segment["same_as"]]["same_as"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,22 @@
+import unittest
+
+from translator_core import needs_tiling, stitch_tile_texts
+
+class NeedsTilingTest(unittest.TestCase):
+    def test_phone_screenshots_are_sent_whole(self):
+        for size in [(1290, 2796), (1440, 3200), (1080, 2400)]:
+            self.assertFalse(needs_tiling(size, 2400, 200), size)
+
+    def test_long_screenshots_are_tiled(self):
+        for size in [(1080, 8000), (800, 12000)]:
+            self.assertTrue(needs_tiling(size, 2400, 200), size)
+
+    def test_short_images_are_never_tiled(self):
+        self.assertFalse(needs_tiling((200, 2000), 2400, 200))
+
+class StitchTileTextsTest(unittest.TestCase):
+    def test_overlapping_lines_are_removed(self):
+        self.assertEqual(stitch_tile_texts(["第一行\n第二行", "第二行！\n第三行"]), "第一行\n第二行\n第三行")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,259 @@
+# 命令列批次翻譯：將整個資料夾（或 glob）的截圖翻譯後逐行寫入 JSONL，中斷後可從上次完成處續跑
+#
+# 用法範例：
+#   python translate_cli.py screenshots/ -o results.jsonl --context 遊戲截圖 --concurrency 8
+#   python translate_cli.py "captures/**/*.png" -o results.jsonl --images-per-request 4
+#   python translate_cli.py screenshots/ -o results.jsonl --watch    # 持續監看資料夾，新截圖寫入完成後自動翻譯
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from PIL import Image
+
+from translator_core import (
+    CACHE_DB_PATH,
+    FALLBACK_MODELS,
+    FINISHED_STATUSES,
+    IMAGE_EXTENSIONS,
+    FolderWatch,
+    ModelScheduler,
+    TranslationCache,
+    build_prompt_parts,
+    cached_image_result,
+    create_router,
+    get_instruction_and_settings,
+    make_cache_id,
+    needs_tiling,
+    parse_provider_specs,
+    result_record,
+    translate_image_file,
+    translate_image_pack_job,
+)
+
+def collect_files(target):
+    if os.path.isdir(target):
+        paths = []
+        for root, _, names in os.walk(target):
+            paths += [os.path.join(root, name) for name in names if name.lower().endswith(IMAGE_EXTENSIONS)]
+    else:
+        paths = [path for path in glob.glob(target, recursive=True) if path.lower().endswith(IMAGE_EXTENSIONS)]
+    return sorted(os.path.normpath(path) for path in paths)
+
+def load_finished(output_path):
+    finished = set()
+    if not os.path.exists(output_path):
+        return finished
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # 中斷時可能留下寫到一半的最後一行，直接略過
+                continue
+            if record.get("status") in FINISHED_STATUSES:
+                finished.add(record["file"])
+    return finished
+
+def load_image(path):
+    img = Image.open(path)
+    img.load()
+    return img
+
+def is_tall(path, tile_options):
+    # 只讀取檔頭判斷尺寸，不解碼整張圖片
+    with Image.open(path) as img:
+        return needs_tiling(img.size, tile_options["tile_height"], tile_options["overlap"])
+
+def translate_files(paths, prompt_parts, safety_settings, router, cache, cache_ids, prep_options, tile_options, text_options, tile_workers):
+    # 在背景執行緒中才解碼圖片，避免一次把整個資料夾載入記憶體
+    images = [load_image(path) for path in paths]
+    return translate_image_pack_job(
+        images, prompt_parts, safety_settings, router, cache, cache_ids, prep_options, None, tile_options, text_options, tile_workers
+    )
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="批次翻譯資料夾中的截圖，結果以 JSONL 逐行輸出。")
+    parser.add_argument("target", help="截圖資料夾，或 glob 樣式（如 \"shots/**/*.png\"）")
+    parser.add_argument("-o", "--output", default="results.jsonl", help="輸出的 JSONL 檔案（已存在時會續寫並略過已完成的檔案）")
+    parser.add_argument("--api-key", default=os.environ.get("GEMINI_API_KEY"), help="Gemini API 金鑰，預設讀取環境變數 GEMINI_API_KEY")
+    parser.add_argument("--provider", action="append", default=[], help="額外的 litellm 模型，格式同網頁版：模型 | API Base | 金鑰，可重複指定")
+    parser.add_argument("--source-lang", default="自動偵測", choices=["自動偵測", "韓文", "日文", "英文", "簡體中文"])
+    parser.add_argument("--context", default="一般", choices=["一般", "小說/網文", "遊戲截圖", "技術文件"])
+    parser.add_argument("--concurrency", type=int, default=4, help="同時進行的請求數")
+    parser.add_argument("--images-per-request", type=int, default=1, help="每次請求合併的圖片數")
+    parser.add_argument("--no-pacing", action="store_true", help="停用 RPM/TPM 自動節流")
+    parser.add_argument("--no-cache", action="store_true", help="停用翻譯快取")
+    parser.add_argument("--no-preprocess", action="store_true", help="直接送出原始圖片")
+    parser.add_argument("--max-edge", type=int, default=2048)
+    parser.add_argument("--grayscale", action="store_true")
+    parser.add_argument("--format", default="JPEG", choices=["JPEG", "WEBP"])
+    parser.add_argument("--quality", type=int, default=85)
+    parser.add_argument("--tile-height", type=int, default=2400, help="高度超過此值且超過寬度 3 倍的長截圖會切塊翻譯，設為 0 停用")
+    parser.add_argument("--tile-overlap", type=int, default=200)
+    parser.add_argument("--hedge", type=int, default=0, help="對沖請求的觸發百分位（如 90），請求超過該模型近期延遲的此百分位仍未回應時另送備用模型；0 為停用")
+    parser.add_argument("--hedge-budget", type=int, default=10, help="對沖額外請求占總請求數的上限 (%%)")
+    parser.add_argument("--metrics", help="結束時將各階段耗時與 Token 用量寫入此檔案（副檔名 .prom 為 Prometheus 格式，其餘為 JSON）")
+    parser.add_argument("--watch", action="store_true", help="翻譯完既有檔案後持續監看資料夾，新增或修改的截圖寫入完成後自動翻譯（Ctrl+C 結束）")
+    parser.add_argument("--no-text-detect", action="store_true", help="停用本機文字區域偵測（不略過無字圖片、不裁切）")
+    parser.add_argument("--text-padding", type=int, default=32, help="裁切文字範圍時保留的外圍留白 (px)")
+    return parser
+
+def watch_folder(args, translate, router):
+    def report(record):
+        print(f"[{time.strftime('%H:%M:%S')}] {record['status']}：{record['file']}", file=sys.stderr)
+
+    watch = FolderWatch(args.target, args.output, translate, args.concurrency, on_record=report)
+    watch.start()
+    print(f"👀 監看 {args.target}（{watch.mode()}），紀錄中已完成 {watch.stats['restored']} 張；按 Ctrl+C 結束。", file=sys.stderr)
+    try:
+        while watch.running():
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watch.stop()
+        if args.metrics:
+            write_metrics(args.metrics, router)
+    return 0
+
+def write_metrics(path, router):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(router.metrics.to_prometheus() if path.endswith(".prom") else router.metrics.to_json())
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    provider_specs = parse_provider_specs("\n".join(args.provider))
+    if not args.api_key and not provider_specs:
+        print("❌ 請以 --api-key 或環境變數 GEMINI_API_KEY 提供 Gemini API 金鑰。", file=sys.stderr)
+        return 2
+    if args.watch and not os.path.isdir(args.target):
+        print("❌ --watch 只能監看資料夾。", file=sys.stderr)
+        return 2
+
+    pending = []
+    if not args.watch:
+        paths = collect_files(args.target)
+        finished = load_finished(args.output)
+        pending = [path for path in paths if path not in finished]
+        print(f"共 {len(paths)} 張截圖，已完成 {len(paths) - len(pending)} 張，本次處理 {len(pending)} 張。", file=sys.stderr)
+        if not pending:
+            return 0
+
+    router = create_router(ModelScheduler(FALLBACK_MODELS) if args.api_key else None, provider_specs, args.api_key)
+    router.set_pacing(not args.no_pacing)
+    router.set_hedging(args.hedge / 100 if args.hedge > 0 else None, args.hedge_budget / 100)
+    cache = None if args.no_cache else TranslationCache(CACHE_DB_PATH)
+
+    base_instruction, safety_settings = get_instruction_and_settings(args.context, is_image=True)
+    prompt_parts = build_prompt_parts(base_instruction, args.source_lang)
+    prep_options = None
+    if not args.no_preprocess:
+        prep_options = {
+            "max_edge": args.max_edge,
+            "grayscale": args.grayscale,
+            "fmt": args.format,
+            "quality": args.quality,
+        }
+
+    tile_options = None
+    if args.tile_height > 0:
+        tile_options = {"tile_height": args.tile_height, "overlap": args.tile_overlap}
+    # 並行數只影響速度，不列入快取鍵，另外傳入
+    tile_workers = max(1, args.concurrency)
+
+    text_options = None if args.no_text_detect else {"padding": args.text_padding}
+
+    if args.watch:
+        # 監看模式：既有與之後新增的檔案都由 FolderWatch 處理，紀錄中已完成且未被修改的檔案會略過
+        def translate(path, data):
+            cache_id = None
+            if cache is not None:
+                cache_id = make_cache_id(data, args.source_lang, args.context, base_instruction, repr((prep_options, tile_options, text_options)))
+            return translate_image_file(
+                data, prompt_parts, safety_settings, router, cache, cache_id, prep_options, tile_options, text_options, tile_workers
+            )
+
+        return watch_folder(args, translate, router)
+
+    done = 0
+    exhausted = False
+    with open(args.output, "a", encoding="utf-8") as out:
+        def write(path, result):
+            nonlocal done
+            done += 1
+            # 一併記錄檔案大小與修改時間，之後以 --watch 監看同一個資料夾時不會重複翻譯
+            stat = os.stat(path)
+            record = dict(result_record(path, result), size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            print(f"[{done}/{len(pending)}] {result['status']}：{path}", file=sys.stderr)
+
+        # 快取命中的檔案直接寫出，其餘依每次請求圖片數分組送出
+        to_send = []
+        cache_ids = {}
+        for path in pending:
+            if cache is not None:
+                with open(path, "rb") as f:
+                    cache_ids[path] = make_cache_id(
+                        f.read(), args.source_lang, args.context, base_instruction, repr((prep_options, tile_options, text_options))
+                    )
+                result = cached_image_result(cache, cache_ids[path], router.model_names())
+                if result:
+                    write(path, result)
+                    continue
+            to_send.append(path)
+
+        # 需要切塊的長截圖不與其他圖片合併
+        tall = [path for path in to_send if tile_options and is_tall(path, tile_options)]
+        to_send = [path for path in to_send if path not in tall]
+        size = max(1, args.images_per_request)
+        packs = [to_send[k:k + size] for k in range(0, len(to_send), size)] + [[path] for path in tall]
+        executor = ThreadPoolExecutor(max_workers=max(1, args.concurrency))
+        try:
+            futures = {
+                executor.submit(
+                    translate_files,
+                    pack,
+                    prompt_parts,
+                    safety_settings,
+                    router,
+                    cache,
+                    [cache_ids.get(path) for path in pack],
+                    prep_options,
+                    tile_options,
+                    text_options,
+                    tile_workers
+                ): pack
+                for pack in packs
+            }
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+                pack = futures[future]
+                try:
+                    results = future.result()
+                except Exception as e:
+                    # 例如檔案損毀無法解碼；記錄為錯誤，續跑時會再試一次
+                    results = [{"status": "error", "text": None, "model": None, "error": str(e)}] * len(pack)
+                for path, result in zip(pack, results):
+                    write(path, result)
+                    if result["status"] == "exhausted" and not exhausted:
+                        # 取消尚未開始的請求，已在進行中的仍會完成並寫出，避免浪費已付費的結果
+                        exhausted = True
+                        print("❌ 所有備用模型的額度均已耗盡，停止送出剩餘檔案；稍後重新執行即可續跑。", file=sys.stderr)
+                        for pending_future in futures:
+                            pending_future.cancel()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    if args.metrics:
+        write_metrics(args.metrics, router)
+
+    return 1 if exhausted else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,2613 @@
+# 截圖翻譯核心邏輯：不依賴 Streamlit，供 APP.py 網頁介面與 translate_cli.py 命令列工具共用
+import google.generativeai as genai
+import google.ai.generativelanguage as glm
+from google.generativeai.types import HarmCategory, HarmBlockThreshold
+from PIL import Image
+import io
+import re
+import numpy as np
+import threading
+import queue
+import base64
+import hashlib
+import importlib.util
+import datetime
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from difflib import SequenceMatcher
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+# --- 共用：初始化指令與安全設定 ---
+# 圖片回應中原文與譯文的分隔標記；與多圖合併請求的「===圖片 k===」標記格式相同但不會互相混淆
+OCR_SOURCE_MARKER = "===原文==="
+OCR_TEXT_MARKER = "===譯文==="
+OCR_MARKER_RE = re.compile(r"={2,}\s*(原文|譯文)\s*={2,}")
+
+def split_ocr_response(text):
+    # 回傳 (原文, 譯文)；沒有譯文標記時（舊快取或模型未依格式輸出）整段視為譯文
+    # 串流中只收到原文時譯文為空字串，畫面不會先顯示原文
+    matches = list(OCR_MARKER_RE.finditer(text or ""))
+    sections = {}
+    for n, match in enumerate(matches):
+        end = matches[n + 1].start() if n + 1 < len(matches) else len(text)
+        sections.setdefault(match.group(1), text[match.end():end].strip())
+    if not matches:
+        return "", (text or "").strip()
+    return sections.get("原文", ""), sections.get("譯文", "")
+
+def join_ocr_response(source, text):
+    return f"{OCR_SOURCE_MARKER}\n{source}\n{OCR_TEXT_MARKER}\n{text}" if source else text
+
+def with_ocr_source(result):
+    # 將圖片回應拆成 text（譯文）與 source（辨識出的原文）；快取中保存的仍是完整回應
+    if not result.get("text"):
+        return result
+    source, text = split_ocr_response(result["text"])
+    return dict(result, text=text, source=source)
+
+def ocr_stream(on_chunk):
+    # 串流時只回呼目前累積的譯文部分
+    if on_chunk is None:
+        return None
+    return lambda partial: on_chunk(split_ocr_response(partial)[1])
+
+def get_instruction_and_settings(context, is_image=True):
+    safety_settings = {
+        HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
+        HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
+        HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
+        HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
+    }
+    
+    if is_image:
+        base_instruction = "你是一個專業的翻譯專家。請先辨識圖片中的文字（OCR），然後將其翻譯成「繁體中文（台灣）」。\n"
+        # 同時取回辨識出的原文（存入翻譯紀錄供搜尋），由 split_ocr_response 拆開，畫面只顯示譯文
+        base_instruction += (
+            f"輸出格式：先單獨輸出一行「{OCR_SOURCE_MARKER}」，接著是辨識出的原文；再單獨輸出一行「{OCR_TEXT_MARKER}」，"
+            "接著是翻譯後的純文字。不要包含任何開場白或解釋。請僅翻譯當前提供的內容，避免回顧過去的對話。\n"
+        )
+    else:
+        base_instruction = "你是一個專業的翻譯專家。請將以下文字翻譯成「繁體中文（台灣）」。\n"
+        base_instruction += "輸出格式：僅輸出翻譯後的純文字，不要包含任何開場白或解釋。請僅翻譯當前提供的內容，避免回顧過去的對話。\n"
+    
+    if context == "小說/網文":
+        base_instruction += "語境：小說。請保持角色對話語氣，使用台灣繁體中文用語，確保流暢且符合文學感。"
+    elif context == "遊戲截圖":
+        base_instruction += "語境：遊戲。請注意遊戲術語一致性，翻譯應簡潔有力。"
+    elif context == "技術文件":
+        base_instruction += "語境：技術。確保專有名詞準確，語氣正式嚴謹。"
+    else:
+        base_instruction += "語境：一般。提供準確自然的翻譯。"
+        
+    return base_instruction, safety_settings
+
+class SystemText(str):
+    # 標記固定的系統指令：後端會改以 system_instruction（或 system 訊息）送出，而不是附在請求內容中
+    pass
+
+def build_prompt_parts(base_instruction, source_lang):
+    return [SystemText(base_instruction), SystemText(f"來源語言：{source_lang}")]
+
+def split_system(contents):
+    system = "\n".join(part for part in contents if isinstance(part, SystemText))
+    return system or None, [part for part in contents if not isinstance(part, SystemText)]
+
+# 定義動態切換的模型清單 (加入容錯命名組合)
+FALLBACK_MODELS = [
+    'gemini-3-flash-preview',         
+    'gemini-3.1-pro-preview',
+    'gemini-3.1-flash-lite-preview',
+    'gemini-2.5-flash',          
+    'gemini-2.5-pro',    
+    'gemini-2.0-flash',             
+    'gemini-2.0-flash-lite'            
+]
+
+# --- 共用：圖片前處理（縮圖、灰階、重新編碼並去除透明度與中繼資料） ---
+def flatten_alpha(img):
+    # 將透明背景合成到白底，JPEG 不支援 alpha，也能避免文字落在黑色背景上
+    if img.mode not in ("RGBA", "LA", "P"):
+        return img
+    rgba = img.convert("RGBA")
+    out = Image.new("RGB", rgba.size, (255, 255, 255))
+    out.paste(rgba, mask=rgba.split()[-1])
+    return out
+
+def preprocess_image(img, max_edge=2048, grayscale=False, fmt="JPEG", quality=85):
+    start = time.perf_counter()
+    out = flatten_alpha(img)
+    
+    if max(out.size) > max_edge:
+        out = out.copy()
+        out.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    
+    out = out.convert("L") if grayscale else out.convert("RGB")
+    
+    # 未傳入 exif / icc_profile，重新編碼後的檔案不會帶有原始中繼資料
+    buffer = io.BytesIO()
+    out.save(buffer, format=fmt, quality=quality)
+    data = buffer.getvalue()
+    
+    stats = {
+        "original_size": img.size,
+        "sent_size": out.size,
+        "sent_bytes": len(data),
+        "elapsed_ms": (time.perf_counter() - start) * 1000,
+    }
+    return {"mime_type": f"image/{fmt.lower()}", "data": data}, stats
+
+def format_bytes(num):
+    if num >= 1024 * 1024:
+        return f"{num / 1024 / 1024:.1f} MB"
+    return f"{num / 1024:.0f} KB"
+
+# --- 共用：大量上傳的低記憶體處理（逐張解碼，介面只顯示壓縮縮圖） ---
+THUMBNAIL_WIDTH = 480
+THUMBNAIL_MAX_HEIGHT = 4800
+THUMBNAIL_QUALITY = 70
+
+def load_image(data):
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    return img
+
+def scan_image(data, with_hash=False):
+    # 只解碼產生縮圖與雜湊所需的解析度（JPEG 以 draft 直接在解碼時縮小），離開時即釋放像素
+    with Image.open(io.BytesIO(data)) as img:
+        size = img.size
+        img.draft("RGB", (THUMBNAIL_WIDTH, THUMBNAIL_WIDTH))
+        small = flatten_alpha(img).convert("RGB")
+        image_hash = dhash(small) if with_hash else None
+        thumbnail = make_thumbnail(small)
+    return {"size": size, "hash": image_hash, "thumbnail": thumbnail}
+
+def make_thumbnail(img, width=THUMBNAIL_WIDTH, max_height=THUMBNAIL_MAX_HEIGHT):
+    # 回傳供畫面顯示的壓縮 JPEG 縮圖
+    small = img.convert("RGB")
+    small.thumbnail((width, max_height), Image.LANCZOS)
+    buffer = io.BytesIO()
+    small.save(buffer, format="JPEG", quality=THUMBNAIL_QUALITY)
+    return buffer.getvalue()
+
+# --- 共用：本機文字區域偵測（略過沒有文字的圖片，並裁切到文字範圍） ---
+# 依寬度縮放：長截圖若依長邊縮小，字會小到無法與雜訊區分
+TEXT_DETECT_WIDTH = 720
+TEXT_BLOCK_SIZE = 16
+# 相鄰像素亮度差超過此值視為邊緣；區塊內邊緣像素比例超過下限視為可能含有文字
+TEXT_EDGE_THRESHOLD = 32
+TEXT_MIN_EDGE_DENSITY = 0.04
+
+def detect_text_box(img, padding=32, edge_threshold=TEXT_EDGE_THRESHOLD, min_density=TEXT_MIN_EDGE_DENSITY):
+    # 在縮小的灰階副本上計算各區塊的邊緣密度，文字筆畫會形成密集的高對比邊緣
+    # 回傳原圖座標的文字範圍 (left, top, right, bottom)；確定沒有文字時回傳 None，
+    # 有邊緣但無法判斷是否為文字時回傳整張圖片的範圍，寧可送出也不略過
+    width, height = img.size
+    scale = min(1.0, TEXT_DETECT_WIDTH / width)
+    small = img.convert("L").resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.BOX)
+    pixels = np.asarray(small, dtype=np.int16)
+    
+    edges = np.zeros(pixels.shape, dtype=bool)
+    edges[:, 1:] |= np.abs(np.diff(pixels, axis=1)) >= edge_threshold
+    edges[1:, :] |= np.abs(np.diff(pixels, axis=0)) >= edge_threshold
+    
+    size = TEXT_BLOCK_SIZE
+    rows, cols = -(-pixels.shape[0] // size), -(-pixels.shape[1] // size)
+    grid = np.zeros((rows * size, cols * size), dtype=bool)
+    grid[:pixels.shape[0], :pixels.shape[1]] = edges
+    blocks = grid.reshape(rows, size, cols, size).mean(axis=(1, 3)) >= min_density
+    if not blocks.any():
+        return None
+    
+    # 文字行會延伸到相鄰區塊，孤立的單一區塊多半是雜訊或小圖示；只剩孤立區塊時無法確定，送出整張圖片
+    padded = np.pad(blocks, 1)
+    neighbours = sum(
+        padded[1 + dy:1 + dy + rows, 1 + dx:1 + dx + cols]
+        for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dy or dx
+    )
+    blocks &= neighbours > 0
+    if not blocks.any():
+        return (0, 0, width, height)
+    
+    ys, xs = np.nonzero(blocks)
+    fx, fy = width / small.size[0], height / small.size[1]
+    return (
+        max(0, int(xs.min() * size * fx) - padding),
+        max(0, int(ys.min() * size * fy) - padding),
+        min(width, int(np.ceil((xs.max() + 1) * size * fx)) + padding),
+        min(height, int(np.ceil((ys.max() + 1) * size * fy)) + padding),
+    )
+
+def crop_to_text(img, padding=32):
+    # 回傳 (裁切後的圖片, 統計)；沒有偵測到文字時圖片為 None，呼叫端應略過 API 調用
+    start = time.perf_counter()
+    box = detect_text_box(img, padding)
+    cropped = None
+    if box is not None:
+        cropped = img if box == (0, 0) + img.size else img.crop(box)
+    stats = {
+        "original_size": img.size,
+        "box": box,
+        "elapsed_ms": (time.perf_counter() - start) * 1000,
+    }
+    return cropped, stats
+
+def no_text_result(region):
+    return {
+        "status": "no_text", "text": "", "model": None, "error": None, "notices": [], "cached": False,
+        "preprocess": None, "text_region": region,
+    }
+
+# --- 共用：感知雜湊 (dHash) 相似截圖偵測 ---
+def dhash(img, hash_size=8):
+    # 縮成 (hash_size+1) x hash_size 灰階縮圖，比較左右相鄰像素的明暗得到 64 位元雜湊
+    small = img.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+def hamming_distance(a, b):
+    return (a ^ b).bit_count()
+
+def find_similar(target_hash, candidates, threshold):
+    # candidates 為 (hash, value) 列表，回傳距離最近且不超過門檻的 value
+    best = None
+    best_distance = threshold + 1
+    for candidate_hash, value in candidates:
+        distance = hamming_distance(target_hash, candidate_hash)
+        if distance < best_distance:
+            best, best_distance = value, distance
+    return best
+
+# --- 共用：翻譯快取（記憶體 LRU + SQLite 持久層） ---
+CACHE_DB_PATH = "translation_cache.sqlite3"
+
+class TranslationCache:
+    def __init__(self, db_path, max_memory_items=256, max_disk_items=5000, ttl_seconds=7 * 24 * 3600):
+        self.max_memory_items = max_memory_items
+        self.max_disk_items = max_disk_items
+        self.ttl_seconds = ttl_seconds
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS translations ("
+            "key TEXT PRIMARY KEY, model TEXT, text TEXT, created_at REAL, accessed_at REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_translations_accessed ON translations (accessed_at)")
+        self.conn.commit()
+
+    def lookup(self, keys):
+        # 依序嘗試多個鍵（例如各備用模型），第一個命中即回傳 (model, text)；整次查詢只計一次命中或未命中
+        now = time.time()
+        with self.lock:
+            for key in keys:
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return self.memory[key]
+            
+            for key in keys:
+                row = self.conn.execute(
+                    "SELECT model, text, created_at FROM translations WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    continue
+                if now - row[2] > self.ttl_seconds:
+                    self.conn.execute("DELETE FROM translations WHERE key = ?", (key,))
+                    self.conn.commit()
+                    continue
+                self.conn.execute("UPDATE translations SET accessed_at = ? WHERE key = ?", (now, key))
+                self.conn.commit()
+                self._remember(key, (row[0], row[1]))
+                self.stats["disk_hits"] += 1
+                return row[0], row[1]
+            
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, key, model, text):
+        now = time.time()
+        with self.lock:
+            self._remember(key, (model, text))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO translations (key, model, text, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, model, text, now, now)
+            )
+            self._evict_disk(now)
+            self.conn.commit()
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            self.conn.execute("DELETE FROM translations")
+            self.conn.commit()
+            for name in self.stats:
+                self.stats[name] = 0
+
+    def disk_size(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM translations").fetchone()[0]
+
+    def _remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last=False)
+
+    def _evict_disk(self, now):
+        self.conn.execute("DELETE FROM translations WHERE created_at < ?", (now - self.ttl_seconds,))
+        overflow = self.conn.execute("SELECT COUNT(*) FROM translations").fetchone()[0] - self.max_disk_items
+        if overflow > 0:
+            self.conn.execute(
+                "DELETE FROM translations WHERE key IN "
+                "(SELECT key FROM translations ORDER BY accessed_at ASC LIMIT ?)",
+                (overflow,)
+            )
+
+def make_cache_id(payload, source_lang, context, instruction, extra=""):
+    # payload 為圖片位元組或原文文字；extra 為影響送出內容的其他設定（如前處理參數）；模型名稱在查詢時另外附加
+    h = hashlib.sha256()
+    for part in (payload, source_lang, context, instruction, extra):
+        h.update(part if isinstance(part, bytes) else str(part).encode("utf-8"))
+        h.update(b"\x00")
+    return h.hexdigest()
+
+def make_cache_key(cache_id, model_name):
+    return hashlib.sha256(f"{cache_id}:{model_name}".encode("utf-8")).hexdigest()
+
+# --- 共用：模型排程（各 API 金鑰的額度冷卻狀態與 RPM/TPM 節流） ---
+# 各模型每分鐘請求數 (RPM) 與每分鐘 Token 數 (TPM) 上限，預設採免費方案的大略數值，可依帳號方案調整
+MODEL_RATE_LIMITS = {
+    'gemini-3-flash-preview': (10, 250000),
+    'gemini-3.1-pro-preview': (5, 250000),
+    'gemini-3.1-flash-lite-preview': (15, 250000),
+    'gemini-2.5-flash': (10, 250000),
+    'gemini-2.5-pro': (5, 250000),
+    'gemini-2.0-flash': (15, 1000000),
+    'gemini-2.0-flash-lite': (30, 1000000),
+}
+DEFAULT_RATE_LIMIT = (10, 250000)
+DEFAULT_COOLDOWN_SECONDS = 60
+MAX_COOLDOWN_SECONDS = 3600
+# 所有模型都在冷卻時，單次請求最多等待的累計秒數，超過即回報額度耗盡
+MAX_COOLDOWN_WAIT_SECONDS = 20
+
+RETRY_HINT_PATTERNS = [
+    (re.compile(r"retry in ([\d.]+)\s*(ms|s)\b"), None),
+    (re.compile(r"retry_delay\s*\{\s*seconds:\s*(\d+)"), "s"),
+    (re.compile(r"retry[-_ ]after[\"':\s]*([\d.]+)"), "s"),
+]
+
+def parse_retry_after(err_str):
+    # 從錯誤訊息中解析建議的重試秒數，找不到時回傳 None
+    for pattern, unit in RETRY_HINT_PATTERNS:
+        match = pattern.search(err_str)
+        if match:
+            seconds = float(match.group(1))
+            if (unit or match.group(2)) == "ms":
+                seconds /= 1000
+            return seconds
+    return None
+
+def estimate_tokens(contents):
+    # 粗估請求 Token 數：文字約每 2 字元 1 個 Token，圖片以 258 個 Token 計
+    total = 0
+    for part in contents:
+        if isinstance(part, str):
+            total += len(part) // 2 + 1
+        else:
+            total += 258
+    return total
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def reserve(self, amount=1):
+        # 預先扣除額度（可為負值），回傳需等待的秒數，讓多個執行緒依序排隊
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= min(amount, self.capacity)
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def available(self):
+        elapsed = time.monotonic() - self.updated
+        return max(0.0, min(self.capacity, self.tokens + elapsed * self.rate))
+
+class ModelScheduler:
+    def __init__(self, models, limits=None):
+        self.models = list(models)
+        self.lock = threading.Lock()
+        self.pacing = True
+        self.state = {}
+        for name in self.models:
+            rpm, tpm = (limits or MODEL_RATE_LIMITS).get(name, DEFAULT_RATE_LIMIT)
+            self.state[name] = {
+                "cooldown_until": 0.0,
+                "failures": 0,
+                "successes": 0,
+                "quota_hits": 0,
+                "probing": False,
+                "rpm": TokenBucket(rpm),
+                "tpm": TokenBucket(tpm),
+            }
+
+    def pick(self, exclude=()):
+        # 依偏好順序回傳第一個不在冷卻中的模型；冷卻結束的較佳模型會重新被嘗試，
+        # 但同一時間只放行一個試探請求，其他執行緒在試探結果出來前先使用下一個模型
+        # exclude 中的模型不列入考慮（對沖請求不會送到原請求正在使用的模型）
+        now = time.time()
+        with self.lock:
+            for name in self.models:
+                state = self.state[name]
+                if state["cooldown_until"] > now or state["probing"] or name in exclude:
+                    continue
+                if state["failures"]:
+                    state["probing"] = True
+                return name, 0.0
+            return None, min(max(self.state[name]["cooldown_until"], now + 1) for name in self.models) - now
+
+    def available(self, exclude=()):
+        now = time.time()
+        with self.lock:
+            return any(self.state[name]["cooldown_until"] <= now for name in self.models if name not in exclude)
+
+    def acquire(self, model_name, tokens):
+        if not self.pacing:
+            return 0.0
+        with self.lock:
+            state = self.state[model_name]
+            return max(state["rpm"].reserve(1), state["tpm"].reserve(tokens))
+
+    def report_success(self, model_name):
+        with self.lock:
+            self.state[model_name]["failures"] = 0
+            self.state[model_name]["probing"] = False
+            self.state[model_name]["successes"] += 1
+
+    def report_done(self, model_name):
+        # 非額度相關的結束（如安全過濾或其他錯誤）也要釋放試探旗標
+        with self.lock:
+            self.state[model_name]["probing"] = False
+
+    def report_quota(self, model_name, err_str):
+        # 回傳 (冷卻秒數, 是否為本次新進入冷卻)；已在冷卻中時不重複延長，避免多執行緒同時回報時倍增
+        now = time.time()
+        with self.lock:
+            state = self.state[model_name]
+            state["probing"] = False
+            if state["cooldown_until"] > now:
+                return state["cooldown_until"] - now, False
+            state["failures"] += 1
+            state["quota_hits"] += 1
+            cooldown = parse_retry_after(err_str)
+            if cooldown is None:
+                cooldown = DEFAULT_COOLDOWN_SECONDS * 2 ** (state["failures"] - 1)
+            cooldown = min(cooldown, MAX_COOLDOWN_SECONDS)
+            state["cooldown_until"] = now + cooldown
+            return cooldown, True
+
+    def reset(self):
+        with self.lock:
+            for state in self.state.values():
+                state["cooldown_until"] = 0.0
+                state["failures"] = 0
+                state["probing"] = False
+
+    def snapshot(self):
+        now = time.time()
+        with self.lock:
+            return [
+                {
+                    "model": name,
+                    "cooldown": max(0.0, self.state[name]["cooldown_until"] - now),
+                    "successes": self.state[name]["successes"],
+                    "quota_hits": self.state[name]["quota_hits"],
+                    "rpm_left": self.state[name]["rpm"].available(),
+                }
+                for name in self.models
+            ]
+
+def api_key_id(key):
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+# --- 共用：效能與用量統計（各階段耗時、各模型 Token 用量、備用切換與安全過濾次數） ---
+METRICS_WINDOW = 500
+METRICS_PREFIX = "screenshot_translation"
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started_at = time.time()
+            self.stages = {}
+            self.models = {}
+            self.counters = {}
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            entry = self.stages.setdefault(stage, {"count": 0, "total": 0.0, "max": 0.0, "samples": deque(maxlen=METRICS_WINDOW)})
+            entry["count"] += 1
+            entry["total"] += seconds
+            entry["max"] = max(entry["max"], seconds)
+            entry["samples"].append(seconds)
+
+    def count(self, event, amount=1):
+        with self.lock:
+            self.counters[event] = self.counters.get(event, 0) + amount
+
+    def record_usage(self, model_name, usage=None):
+        # usage 為 (輸入 Token, 輸出 Token, 命中上下文快取的 Token)；供應商未回傳用量時只累計請求數
+        with self.lock:
+            entry = self.models.setdefault(model_name, {"requests": 0, "prompt_tokens": 0, "output_tokens": 0, "cached_tokens": 0})
+            entry["requests"] += 1
+            if usage:
+                entry["prompt_tokens"] += usage[0]
+                entry["output_tokens"] += usage[1]
+                entry["cached_tokens"] += usage[2]
+
+    def snapshot(self):
+        with self.lock:
+            stages = {}
+            for stage, entry in self.stages.items():
+                samples = sorted(entry["samples"])
+                stages[stage] = {
+                    "count": entry["count"],
+                    "total_seconds": entry["total"],
+                    "avg_seconds": entry["total"] / entry["count"],
+                    # 百分位數只取最近 METRICS_WINDOW 筆
+                    "p50_seconds": samples[len(samples) // 2],
+                    "p95_seconds": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+                    "max_seconds": entry["max"],
+                }
+            return {
+                "started_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started_at)),
+                "uptime_seconds": time.time() - self.started_at,
+                "stages": stages,
+                "models": {name: dict(entry) for name, entry in self.models.items()},
+                "counters": dict(self.counters),
+            }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), ensure_ascii=False, indent=2)
+
+    def to_prometheus(self):
+        snap = self.snapshot()
+        lines = [
+            f"# HELP {METRICS_PREFIX}_stage_seconds Time spent in each pipeline stage.",
+            f"# TYPE {METRICS_PREFIX}_stage_seconds summary",
+        ]
+        for stage, entry in sorted(snap["stages"].items()):
+            lines.append(f'{METRICS_PREFIX}_stage_seconds{{stage="{stage}",quantile="0.5"}} {entry["p50_seconds"]:.6f}')
+            lines.append(f'{METRICS_PREFIX}_stage_seconds{{stage="{stage}",quantile="0.95"}} {entry["p95_seconds"]:.6f}')
+            lines.append(f'{METRICS_PREFIX}_stage_seconds_sum{{stage="{stage}"}} {entry["total_seconds"]:.6f}')
+            lines.append(f'{METRICS_PREFIX}_stage_seconds_count{{stage="{stage}"}} {entry["count"]}')
+        lines += [
+            f"# HELP {METRICS_PREFIX}_model_requests_total Successful API calls per model.",
+            f"# TYPE {METRICS_PREFIX}_model_requests_total counter",
+        ]
+        for name, entry in sorted(snap["models"].items()):
+            lines.append(f'{METRICS_PREFIX}_model_requests_total{{model="{name}"}} {entry["requests"]}')
+        lines += [
+            f"# HELP {METRICS_PREFIX}_tokens_total Tokens reported by the provider per model.",
+            f"# TYPE {METRICS_PREFIX}_tokens_total counter",
+        ]
+        for name, entry in sorted(snap["models"].items()):
+            for kind in ["prompt", "output", "cached"]:
+                lines.append(f'{METRICS_PREFIX}_tokens_total{{model="{name}",kind="{kind}"}} {entry[kind + "_tokens"]}')
+        lines += [
+            f"# HELP {METRICS_PREFIX}_events_total Fallbacks, quota errors, safety filters and other events.",
+            f"# TYPE {METRICS_PREFIX}_events_total counter",
+        ]
+        for event, value in sorted(snap["counters"].items()):
+            lines.append(f'{METRICS_PREFIX}_events_total{{event="{event}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+# --- 共用：模型實例池（每個模型與系統指令組合只建立一次，指令夠長時註冊為上下文快取） ---
+MODEL_POOL_SIZE = 64
+# Gemini 明確上下文快取的最低 Token 數與存活時間。內建的翻譯指令只有約一百多個 Token，
+# 也低於隱含快取的最低門檻（同樣約 1024 Token），實際上不會命中任何快取；
+# 只有自訂的長指令（例如附上大量術語）才會建立明確快取。結果中的 tokens_saved 一律取自供應商回報的命中數
+CONTEXT_CACHE_MIN_TOKENS = 1024
+CONTEXT_CACHE_TTL_SECONDS = 3600
+
+def keyed_gemini_model(client, model_name=None, system=None, cached=None):
+    # 讓 GenerativeModel 改用指定金鑰的連線；cached 為 CacheServiceClient 建立的 protos.CachedContent
+    # google-generativeai 的 GenerativeModel 與 CachedContent 只會使用全域預設連線，沒有公開的方式指定金鑰，
+    # 這裡是專案中唯一使用 SDK 私有介面（GenerativeModel._client、CachedContent._from_obj）的地方，
+    # 已對照 google-generativeai 0.8.6 確認，升級 SDK 時需重新檢查
+    if cached is not None:
+        model = genai.GenerativeModel.from_cached_content(genai.caching.CachedContent._from_obj(cached))
+    elif system:
+        model = genai.GenerativeModel(model_name, system_instruction=system)
+    else:
+        model = genai.GenerativeModel(model_name)
+    model._client = client
+    return model
+
+class GeminiModelPool:
+    def __init__(self, model_factory=None, max_models=MODEL_POOL_SIZE, api_key=None):
+        # model_factory 預設為 genai.GenerativeModel；效能測試時改為本機模擬伺服器，不消耗真實額度
+        # api_key：池中的模型一律使用以此金鑰建立的連線，不依賴全域的 genai.configure；
+        # 背景工作與資料夾監看跨工作階段共用，全域設定可能已被其他使用者的金鑰覆寫
+        self.model_factory = model_factory
+        self.max_models = max_models
+        self.api_key = api_key
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.models = OrderedDict()
+        self.unsupported = set()
+        self.stats = {"built": 0, "reused": 0, "context_caches": 0}
+
+    def get(self, model_name, system=None):
+        key = (model_name, system)
+        now = time.time()
+        with self.lock:
+            entry = self.models.get(key)
+            if entry and entry[1] > now:
+                self.models.move_to_end(key)
+                self.stats["reused"] += 1
+                return entry[0]
+        
+        model, expires_at = self.build(model_name, system)
+        with self.lock:
+            self.models[key] = (model, expires_at)
+            self.models.move_to_end(key)
+            self.stats["built"] += 1
+            while len(self.models) > self.max_models:
+                self.models.popitem(last=False)
+        return model
+
+    def build(self, model_name, system):
+        if self.model_factory is not None:
+            model = self.model_factory(model_name, system_instruction=system) if system else self.model_factory(model_name)
+            return model, float("inf")
+        if system and model_name not in self.unsupported and estimate_text_tokens(system) >= CONTEXT_CACHE_MIN_TOKENS:
+            try:
+                model = self.context_cached_model(model_name, system)
+                with self.lock:
+                    self.stats["context_caches"] += 1
+                # 提早一分鐘汰換，避免使用到剛過期的快取
+                return model, time.time() + CONTEXT_CACHE_TTL_SECONDS - 60
+            except Exception:
+                # 模型或方案不支援明確快取時改用一般的 system_instruction，之後不再嘗試
+                with self.lock:
+                    self.unsupported.add(model_name)
+        if self.api_key is not None:
+            return keyed_gemini_model(self.client("generative"), model_name, system), float("inf")
+        # 未指定金鑰（例如只設定了環境變數）時維持 genai 的全域設定
+        model = genai.GenerativeModel(model_name, system_instruction=system) if system else genai.GenerativeModel(model_name)
+        return model, float("inf")
+
+    def context_cached_model(self, model_name, system):
+        ttl = datetime.timedelta(seconds=CONTEXT_CACHE_TTL_SECONDS)
+        if self.api_key is None:
+            cached = genai.caching.CachedContent.create(model=model_name, system_instruction=system, ttl=ttl)
+            return genai.GenerativeModel.from_cached_content(cached)
+        request = genai.protos.CreateCachedContentRequest(cached_content=genai.protos.CachedContent(
+            model=f"models/{model_name}",
+            system_instruction=genai.protos.Content(parts=[genai.protos.Part(text=system)]),
+            ttl=ttl
+        ))
+        return keyed_gemini_model(self.client("generative"), cached=self.client("cache").create_cached_content(request))
+
+    def client(self, name):
+        # 每個池（即每個 API 金鑰）各自建立一次 Gemini 連線
+        with self.lock:
+            if name not in self.clients:
+                client_class = glm.CacheServiceClient if name == "cache" else glm.GenerativeServiceClient
+                self.clients[name] = client_class(client_options={"api_key": self.api_key})
+            return self.clients[name]
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, models=len(self.models))
+
+# --- 共用：模型後端（Gemini 直連與 litellm 可路由的其他供應商） ---
+class GeminiBackend:
+    def __init__(self, model_name, pool):
+        self.model_name = model_name
+        self.pool = pool
+        self.usage = None
+
+    def generate(self, contents, safety_settings, on_chunk=None):
+        # 回傳 (翻譯文字, 是否觸發安全過濾)；未被過濾卻無法取得文字時讓例外往外拋，交由呼叫端判斷
+        # 提供 on_chunk 時以串流模式調用，每收到一段文字就以目前累積的全文回呼一次
+        system, contents = split_system(contents)
+        model = self.pool.get(self.model_name, system)
+        if on_chunk is None:
+            response = model.generate_content(contents, safety_settings=safety_settings)
+            self.read_usage(response)
+            if response.candidates and response.candidates[0].finish_reason in [3, 4, 8]:
+                try:
+                    return response.text, True
+                except:
+                    return None, True
+            return response.text, False
+        
+        response = model.generate_content(contents, safety_settings=safety_settings, stream=True)
+        pieces = []
+        for chunk in response:
+            try:
+                piece = chunk.text
+            except ValueError:
+                # 被過濾的片段沒有文字，串流結束後再統一檢查 finish_reason
+                piece = ""
+            if piece:
+                pieces.append(piece)
+                on_chunk("".join(pieces))
+        
+        text = "".join(pieces)
+        self.read_usage(response)
+        if response.candidates and response.candidates[0].finish_reason in [3, 4, 8]:
+            return text or None, True
+        if not text:
+            return response.text, False
+        return text, False
+
+    def read_usage(self, response):
+        meta = getattr(response, "usage_metadata", None)
+        if meta:
+            self.usage = (
+                meta.prompt_token_count or 0,
+                meta.candidates_token_count or 0,
+                getattr(meta, "cached_content_token_count", 0) or 0,
+            )
+
+def to_openai_content(contents):
+    # 將 Gemini 格式的內容（文字、PIL 圖片、{mime_type, data}）轉為 OpenAI 相容的訊息內容
+    parts = []
+    for part in contents:
+        if isinstance(part, str):
+            parts.append({"type": "text", "text": part})
+            continue
+        if isinstance(part, dict):
+            mime_type, data = part["mime_type"], part["data"]
+        else:
+            buffer = io.BytesIO()
+            part.save(buffer, format="PNG")
+            mime_type, data = "image/png", buffer.getvalue()
+        url = f"data:{mime_type};base64,{base64.b64encode(data).decode('ascii')}"
+        parts.append({"type": "image_url", "image_url": {"url": url}})
+    return parts
+
+class LiteLLMBackend:
+    def __init__(self, model_name, api_base=None, api_key=None):
+        self.model_name = model_name
+        self.api_base = api_base
+        self.api_key = api_key
+        self.usage = None
+
+    def generate(self, contents, safety_settings, on_chunk=None):
+        # litellm 載入較慢，僅在實際使用其他供應商時才匯入；safety_settings 為 Gemini 專用參數，此處忽略
+        import litellm
+        
+        system, contents = split_system(contents)
+        messages = [{"role": "user", "content": to_openai_content(contents)}]
+        if system:
+            # 固定的系統指令放在最前面，支援前綴快取的供應商可自動命中
+            messages.insert(0, {"role": "system", "content": system})
+        response = litellm.completion(
+            model=self.model_name,
+            messages=messages,
+            api_base=self.api_base,
+            api_key=self.api_key,
+            stream=on_chunk is not None,
+        )
+        if on_chunk is None:
+            self.read_usage(response)
+            choice = response.choices[0]
+            return choice.message.content, choice.finish_reason == "content_filter"
+        
+        pieces = []
+        finish_reason = None
+        for chunk in response:
+            # 部分供應商會在最後一個串流片段附上用量
+            self.read_usage(chunk)
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            if choice.delta.content:
+                pieces.append(choice.delta.content)
+                on_chunk("".join(pieces))
+            finish_reason = choice.finish_reason or finish_reason
+        return "".join(pieces), finish_reason == "content_filter"
+
+    def read_usage(self, response):
+        usage = getattr(response, "usage", None)
+        if usage:
+            details = getattr(usage, "prompt_tokens_details", None)
+            cached = getattr(details, "cached_tokens", 0) or 0
+            self.usage = (usage.prompt_tokens or 0, usage.completion_tokens or 0, cached)
+
+# --- 共用：依近期延遲與成功率選擇供應商 ---
+# litellm 供應商（含本地 OpenAI 相容服務）預設的 RPM/TPM 上限
+LITELLM_RATE_LIMIT = (60, 1000000)
+ROUTER_WINDOW = 50
+ROUTER_MIN_SAMPLES = 3
+# 對沖請求：同一模型至少累積 HEDGE_MIN_SAMPLES 筆延遲樣本才啟用；預設額外請求不超過總數的 10%
+HEDGE_MIN_SAMPLES = 5
+HEDGE_MIN_DELAY_SECONDS = 0.5
+HEDGE_BUDGET = 0.1
+HEDGE_POLL_SECONDS = 0.05
+
+def parse_provider_specs(text):
+    specs = []
+    for line in (text or "").splitlines():
+        fields = [field.strip() for field in line.split("|")]
+        if not fields[0]:
+            continue
+        fields += [""] * (3 - len(fields))
+        specs.append((fields[0], fields[1] or None, fields[2] or None))
+    return tuple(specs)
+
+class ProviderRoute:
+    def __init__(self, name, scheduler, make_backend, pool=None):
+        self.name = name
+        self.scheduler = scheduler
+        self.make_backend = make_backend
+        self.pool = pool
+        self.samples = deque(maxlen=ROUTER_WINDOW)
+
+    def stats(self):
+        latencies = sorted(latency for latency, ok in self.samples if ok)
+        success_rate = len(latencies) / len(self.samples) if self.samples else None
+        p50 = latencies[len(latencies) // 2] if latencies else None
+        return p50, success_rate
+
+class BackendRouter:
+    def __init__(self, routes):
+        self.routes = routes
+        self.lock = threading.Lock()
+        self.latency_aware = True
+        self.metrics = Metrics()
+        # 對沖請求：hedge 為 None 時停用，否則為 {"percentile": 延遲百分位, "budget": 額外請求占比上限}
+        self.hedge = None
+        self.model_latency = {}
+        self.hedge_requests = 0
+        self.hedges_sent = 0
+
+    def ranked(self):
+        # 樣本不足的供應商分數為 0，會優先被試用以收集延遲資料；全數冷卻中的供應商排在最後
+        with self.lock:
+            if not self.latency_aware:
+                return list(self.routes)
+            return sorted(self.routes, key=lambda route: (not route.scheduler.available(), self._score(route)))
+
+    def _score(self, route):
+        if len(route.samples) < ROUTER_MIN_SAMPLES:
+            return 0.0
+        p50, success_rate = route.stats()
+        if p50 is None:
+            return float("inf")
+        # 以「每次成功所需的期望時間」排序
+        return p50 / max(success_rate, 0.05)
+
+    def record(self, route, latency, ok):
+        with self.lock:
+            route.samples.append((latency, ok))
+
+    def record_latency(self, model_name, streaming, seconds):
+        # 串流模式記錄首字延遲，否則記錄完整回應時間；兩者分開統計，作為對沖的觸發門檻
+        with self.lock:
+            samples = self.model_latency.setdefault((model_name, streaming), deque(maxlen=ROUTER_WINDOW))
+            samples.append(seconds)
+
+    def hedge_delay(self, model_name, streaming):
+        # 樣本不足時回傳 None，不進行對沖
+        with self.lock:
+            samples = sorted(self.model_latency.get((model_name, streaming), ()))
+        if self.hedge is None or len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return max(HEDGE_MIN_DELAY_SECONDS, samples[int(self.hedge["percentile"] * (len(samples) - 1))])
+
+    def expected_latency(self, model_name, streaming, elapsed):
+        # 已等待 elapsed 秒仍未回應時，依歷史樣本中同樣超過 elapsed 的部分估計實際所需時間；沒有更慢的樣本時只能以 elapsed 作為下限
+        with self.lock:
+            slower = sorted(seconds for seconds in self.model_latency.get((model_name, streaming), ()) if seconds > elapsed)
+        return slower[len(slower) // 2] if slower else elapsed
+
+    def count_hedge_request(self):
+        with self.lock:
+            self.hedge_requests += 1
+
+    def spend_hedge(self):
+        # 額外送出的對沖請求不超過總請求數的 budget 比例
+        with self.lock:
+            if self.hedge is None or self.hedges_sent >= self.hedge["budget"] * self.hedge_requests:
+                return False
+            self.hedges_sent += 1
+            return True
+
+    def has_alternative(self, exclude):
+        return any(route.scheduler.available(exclude) for route in self.routes)
+
+    def set_hedging(self, percentile=None, budget=HEDGE_BUDGET):
+        self.hedge = None if percentile is None else {"percentile": percentile, "budget": budget}
+
+    def model_names(self):
+        return [name for route in self.routes for name in route.scheduler.models]
+
+    def pool_stats(self):
+        total = {"built": 0, "reused": 0, "context_caches": 0, "models": 0}
+        for route in self.routes:
+            if route.pool is not None:
+                for key, value in route.pool.snapshot().items():
+                    total[key] += value
+        return total
+
+    def set_pacing(self, enabled):
+        for route in self.routes:
+            route.scheduler.pacing = enabled
+
+def create_router(gemini_scheduler, provider_specs, gemini_api_key=None):
+    # gemini_scheduler 為 None 時不使用 Gemini；provider_specs 為 parse_provider_specs 的結果
+    # gemini_api_key 為此路由器專用的金鑰，所有 Gemini 請求都以它建立的連線送出
+    routes = []
+    if gemini_scheduler is not None:
+        pool = GeminiModelPool(api_key=gemini_api_key)
+        routes.append(ProviderRoute("Gemini", gemini_scheduler, lambda name: GeminiBackend(name, pool), pool))
+    for model_name, api_base, key in provider_specs:
+        scheduler = ModelScheduler([model_name], limits={model_name: LITELLM_RATE_LIMIT})
+        routes.append(ProviderRoute(
+            model_name,
+            scheduler,
+            lambda name, api_base=api_base, key=key: LiteLLMBackend(name, api_base, key)
+        ))
+    return BackendRouter(routes)
+
+# --- 共用：帶備用模型切換的 API 調用 ---
+def is_quota_error(err_str):
+    return "429" in err_str or "quota" in err_str or "exhausted" in err_str
+
+def cached_result(cache, cache_id, model_names=FALLBACK_MODELS):
+    # 快取命中時回傳與 generate_with_fallback 相同格式的結果，否則回傳 None
+    if cache is None or not cache_id:
+        return None
+    hit = cache.lookup([make_cache_key(cache_id, name) for name in model_names])
+    if not hit:
+        return None
+    model_name, text = hit
+    return {"status": "ok", "text": text, "model": model_name, "error": None, "notices": [], "cached": True}
+
+def cached_image_result(cache, cache_id, model_names=FALLBACK_MODELS):
+    result = cached_result(cache, cache_id, model_names)
+    return with_ocr_source(result) if result is not None else None
+
+def generate_with_fallback(contents, safety_settings, router, cache=None, cache_id=None, on_chunk=None):
+    # 注意：此函式可能在背景執行緒中執行，不可直接呼叫 st.* 元件，結果以 dict 回傳由主執行緒渲染
+    if router.hedge is None:
+        return call_with_fallback(contents, safety_settings, router, cache, cache_id, on_chunk)
+    return hedged_generate(contents, safety_settings, router, cache, cache_id, on_chunk)
+
+def call_with_fallback(contents, safety_settings, router, cache=None, cache_id=None, on_chunk=None, attempt=None):
+    # attempt 為對沖時的 HedgeAttempt：記錄目前使用的模型，並可由另一個請求取消
+    result = {"status": "exhausted", "text": None, "model": None, "error": None, "notices": [], "cached": False}
+    tokens = estimate_tokens(contents)
+    routes = router.ranked()
+    metrics = router.metrics
+    waited = 0.0
+    attempted = [] if attempt is None else attempt.attempted
+    exclude = () if attempt is None else attempt.exclude
+    
+    for route in routes:
+        scheduler = route.scheduler
+        while True:
+            if attempt is not None and attempt.cancel.is_set():
+                raise HedgeCancelled()
+            model_name, wait = scheduler.pick(exclude)
+            if model_name is None:
+                # 還有其他供應商可用時不等待冷卻，直接換下一個供應商；單次請求累計等待超過上限即放棄
+                # 對沖請求不等待冷卻，沒有其他健康的模型時直接放棄
+                if waited + wait > MAX_COOLDOWN_WAIT_SECONDS or route is not routes[-1] or exclude:
+                    result["status"] = "exhausted"
+                    break
+                with metrics.span("cooldown_wait"):
+                    time.sleep(wait)
+                waited += wait
+                continue
+            
+            pacing = scheduler.acquire(model_name, tokens)
+            if pacing > 0:
+                with metrics.span("pacing_wait"):
+                    time.sleep(pacing)
+            backend = route.make_backend(model_name)
+            attempted.append(model_name)
+            metrics.count("api_calls")
+            start = time.perf_counter()
+            if attempt is not None:
+                attempt.sent_at = start
+            first_token = []
+            
+            def stream_chunk(partial):
+                # 記錄首字延遲 (time-to-first-token)
+                if not first_token:
+                    first_token.append(time.perf_counter() - start)
+                    metrics.observe("first_token", first_token[0])
+                on_chunk(partial)
+            
+            try:
+                # 包含上傳、等待模型生成與下載回應的時間
+                with metrics.span("generate"):
+                    text, filtered = backend.generate(contents, safety_settings, stream_chunk if on_chunk else None)
+                latency = time.perf_counter() - start
+                router.record(route, latency, True)
+                router.record_latency(model_name, on_chunk is not None, first_token[0] if first_token else latency)
+                scheduler.report_success(model_name)
+                usage = getattr(backend, "usage", None)
+                metrics.record_usage(model_name, usage)
+                if attempted[0] != model_name:
+                    metrics.count("fallbacks")
+                result["model"] = model_name
+                result["text"] = text
+                result["error"] = None
+                result["latency"] = latency
+                result["ttft"] = first_token[0] if first_token else None
+                # 供應商回報輸入中命中上下文快取（明確或隱含）的 Token 數；未回報或未命中時為 0
+                result["tokens_saved"] = usage[2] if usage else 0
+                # 每次請求都重複送出的固定指令估計 Token 數，可對照快取門檻判斷是否值得建立明確快取
+                result["instruction_tokens"] = estimate_text_tokens(split_system(contents)[0] or "")
+                
+                if filtered:
+                    result["status"] = "filtered"
+                    metrics.count("safety_filtered")
+                else:
+                    result["status"] = "ok"
+                    if cache is not None and cache_id:
+                        cache.put(make_cache_key(cache_id, model_name), model_name, text)
+                return result
+                
+            except HedgeCancelled:
+                # 另一個對沖請求已先回應，中止串流；不視為此模型的錯誤
+                scheduler.report_done(model_name)
+                raise
+            except Exception as api_err:
+                err_str = str(api_err).lower()
+                if is_quota_error(err_str):
+                    metrics.count("quota_errors")
+                    cooldown, newly = scheduler.report_quota(model_name, err_str)
+                    if newly:
+                        result["notices"].append(f"🔄 {model_name} 額度耗盡（約 {cooldown:.0f} 秒後重試），自動切換至下一個模型...")
+                    continue
+                
+                scheduler.report_done(model_name)
+                if "finish_reason" in err_str:
+                    result["status"] = "blocked"
+                    metrics.count("safety_blocked")
+                    return result
+                
+                # 其他錯誤視為此供應商暫時異常，記錄失敗後改用下一個供應商
+                metrics.count("api_errors")
+                router.record(route, time.perf_counter() - start, False)
+                result["status"] = "error"
+                result["error"] = str(api_err)
+                if route is not routes[-1]:
+                    result["notices"].append(f"⚠️ {route.name} 調用出錯，改用其他供應商...")
+                break
+    
+    if result["status"] == "exhausted":
+        metrics.count("exhausted")
+    return result
+
+# --- 共用：對沖請求（原請求超過延遲百分位仍未回應時，另送一份到下一個健康的模型，先成功者勝出） ---
+class HedgeCancelled(Exception):
+    pass
+
+class HedgeAttempt:
+    def __init__(self, exclude=()):
+        self.exclude = set(exclude)
+        self.attempted = []
+        self.cancel = threading.Event()
+        self.sent_at = None
+        self.delay = None
+
+def hedged_generate(contents, safety_settings, router, cache=None, cache_id=None, on_chunk=None):
+    # 兩個請求都在輔助執行緒中執行，呼叫端只等待結果；非串流的落敗請求無法中途取消，完成後結果直接捨棄，
+    # 但仍會寫入快取與延遲統計。串流時第一個送出文字的請求取得畫面，另一個立即中止
+    streaming = on_chunk is not None
+    metrics = router.metrics
+    router.count_hedge_request()
+    outcomes = queue.Queue()
+    lock = threading.Lock()
+    leader = []
+    attempts = []
+    
+    def launch(attempt):
+        def stream(partial):
+            with lock:
+                if not leader:
+                    leader.append(attempt)
+                    for other in attempts:
+                        if other is not attempt:
+                            other.cancel.set()
+                if leader[0] is not attempt or attempt.cancel.is_set():
+                    raise HedgeCancelled()
+            on_chunk(partial)
+        
+        def run():
+            try:
+                result = call_with_fallback(contents, safety_settings, router, cache, cache_id, stream if streaming else None, attempt)
+            except HedgeCancelled:
+                result = None
+            except Exception as e:
+                result = {"status": "error", "text": None, "model": None, "error": str(e), "notices": [], "cached": False}
+            outcomes.put((attempt, result))
+        
+        attempts.append(attempt)
+        threading.Thread(target=run, daemon=True).start()
+    
+    primary = HedgeAttempt()
+    launch(primary)
+    hedge = None
+    hedge_checked = False
+    failures = []
+    
+    while True:
+        timeout = HEDGE_POLL_SECONDS
+        if hedge is None and not hedge_checked and primary.sent_at is not None and not leader:
+            delay = router.hedge_delay(primary.attempted[-1], streaming)
+            elapsed = time.perf_counter() - primary.sent_at
+            if delay is not None and elapsed >= delay:
+                hedge_checked = True
+                if router.has_alternative(primary.attempted) and router.spend_hedge():
+                    metrics.count("hedges")
+                    hedge = HedgeAttempt(primary.attempted)
+                    hedge.delay = delay
+                    launch(hedge)
+            elif delay is not None:
+                timeout = min(timeout, delay - elapsed)
+        
+        try:
+            attempt, result = outcomes.get(timeout=timeout)
+        except queue.Empty:
+            continue
+        
+        if result is None or result["status"] not in ["ok", "filtered"]:
+            # 失敗或被取消：另一個請求仍在進行時繼續等待；全部結束時優先回報原請求的結果
+            failures.append((attempt, result))
+            if len(failures) < len(attempts):
+                continue
+            failures.sort(key=lambda failure: (failure[1] is None, failure[0] is not primary))
+            return failures[0][1]
+        
+        for other in attempts:
+            if other is not attempt:
+                other.cancel.set()
+        if hedge is not None:
+            elapsed = time.perf_counter() - primary.sent_at
+            saved = 0.0
+            if attempt is hedge:
+                metrics.count("hedge_wins")
+                saved = max(0.0, router.expected_latency(primary.attempted[-1], streaming, elapsed) - elapsed)
+                metrics.observe("hedge_saved", saved)
+            result["hedge"] = {
+                "primary": primary.attempted[-1],
+                "winner": result["model"],
+                "delay": hedge.delay,
+                "saved": saved,
+            }
+        return result
+
+# --- 共用：多張圖片合併為單次請求 ---
+# 長截圖切塊時同時翻譯的區塊數預設值
+TILE_MAX_WORKERS = 4
+PACK_MARKER_RE = re.compile(r"={2,}\s*圖片\s*(\d+)\s*={2,}")
+
+def build_pack_instruction(count):
+    return (
+        f"本次請求共包含 {count} 張圖片，請依序分別辨識並翻譯每一張。\n"
+        f"每張圖片的翻譯之前，請先單獨輸出一行標記「===圖片 k===」（k 為圖片編號 1 到 {count}），"
+        "標記之後依上述輸出格式緊接該圖片的原文與翻譯內容；每張圖片都必須輸出標記，即使圖片中沒有文字也請保留標記。"
+    )
+
+def split_pack_response(text, count):
+    # 回傳 {圖片編號: 翻譯}；缺少標記或內容為空的圖片不會出現在結果中
+    sections = {}
+    matches = list(PACK_MARKER_RE.finditer(text or ""))
+    for n, match in enumerate(matches):
+        k = int(match.group(1))
+        end = matches[n + 1].start() if n + 1 < len(matches) else len(text)
+        section = text[match.end():end].strip()
+        if 1 <= k <= count and section and k not in sections:
+            sections[k] = section
+    return sections
+
+def translate_image_pack_job(images, prompt_parts, safety_settings, router, cache=None, cache_ids=None, prep_options=None,
+                             on_chunk=None, tile_options=None, text_options=None, tile_workers=TILE_MAX_WORKERS):
+    # 回傳與 images 順序對應的結果列表；解析失敗的圖片會自動改為單張重送
+    # on_chunk(位置, 目前累積的翻譯) 會在串流時依圖片分別回呼
+    # tile_options 只含影響翻譯結果的切塊設定（會列入快取鍵）；切塊的並行數 tile_workers 另外傳入
+    cache_ids = cache_ids or [None] * len(images)
+    if not text_options:
+        return send_image_pack(images, prompt_parts, safety_settings, router, cache, cache_ids, prep_options, on_chunk, tile_options, tile_workers)
+    
+    # 先在本機偵測文字範圍：沒有文字的圖片不送出，其餘裁切到文字範圍後再合併送出
+    # 需要切塊的長截圖不偵測也不裁切，整張交給切塊翻譯，避免裁掉分散在各處的文字
+    results = [None] * len(images)
+    regions = []
+    kept = []
+    for k, img in enumerate(images):
+        if tile_options and needs_tiling(img.size, tile_options["tile_height"], tile_options["overlap"]):
+            regions.append(None)
+            kept.append((k, img))
+            continue
+        with router.metrics.span("text_detect"):
+            cropped, region = crop_to_text(img, **text_options)
+        regions.append(region)
+        if cropped is None:
+            results[k] = no_text_result(region)
+        else:
+            kept.append((k, cropped))
+    
+    if kept:
+        def kept_stream(position, partial):
+            on_chunk(kept[position][0], partial)
+        
+        sent = send_image_pack(
+            [cropped for _, cropped in kept], prompt_parts, safety_settings, router, cache,
+            [cache_ids[k] for k, _ in kept], prep_options, kept_stream if on_chunk else None, tile_options, tile_workers
+        )
+        for (k, _), result in zip(kept, sent):
+            result["text_region"] = regions[k]
+            if result.get("preprocess") and regions[k]:
+                # 前處理統計以原始上傳的尺寸為準，方便對照裁切與壓縮各省下多少
+                result["preprocess"] = dict(result["preprocess"], original_size=regions[k]["original_size"])
+            results[k] = result
+    return results
+
+def send_image_pack(images, prompt_parts, safety_settings, router, cache, cache_ids, prep_options, on_chunk, tile_options,
+                    tile_workers=TILE_MAX_WORKERS):
+    def image_stream(position):
+        if on_chunk is None:
+            return None
+        return lambda partial: on_chunk(position, partial)
+    
+    if len(images) == 1:
+        return [translate_image_job(
+            images[0], prompt_parts, safety_settings, router, cache, cache_ids[0], prep_options, image_stream(0), tile_options, tile_workers
+        )]
+    
+    contents = list(prompt_parts) + [build_pack_instruction(len(images))]
+    prep_stats = []
+    for k, img in enumerate(images, start=1):
+        payload = img
+        stats = None
+        if prep_options:
+            with router.metrics.span("preprocess"):
+                payload, stats = preprocess_image(img, **prep_options)
+        prep_stats.append(stats)
+        contents += [f"圖片 {k}：", payload]
+    
+    def pack_stream(partial):
+        for k, section in split_pack_response(partial, len(images)).items():
+            on_chunk(k - 1, split_ocr_response(section)[1])
+    
+    pack_result = generate_with_fallback(contents, safety_settings, router, on_chunk=pack_stream if on_chunk else None)
+    if pack_result["status"] in ["exhausted", "error"]:
+        # 額度耗盡或 API 錯誤時單張重送也無濟於事，直接回報給每張圖片
+        return [dict(pack_result, preprocess=stats) for stats in prep_stats]
+    
+    sections = split_pack_response(pack_result["text"], len(images)) if pack_result["status"] == "ok" else {}
+    results = []
+    notices = pack_result["notices"]
+    for k, img in enumerate(images, start=1):
+        if k in sections:
+            if cache is not None and cache_ids[k - 1]:
+                cache.put(make_cache_key(cache_ids[k - 1], pack_result["model"]), pack_result["model"], sections[k])
+            result = with_ocr_source(dict(pack_result, text=sections[k], notices=notices, preprocess=prep_stats[k - 1], packed=len(images)))
+        else:
+            result = translate_image_job(img, prompt_parts, safety_settings, router, cache, cache_ids[k - 1], prep_options, image_stream(k - 1))
+            result["notices"] = notices + result["notices"]
+            result["pack_retry"] = True
+        notices = []
+        results.append(result)
+    return results
+
+def translate_image_file(data, prompt_parts, safety_settings, router, cache=None, cache_id=None, prep_options=None,
+                         tile_options=None, text_options=None, tile_workers=TILE_MAX_WORKERS):
+    # 單一檔案：快取命中時不解碼，否則解碼後翻譯並立即釋放像素
+    result = cached_image_result(cache, cache_id, router.model_names())
+    if result is not None:
+        return result
+    img = load_image(data)
+    try:
+        return translate_image_pack_job(
+            [img], prompt_parts, safety_settings, router, cache, [cache_id], prep_options, None, tile_options, text_options, tile_workers
+        )[0]
+    finally:
+        img.close()
+
+def translate_image_job(img, prompt_parts, safety_settings, router, cache=None, cache_id=None, prep_options=None, on_chunk=None,
+                        tile_options=None, tile_workers=TILE_MAX_WORKERS):
+    # 快取查詢由呼叫端先行處理（命中時連前處理都省略）；前處理在背景執行緒中進行，與其他圖片的 API 調用重疊
+    if tile_options and needs_tiling(img.size, tile_options["tile_height"], tile_options["overlap"]):
+        return translate_tiled_image(
+            img, prompt_parts, safety_settings, router, cache, cache_id, prep_options, on_chunk, max_workers=tile_workers, **tile_options
+        )
+    
+    payload = img
+    prep_stats = None
+    if prep_options:
+        with router.metrics.span("preprocess"):
+            payload, prep_stats = preprocess_image(img, **prep_options)
+    
+    result = with_ocr_source(generate_with_fallback(prompt_parts + [payload], safety_settings, router, cache, cache_id, ocr_stream(on_chunk)))
+    result["preprocess"] = prep_stats
+    return result
+
+# --- 共用：超長截圖（條漫、長截圖）切成重疊區塊分別翻譯 ---
+# 兩塊譯文之間最多比對幾行重複內容
+TILE_MAX_OVERLAP_LINES = 8
+TILE_LINE_SIMILARITY = 0.85
+# 高度至少為寬度的幾倍才切塊：一般手機截圖（如 1290×2796、1440×3200）約 2.2 倍，整張送出即可
+TILE_MIN_ASPECT = 3.0
+
+def needs_tiling(size, tile_height, overlap):
+    width, height = size
+    return height > tile_height + overlap and height > TILE_MIN_ASPECT * width
+
+def split_tiles(img, tile_height=2400, overlap=200):
+    # 由上而下切成固定高度的區塊，相鄰區塊重疊 overlap 像素，避免文字剛好被切斷
+    width, height = img.size
+    tiles = []
+    top = 0
+    while True:
+        bottom = min(top + tile_height, height)
+        tiles.append(img.crop((0, top, width, bottom)))
+        if bottom >= height:
+            return tiles
+        top = bottom - overlap
+
+def build_tile_instruction(index, count):
+    return (
+        f"這是一張長截圖由上而下切開後的第 {index} / {count} 塊，相鄰區塊的上下邊緣有部分重疊。"
+        "若最上方或最下方的文字被裁切而不完整，請略過該行，不要猜測。"
+    )
+
+def normalize_line(line):
+    return re.sub(r"[\W_]+", "", line).lower()
+
+def lines_match(a, b):
+    a, b = normalize_line(a), normalize_line(b)
+    return bool(a) and (a == b or SequenceMatcher(None, a, b).ratio() >= TILE_LINE_SIMILARITY)
+
+def stitch_tile_texts(texts, max_overlap_lines=TILE_MAX_OVERLAP_LINES):
+    # 依閱讀順序串接各塊譯文，並移除重疊區域造成的重複行（比較時忽略空白行與標點）
+    merged = []
+    for text in texts:
+        lines = (text or "").strip().splitlines()
+        content = [n for n, line in enumerate(lines) if line.strip()]
+        merged_content = [line for line in merged if line.strip()]
+        
+        skip = 0
+        for k in range(min(max_overlap_lines, len(content), len(merged_content)), 0, -1):
+            head = [lines[n] for n in content[:k]]
+            if all(lines_match(a, b) for a, b in zip(merged_content[-k:], head)):
+                skip = content[k - 1] + 1
+                break
+        
+        merged += lines[skip:]
+    return "\n".join(merged).strip()
+
+def translate_tiled_image(img, prompt_parts, safety_settings, router, cache=None, cache_id=None, prep_options=None,
+                          on_chunk=None, tile_height=2400, overlap=200, max_workers=TILE_MAX_WORKERS):
+    with router.metrics.span("tile_split"):
+        tiles = split_tiles(img, tile_height, overlap)
+    tile_texts = [""] * len(tiles)
+    tile_stats = [None] * len(tiles)
+    
+    def tile_job(k):
+        def job(stream):
+            payload = tiles[k]
+            if prep_options:
+                with router.metrics.span("preprocess"):
+                    payload, tile_stats[k] = preprocess_image(tiles[k], **prep_options)
+            contents = list(prompt_parts) + [build_tile_instruction(k + 1, len(tiles)), payload]
+            return with_ocr_source(generate_with_fallback(contents, safety_settings, router, on_chunk=ocr_stream(stream)))
+        return job
+    
+    def show_partial(k, partial):
+        tile_texts[k] = partial
+        on_chunk(stitch_tile_texts(tile_texts))
+    
+    results = run_streaming_jobs(
+        {k: tile_job(k) for k in range(len(tiles))},
+        max_workers,
+        show_partial if on_chunk else None
+    )
+    results = [results[k] for k in range(len(tiles))]
+    
+    succeeded = [r for r in results if r["status"] in ["ok", "filtered"]]
+    if not succeeded:
+        result = dict(results[0])
+    else:
+        texts = [
+            r["text"] if r["status"] in ["ok", "filtered"] and r["text"] else f"〔第 {k + 1} 塊翻譯失敗〕"
+            for k, r in enumerate(results)
+        ]
+        filtered = [r for r in results if r["status"] == "filtered"]
+        result = dict(
+            (filtered or succeeded)[0],
+            status="filtered" if filtered else "ok",
+            text=stitch_tile_texts(texts),
+            source=stitch_tile_texts([r.get("source") or "" for r in results]),
+            ttft=min((r["ttft"] for r in succeeded if r.get("ttft") is not None), default=None),
+            latency=max(r.get("latency") or 0 for r in succeeded),
+        )
+        if len(succeeded) < len(results):
+            result["error"] = "部分區塊翻譯失敗"
+    
+    notices = []
+    for r in results:
+        notices += [notice for notice in r["notices"] if notice not in notices]
+    result["notices"] = notices
+    result["tiles"] = len(tiles)
+    
+    if prep_options:
+        result["preprocess"] = {
+            "original_size": img.size,
+            "sent_size": tile_stats[0]["sent_size"] if tile_stats[0] else tiles[0].size,
+            "sent_bytes": sum(stats["sent_bytes"] for stats in tile_stats if stats),
+            "elapsed_ms": sum(stats["elapsed_ms"] for stats in tile_stats if stats),
+        }
+    else:
+        result["preprocess"] = None
+    
+    if cache is not None and cache_id and result["status"] == "ok" and len(succeeded) == len(results):
+        cache.put(make_cache_key(cache_id, result["model"]), result["model"], join_ocr_response(result["source"], result["text"]))
+    return result
+
+def reuse_result(result, source_name):
+    # 相似截圖沿用代表圖片的翻譯；不重複顯示切換模型的提示
+    reused = dict(result)
+    reused["notices"] = []
+    reused["preprocess"] = None
+    reused["packed"] = None
+    reused["pack_retry"] = False
+    reused["tiles"] = None
+    reused["text_region"] = None
+    reused["reused_from"] = source_name
+    return reused
+
+def summarize_latency(results):
+    # 統計本次串流結果的平均首字延遲與總耗時，用來比較體感速度
+    timed = [r for r in results if r.get("ttft") is not None]
+    if not timed:
+        return None
+    avg_ttft = sum(r["ttft"] for r in timed) / len(timed)
+    avg_total = sum(r["latency"] for r in timed) / len(timed)
+    return f"⏱️ 平均首字延遲 {avg_ttft:.2f} 秒，平均總耗時 {avg_total:.2f} 秒（{len(timed)} 次串流請求）"
+
+# --- 共用：影片與 GIF 字幕翻譯（只送出字幕區域有變化的影格，輸出 SRT） ---
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".mkv", ".webm", ".avi")
+SUBTITLE_SAMPLE_FPS = 2.0
+# 字幕區域：以畫面高度比例表示的上下界，預設為畫面下方三分之一
+SUBTITLE_REGION = (0.65, 1.0)
+# 相鄰取樣影格的字幕區域 dHash 距離不超過此值時視為同一句字幕
+SUBTITLE_HASH_THRESHOLD = 6
+SUBTITLE_PADDING = 8
+
+def video_reader_available():
+    # 只檢查是否已安裝 OpenCV，不在此載入；未安裝時只能讀取 GIF
+    return importlib.util.find_spec("cv2") is not None
+
+def iter_video_frames(path, sample_fps=SUBTITLE_SAMPLE_FPS):
+    # 依固定間隔取樣，產生 (時間秒數, 影格)；GIF／動態 WebP 以 Pillow 讀取，其他影片以 OpenCV 讀取
+    interval = 1.0 / sample_fps
+    if not path.lower().endswith(VIDEO_EXTENSIONS):
+        with Image.open(path) as img:
+            elapsed = 0.0
+            next_sample = 0.0
+            for index in range(getattr(img, "n_frames", 1)):
+                img.seek(index)
+                if elapsed >= next_sample:
+                    yield elapsed, img.convert("RGB")
+                    next_sample = elapsed + interval
+                elapsed += (img.info.get("duration") or 100) / 1000
+        return
+    
+    # OpenCV 載入較慢且只有影片需要，僅在實際處理影片時才匯入
+    try:
+        import cv2
+    except ImportError:
+        raise RuntimeError("讀取影片需要安裝 opencv-python-headless（GIF 不需要）")
+    
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError("無法開啟影片檔案")
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+        step = max(1, round(fps * interval))
+        index = 0
+        while True:
+            # 不需要的影格只 grab 不解碼，取樣間隔越大越省時
+            if not capture.grab():
+                break
+            if index % step == 0:
+                ok, frame = capture.retrieve()
+                if not ok:
+                    break
+                yield index / fps, Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+            index += 1
+    finally:
+        capture.release()
+
+def subtitle_crop(frame, region=SUBTITLE_REGION):
+    width, height = frame.size
+    return frame.crop((0, int(height * region[0]), width, int(height * region[1])))
+
+def detect_subtitle_changes(frames, region=SUBTITLE_REGION, threshold=SUBTITLE_HASH_THRESHOLD, interval=1.0 / SUBTITLE_SAMPLE_FPS,
+                            on_frame=None):
+    # 回傳字幕片段列表：{"start", "end", "hash", "image", "same_as"}；沒有文字的影格結束目前的字幕，
+    # 與前一句相似的影格延長目前字幕的結束時間，只有字幕內容改變時才開始新片段（只有新片段需要翻譯）
+    # same_as 指向先前內容相同的片段（例如重複出現的台詞），可直接沿用其翻譯
+    segments = []
+    seen = []
+    current = None
+    last_time = 0.0
+    for count, (timestamp, frame) in enumerate(frames, start=1):
+        if on_frame is not None:
+            on_frame(count, timestamp)
+        if current is not None:
+            current["end"] = timestamp
+        last_time = timestamp
+        crop = subtitle_crop(frame, region)
+        box = detect_text_box(crop, SUBTITLE_PADDING)
+        if box is None:
+            current = None
+            continue
+        # 只比對文字範圍，降低字幕後方畫面變化的影響
+        text_crop = crop.crop(box)
+        image_hash = dhash(text_crop)
+        if current is not None and hamming_distance(image_hash, current["hash"]) <= threshold:
+            continue
+        current = {
+            "start": timestamp,
+            "end": timestamp,
+            "hash": image_hash,
+            "image": text_crop,
+            "same_as": find_similar(image_hash, seen, threshold),
+        }
+        # 只有第一次出現的字幕可被沿用，same_as 一律指向實際送出翻譯的片段
+        if current["same_as"] is None:
+            seen.append((image_hash, len(segments)))
+        segments.append(current)
+    if current is not None:
+        # 最後一句持續到最後一次取樣後再一個取樣間隔
+        current["end"] = last_time + interval
+    return segments
+
+def format_srt_time(seconds):
+    millis = int(round(seconds * 1000))
+    hours, millis = divmod(millis, 3600000)
+    minutes, millis = divmod(millis, 60000)
+    secs, millis = divmod(millis, 1000)
+    return f"{hours:02d}:{minutes:02d}:{secs:02d},{millis:03d}"
+
+def build_srt(cues):
+    # cues 為 (開始秒數, 結束秒數, 文字)；相鄰且文字相同的字幕合併為一句，空白的略過
+    merged = []
+    for start, end, text in cues:
+        text = (text or "").strip()
+        if not text:
+            continue
+        if merged and merged[-1][2] == text and start - merged[-1][1] < 0.01:
+            merged[-1] = (merged[-1][0], end, text)
+        else:
+            merged.append((start, end, text))
+    blocks = [
+        f"{k}\n{format_srt_time(start)} --> {format_srt_time(end)}\n{text}\n"
+        for k, (start, end, text) in enumerate(merged, start=1)
+    ]
+    return "\n".join(blocks)
+
+# --- 共用：並行執行多個可串流的工作 ---
+def run_streaming_jobs(jobs, max_workers, on_partial=None, on_result=None):
+    # jobs 為 {key: fn(on_chunk) -> result}；工作在背景執行緒中執行，
+    # on_partial(key, 目前文字) 與 on_result(key, result) 一律在呼叫端的執行緒中回呼，可安全更新 Streamlit 畫面
+    events = queue.Queue()
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for key, job in jobs.items():
+            stream = None
+            if on_partial is not None:
+                stream = lambda partial, key=key: events.put(("chunk", key, partial))
+            future = executor.submit(job, stream)
+            future.add_done_callback(lambda f, key=key: events.put(("done", key, f)))
+        
+        remaining = len(jobs)
+        while remaining:
+            kind, key, payload = events.get()
+            if kind == "chunk":
+                on_partial(key, payload)
+                continue
+            remaining -= 1
+            results[key] = payload.result()
+            if on_result is not None:
+                on_result(key, results[key])
+    return results
+
+# --- 共用：背景工作佇列（翻譯工作在呼叫端之外執行，介面重新執行時不會中斷） ---
+JOB_QUEUE_WORKERS = 16
+JOB_KEEP_SECONDS = 3600
+JOB_KEEP_PER_SESSION = 5
+
+class TranslationJob:
+    # tasks 為不帶參數的函式，在背景執行緒中執行並透過 set_partial / set_result 回報進度；
+    # 同一個工作最多同時執行 max_workers 個 task，其餘排隊等候
+    def __init__(self, job_id, total, max_workers=4, meta=None):
+        self.id = job_id
+        self.total = total
+        self.max_workers = max(1, max_workers)
+        self.meta = meta or {}
+        self.lock = threading.Lock()
+        self.partials = {}
+        self.results = {}
+        self.errors = []
+        self.pending = deque()
+        self.running = 0
+        self.cancelled = False
+        self.created_at = time.time()
+        self.finished_at = None
+
+    def add_task(self, fn):
+        # 取消後才加入的 task（例如分析完成後排入的翻譯請求）直接丟棄
+        with self.lock:
+            if not self.cancelled:
+                self.pending.append(fn)
+
+    def set_partial(self, key, text):
+        with self.lock:
+            self.partials[key] = text
+
+    def set_result(self, key, result):
+        with self.lock:
+            self.results[key] = result
+            self.partials.pop(key, None)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.partials), dict(self.results)
+
+    def done(self):
+        with self.lock:
+            return self.finished_at is not None
+
+    def cancel(self):
+        # 尚未開始的 task 不再送出；已在進行中的請求仍會完成並寫入結果與快取
+        with self.lock:
+            self.cancelled = True
+            self.pending.clear()
+            if not self.running:
+                self.finished_at = self.finished_at or time.time()
+
+    def _next_tasks(self):
+        with self.lock:
+            tasks = []
+            while self.pending and self.running < self.max_workers:
+                tasks.append(self.pending.popleft())
+                self.running += 1
+            if not self.running and not self.pending:
+                self.finished_at = self.finished_at or time.time()
+            return tasks
+
+    def _task_done(self, error=None):
+        with self.lock:
+            self.running -= 1
+            if error is not None:
+                self.errors.append(error)
+
+class JobQueue:
+    # 整個行程共用一個執行緒池；工作以 (工作階段 ID, 工作 ID) 為鍵保存，介面可隨時重新取得並顯示進度
+    def __init__(self, max_workers=JOB_QUEUE_WORKERS, keep_seconds=JOB_KEEP_SECONDS, keep_per_session=JOB_KEEP_PER_SESSION):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="translation-job")
+        self.keep_seconds = keep_seconds
+        self.keep_per_session = keep_per_session
+        self.lock = threading.Lock()
+        self.jobs = {}
+
+    def get(self, session_id, job_id):
+        if not job_id:
+            return None
+        with self.lock:
+            return self.jobs.get((session_id, job_id))
+
+    def submit(self, session_id, job):
+        # 同一工作階段中相同 ID 的工作仍在執行時直接沿用，避免重複按下按鈕而重送整批請求
+        with self.lock:
+            existing = self.jobs.get((session_id, job.id))
+            if existing is not None and not existing.done():
+                return existing
+            self.jobs[(session_id, job.id)] = job
+            self._prune(session_id)
+        self._start(job)
+        return job
+
+    def active_jobs(self):
+        with self.lock:
+            return sum(1 for job in self.jobs.values() if not job.done())
+
+    def _start(self, job):
+        for task in job._next_tasks():
+            self.executor.submit(self._run, job, task)
+
+    def _run(self, job, task):
+        error = None
+        try:
+            task()
+        except Exception as e:
+            error = str(e)
+        job._task_done(error)
+        self._start(job)
+
+    def _prune(self, session_id):
+        now = time.time()
+        for key, job in list(self.jobs.items()):
+            if job.done() and now - job.finished_at > self.keep_seconds:
+                del self.jobs[key]
+        finished = sorted(
+            (job.finished_at, key) for key, job in self.jobs.items()
+            if key[0] == session_id and job.done()
+        )
+        for _, key in finished[:max(0, len(finished) - self.keep_per_session)]:
+            del self.jobs[key]
+
+# --- 共用：監看資料夾（新增或修改的截圖寫入完成後自動翻譯，結果逐行附加到 JSONL 紀錄） ---
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+# 這些狀態代表該檔案已有最終結果，重新啟動時不再翻譯；額度耗盡或 API 錯誤的檔案會重試
+# 本機偵測判定沒有文字 (no_text) 不算最終結果，續跑時重新偵測，偵測有誤時文字不會就此遺失
+FINISHED_STATUSES = ("ok", "filtered", "blocked")
+WATCH_POLL_SECONDS = 2.0
+# 有檔案系統事件時只重新檢查事件涉及的路徑；仍定期完整掃描一次，補上漏掉的事件
+WATCH_FULL_SCAN_SECONDS = 300.0
+# 檔案大小與修改時間持續這麼久沒有變化才視為寫入完成，避免讀到寫到一半的截圖
+WATCH_SETTLE_SECONDS = 1.5
+WATCH_RECENT = 50
+
+def result_record(path, result):
+    record = {
+        "file": path,
+        "status": result["status"],
+        "text": result["text"],
+        "model": result["model"],
+        "error": result["error"],
+        "cached": result.get("cached", False),
+        "latency": result.get("latency"),
+        "tokens_saved": result.get("tokens_saved", 0),
+        "instruction_tokens": result.get("instruction_tokens"),
+        "finished_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    if result.get("source"):
+        record["source"] = result["source"]
+    if result.get("hedge"):
+        record["hedge"] = result["hedge"]
+    if result.get("tiles"):
+        record["tiles"] = result["tiles"]
+    region = result.get("text_region")
+    if region:
+        record["text_box"] = region["box"]
+    prep = result.get("preprocess")
+    if prep:
+        record["sent_bytes"] = prep["sent_bytes"]
+    return record
+
+def load_watch_log(log_path):
+    # 從紀錄還原已完成的檔案與當時的 (大小, 修改時間)；檔案之後被修改時會重新翻譯
+    known = {}
+    if not os.path.exists(log_path):
+        return known
+    with open(log_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # 中斷時可能留下寫到一半的最後一行，直接略過
+                continue
+            if record.get("status") in FINISHED_STATUSES and "mtime_ns" in record:
+                known[record["file"]] = (record["size"], record["mtime_ns"])
+    return known
+
+class FolderScanner:
+    def __init__(self, folder, recursive=True, known=None, settle=WATCH_SETTLE_SECONDS):
+        self.folder = folder
+        self.recursive = recursive
+        self.known = dict(known or {})
+        self.settle = settle
+        self.pending = {}
+
+    def files(self, folder=None):
+        for root, dirs, names in os.walk(folder or self.folder):
+            if not self.recursive:
+                dirs.clear()
+            for name in names:
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    yield os.path.normpath(os.path.join(root, name))
+
+    def changed_files(self, paths):
+        # 檔案系統事件涉及的路徑：整個資料夾被移入時展開其中的圖片
+        for path in paths:
+            if os.path.isdir(path):
+                yield from self.files(path)
+            elif path.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.normpath(path)
+
+    def scan(self, paths=None):
+        # 回傳寫入完成且尚未處理的 (路徑, (大小, 修改時間))；新出現或仍在變動的檔案先放入 pending 等待穩定
+        # paths 為 None 時完整掃描資料夾，否則只檢查這些路徑與仍在等待穩定的檔案
+        now = time.time()
+        ready = []
+        candidates = self.files() if paths is None else set(self.changed_files(paths)) | set(self.pending)
+        for path in candidates:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                self.pending.pop(path, None)
+                continue
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if self.known.get(path) == signature:
+                continue
+            seen = self.pending.get(path)
+            if seen is None or seen[0] != signature:
+                self.pending[path] = (signature, now)
+                continue
+            if now - seen[1] >= self.settle and now - stat.st_mtime >= self.settle and stat.st_size > 0:
+                del self.pending[path]
+                self.known[path] = signature
+                ready.append((path, signature))
+        return ready
+
+class FolderWatch:
+    # translate(路徑, 檔案內容) 回傳與 generate_with_fallback 相同格式的結果，在背景執行緒中並行呼叫
+    # on_record(紀錄) 在每個檔案完成並寫入紀錄後回呼（背景執行緒）
+    def __init__(self, folder, log_path, translate, max_workers=4, recursive=True, poll=WATCH_POLL_SECONDS, on_record=None):
+        self.folder = folder
+        self.log_path = log_path
+        self.translate = translate
+        self.on_record = on_record
+        self.poll = poll
+        self.scanner = FolderScanner(folder, recursive, load_watch_log(log_path))
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="folder-watch")
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.changed = set()
+        self.recent = deque(maxlen=WATCH_RECENT)
+        self.stats = {"restored": len(self.scanner.known), "queued": 0, "finished": 0, "failed": 0}
+        self.errors = []
+        self.observer = None
+        self.thread = None
+
+    def start(self):
+        self.observer = self.start_events()
+        self.thread = threading.Thread(target=self._loop, name="folder-watch", daemon=True)
+        self.thread.start()
+
+    def start_events(self):
+        # 有安裝 watchdog 時改用檔案系統事件（inotify 等）立即觸發掃描，否則只依固定間隔輪詢
+        try:
+            from watchdog.events import FileSystemEventHandler
+            from watchdog.observers import Observer
+        except ImportError:
+            return None
+        watch = self
+        
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                # 資料夾本身的修改事件（其中有檔案變動）不需要重新掃描整個資料夾，只處理新建或移入的資料夾
+                if event.is_directory and event.event_type not in ("created", "moved"):
+                    return
+                with watch.lock:
+                    watch.changed.add(os.fsdecode(event.src_path))
+                    if getattr(event, "dest_path", None):
+                        watch.changed.add(os.fsdecode(event.dest_path))
+                watch.wake.set()
+        
+        try:
+            observer = Observer()
+            observer.schedule(Handler(), self.folder, recursive=self.scanner.recursive)
+            observer.start()
+        except Exception:
+            return None
+        return observer
+
+    def stop(self):
+        self.stopped.set()
+        self.wake.set()
+        if self.observer is not None:
+            self.observer.stop()
+        # 已送出的翻譯仍會完成並寫入紀錄，尚未開始的取消，重新啟動時再處理
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def mode(self):
+        return "檔案系統事件" if self.observer is not None else "輪詢"
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.recent), dict(self.stats, settling=len(self.scanner.pending)), list(self.errors)
+
+    def _loop(self):
+        last_full_scan = 0.0
+        while not self.stopped.is_set():
+            # 沒有檔案系統事件時每次都完整掃描；有事件時只檢查變動的路徑，避免每隔幾秒就 stat 整個資料夾
+            full_scan = self.observer is None or time.time() - last_full_scan >= WATCH_FULL_SCAN_SECONDS
+            with self.lock:
+                changed, self.changed = self.changed, set()
+            try:
+                if full_scan:
+                    last_full_scan = time.time()
+                ready = self.scanner.scan(None if full_scan else changed)
+            except OSError as e:
+                ready = []
+                with self.lock:
+                    self.errors = [str(e)]
+            for path, signature in ready:
+                with self.lock:
+                    self.stats["queued"] += 1
+                self.executor.submit(self._process, path, signature)
+            # 有檔案仍在等待寫入完成時縮短間隔，盡快在穩定後送出；事件模式下其餘時間只等待事件
+            idle = self.poll if self.observer is None else WATCH_FULL_SCAN_SECONDS - (time.time() - last_full_scan)
+            self.wake.wait(min(self.poll, self.scanner.settle) if self.scanner.pending else max(0.0, idle))
+            self.wake.clear()
+
+    def _process(self, path, signature):
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            result = self.translate(path, data)
+            # 介面只保留壓縮縮圖，不保留原始檔案
+            thumbnail = scan_image(data)["thumbnail"]
+        except Exception as e:
+            result = {"status": "error", "text": None, "model": None, "error": str(e), "notices": [], "cached": False}
+            thumbnail = None
+        record = dict(result_record(path, result), size=signature[0], mtime_ns=signature[1])
+        with self.lock:
+            with open(self.log_path, "a", encoding="utf-8") as out:
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.stats["finished" if result["status"] in FINISHED_STATUSES + ("no_text",) else "failed"] += 1
+            self.recent.appendleft({"record": record, "result": result, "thumbnail": thumbnail})
+        if self.on_record is not None:
+            self.on_record(record)
+
+# --- 共用：長文依段落與句子切分後並行翻譯 ---
+# 中日韓文字大約每字 1 個 Token，其他文字大約每 4 個字元 1 個 Token
+CJK_CHAR_RE = re.compile(r"[\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af\uf900-\ufaff]")
+# 句尾：中日文全形標點、驚嘆問號與刪節號（可接收尾引號或括號），英文／韓文句點後須接空白或結尾
+SENTENCE_END_RE = re.compile(r"[。！？!?…]+[」』”’）)\"']*\s*|\.[」』”’）)\"']*(?:\s+|$)|\n+")
+CHUNK_TAIL_CHARS = 200
+CHUNK_RETRIES = 1
+
+def estimate_text_tokens(text):
+    cjk = len(CJK_CHAR_RE.findall(text))
+    return cjk + (len(text) - cjk) // 4 + 1
+
+def split_sentences(paragraph):
+    sentences = []
+    start = 0
+    for match in SENTENCE_END_RE.finditer(paragraph):
+        if match.end() > start:
+            sentences.append(paragraph[start:match.end()])
+            start = match.end()
+    if start < len(paragraph):
+        sentences.append(paragraph[start:])
+    return [sentence for sentence in sentences if sentence.strip()]
+
+def split_hard(text, max_tokens):
+    # 單句仍超過上限時只能依字數硬切
+    pieces = []
+    current = ""
+    for char in text:
+        if current and estimate_text_tokens(current + char) > max_tokens:
+            pieces.append(current)
+            current = ""
+        current += char
+    if current:
+        pieces.append(current)
+    return pieces
+
+def chunk_text(text, max_tokens=1000):
+    # 回傳 [(段落文字, 與前一段之間的分隔字串)]；依序以 分隔字串 + 譯文 串接即可還原段落結構
+    units = []
+    for n, paragraph in enumerate(re.split(r"\n\s*\n", text.strip())):
+        paragraph_sep = "\n\n" if n else ""
+        if estimate_text_tokens(paragraph) <= max_tokens:
+            units.append((paragraph, paragraph_sep))
+            continue
+        # 段落過長時改以句子為單位，句子仍過長才硬切；同一段落內的片段之間不加分隔
+        first = True
+        for sentence in split_sentences(paragraph):
+            for piece in split_hard(sentence, max_tokens) if estimate_text_tokens(sentence) > max_tokens else [sentence]:
+                units.append((piece, paragraph_sep if first else ""))
+                first = False
+    
+    chunks = []
+    current, current_sep = "", ""
+    for unit, sep in units:
+        if current and estimate_text_tokens(current + sep + unit) > max_tokens:
+            chunks.append((current, current_sep))
+            current, current_sep = unit, sep
+        elif current:
+            current += sep + unit
+        else:
+            current, current_sep = unit, sep
+    if current:
+        chunks.append((current, current_sep))
+    return chunks
+
+def chunk_tail(chunk, max_chars=CHUNK_TAIL_CHARS):
+    # 取前一段結尾的幾個完整句子作為下一段的上下文
+    tail = ""
+    for sentence in reversed(split_sentences(chunk)):
+        if tail and len(sentence) + len(tail) > max_chars:
+            break
+        tail = sentence + tail
+    return tail[-max_chars:].strip()
+
+def build_chunk_prompt(prompt_parts, chunk, previous_tail=""):
+    contents = list(prompt_parts)
+    if previous_tail:
+        contents.append("以下「前文」僅供理解上下文並維持用語一致，請勿翻譯或輸出前文：\n" + previous_tail)
+        contents.append("請翻譯以下內容：")
+    contents.append(chunk)
+    return contents
+
+def make_chunk_cache_ids(chunks, source_lang, context, instruction):
+    # 送出的內容包含前一段結尾作為上下文，因此一併納入快取鍵
+    return [
+        make_cache_id(chunk, source_lang, context, instruction, chunk_tail(chunks[k - 1][0]) if k else "")
+        for k, (chunk, _) in enumerate(chunks)
+    ]
+
+def translate_text_chunks(chunks, prompt_parts, safety_settings, router, cache=None, cache_ids=None,
+                          max_workers=4, on_partial=None, on_result=None, retries=CHUNK_RETRIES):
+    # 各段並行翻譯（帶前一段結尾作為上下文），失敗（API 錯誤）的段落才重送，最多重試 retries 輪
+    cache_ids = cache_ids or [None] * len(chunks)
+    results = {}
+    pending = list(range(len(chunks)))
+    
+    for attempt in range(retries + 1):
+        jobs = {}
+        for k in pending:
+            hit = cached_result(cache, cache_ids[k], router.model_names()) if attempt == 0 else None
+            if hit:
+                results[k] = hit
+                if on_result is not None:
+                    on_result(k, hit)
+                continue
+            contents = build_chunk_prompt(prompt_parts, chunks[k][0], chunk_tail(chunks[k - 1][0]) if k else "")
+            jobs[k] = lambda on_chunk, contents=contents, k=k: generate_with_fallback(
+                contents, safety_settings, router, cache, cache_ids[k], on_chunk
+            )
+        
+        results.update(run_streaming_jobs(jobs, max_workers, on_partial, on_result))
+        pending = [k for k in pending if results[k]["status"] == "error"]
+        if not pending:
+            break
+    
+    return [results[k] for k in range(len(chunks))]
+
+def join_chunk_texts(chunks, texts):
+    return "".join(sep + text for (_, sep), text in zip(chunks, texts))
+
+def merge_chunk_results(chunks, results):
+    # 合併各段結果；失敗的段落以標記取代，全部失敗時回傳第一個失敗結果
+    succeeded = [r for r in results if r["status"] in ["ok", "filtered"]]
+    if not succeeded:
+        return results[0]
+    
+    texts = []
+    for k, result in enumerate(results):
+        if result["status"] in ["ok", "filtered"] and result["text"]:
+            texts.append(result["text"].strip())
+        else:
+            texts.append(f"〔第 {k + 1} 段翻譯失敗〕")
+    
+    notices = []
+    for result in results:
+        notices += [notice for notice in result["notices"] if notice not in notices]
+    
+    filtered = [r for r in results if r["status"] == "filtered"]
+    return {
+        "status": "filtered" if filtered else "ok",
+        "text": join_chunk_texts(chunks, texts),
+        "model": (filtered or succeeded)[0]["model"],
+        "error": None,
+        "notices": notices,
+        "cached": all(r.get("cached") for r in results),
+        "complete": len(succeeded) == len(results),
+    }
+
+# --- 共用：翻譯記憶（逐行原文→譯文對照，依語境分開，MinHash 索引模糊比對並提供術語表） ---
+MEMORY_DB_PATH = "translation_memory.sqlite3"
+MEMORY_SHINGLE_SIZE = 3
+# 32 個雜湊分成 8 組、每組 4 個，兩行的字元 3-gram 相似度約 0.5 以上才容易落入同一個桶
+MEMORY_NUM_HASHES = 32
+MEMORY_BANDS = 8
+MEMORY_MIN_SIMILARITY = 0.92
+MEMORY_TERM_MAX_CHARS = 24
+MEMORY_MAX_TERMS = 40
+MEMORY_RETRIES = 1
+# 組成上下文時最多往前看幾個片段，實際長度再由 chunk_tail 限制
+MEMORY_CONTEXT_SEGMENTS = 8
+SEGMENT_MARKER_RE = re.compile(r"【(\d+)】")
+DIGITS_RE = re.compile(r"\d+(?:[.,]\d+)*")
+
+def normalize_segment(text):
+    # 數字以 # 取代，只差在數值的行（如「獲得 100 金幣」與「獲得 200 金幣」）視為同一條目
+    return DIGITS_RE.sub("#", re.sub(r"\s+", " ", text).strip().lower())
+
+def segment_shingles(normalized):
+    if len(normalized) <= MEMORY_SHINGLE_SIZE:
+        return {normalized}
+    return {normalized[k:k + MEMORY_SHINGLE_SIZE] for k in range(len(normalized) - MEMORY_SHINGLE_SIZE + 1)}
+
+_minhash_rng = np.random.default_rng(20240601)
+MEMORY_HASH_A = _minhash_rng.integers(1, 2 ** 63, MEMORY_NUM_HASHES, dtype=np.uint64) | np.uint64(1)
+MEMORY_HASH_B = _minhash_rng.integers(0, 2 ** 63, MEMORY_NUM_HASHES, dtype=np.uint64)
+
+def minhash_bands(shingles):
+    # 每個 3-gram 以 blake2b 雜湊一次，再以 a*h+b（溢位取模 2^64）產生 32 組排列並取最小值
+    # 回傳各組 (組別, 該組簽章) 作為桶的鍵
+    hashes = np.array(
+        [int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big") for shingle in shingles],
+        dtype=np.uint64
+    )
+    with np.errstate(over="ignore"):
+        signature = (MEMORY_HASH_A[:, None] * hashes[None, :] + MEMORY_HASH_B[:, None]).min(axis=1)
+    rows = MEMORY_NUM_HASHES // MEMORY_BANDS
+    return [(band, signature[band * rows:(band + 1) * rows].tobytes()) for band in range(MEMORY_BANDS)]
+
+def adapt_numbers(source, matched_source, target):
+    # 原文數字不同時，依序替換譯文中的對應數字；譯文中的數字無法一一對應時回傳 None
+    new, old = DIGITS_RE.findall(source), DIGITS_RE.findall(matched_source)
+    if new == old:
+        return target
+    if len(new) != len(old) or DIGITS_RE.findall(target) != old:
+        return None
+    replacements = iter(new)
+    return DIGITS_RE.sub(lambda match: next(replacements), target)
+
+class TranslationMemory:
+    def __init__(self, db_path, max_items=20000):
+        self.max_items = max_items
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.exact = {}
+        self.buckets = {}
+        self.short_entries = {}
+        self.stats = {"exact": 0, "fuzzy": 0, "misses": 0}
+        
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS memory ("
+            "id INTEGER PRIMARY KEY, context TEXT, source TEXT, normalized TEXT, target TEXT, model TEXT, "
+            "uses INTEGER DEFAULT 0, created_at REAL, accessed_at REAL, UNIQUE (context, normalized))"
+        )
+        self.conn.commit()
+        rows = self.conn.execute(
+            "SELECT id, context, source, normalized, target, model FROM memory ORDER BY accessed_at DESC LIMIT ?",
+            (max_items,)
+        ).fetchall()
+        for row in rows:
+            self._index(*row)
+
+    def _index(self, entry_id, context, source, normalized, target, model):
+        old = self.entries.get(entry_id)
+        if old:
+            self._unindex(entry_id, old)
+        entry = {"context": context, "source": source, "normalized": normalized, "target": target, "model": model}
+        entry["bands"] = minhash_bands(segment_shingles(normalized))
+        self.entries[entry_id] = entry
+        self.exact[(context, normalized)] = entry_id
+        for band in entry["bands"]:
+            self.buckets.setdefault((context,) + band, set()).add(entry_id)
+        if len(source) <= MEMORY_TERM_MAX_CHARS:
+            self.short_entries.setdefault(context, set()).add(entry_id)
+
+    def _unindex(self, entry_id, entry):
+        self.exact.pop((entry["context"], entry["normalized"]), None)
+        for band in entry["bands"]:
+            self.buckets.get((entry["context"],) + band, set()).discard(entry_id)
+        self.short_entries.get(entry["context"], set()).discard(entry_id)
+
+    def lookup(self, context, source, min_similarity=MEMORY_MIN_SIMILARITY):
+        # 回傳 {"text", "model", "similarity", "source"}；先查完全相符，再以 MinHash 桶找候選並計算實際相似度
+        normalized = normalize_segment(source)
+        with self.lock:
+            entry_id = self.exact.get((context, normalized))
+            similarity = 1.0
+            if entry_id is None and min_similarity < 1:
+                candidates = set()
+                for band in minhash_bands(segment_shingles(normalized)):
+                    candidates |= self.buckets.get((context,) + band, set())
+                similarity = 0.0
+                for candidate in candidates:
+                    score = SequenceMatcher(None, normalized, self.entries[candidate]["normalized"]).ratio()
+                    if score > similarity:
+                        entry_id, similarity = candidate, score
+                if similarity < min_similarity:
+                    entry_id = None
+            
+            text = None
+            if entry_id is not None:
+                entry = self.entries[entry_id]
+                text = adapt_numbers(source, entry["source"], entry["target"])
+            if text is None:
+                self.stats["misses"] += 1
+                return None
+            
+            exact = similarity == 1.0 and DIGITS_RE.findall(source) == DIGITS_RE.findall(entry["source"])
+            self.stats["exact" if exact else "fuzzy"] += 1
+            self.conn.execute("UPDATE memory SET uses = uses + 1, accessed_at = ? WHERE id = ?", (time.time(), entry_id))
+            self.conn.commit()
+            return {"text": text, "model": entry["model"], "exact": exact, "similarity": similarity, "source": entry["source"]}
+
+    def put(self, context, source, target, model):
+        normalized = normalize_segment(source)
+        if not normalized or not target.strip():
+            return
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO memory (context, source, normalized, target, model, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (context, normalized) DO UPDATE SET "
+                "source = excluded.source, target = excluded.target, model = excluded.model, accessed_at = excluded.accessed_at",
+                (context, source, normalized, target.strip(), model, now, now)
+            )
+            entry_id = self.conn.execute(
+                "SELECT id FROM memory WHERE context = ? AND normalized = ?", (context, normalized)
+            ).fetchone()[0]
+            self._index(entry_id, context, source, normalized, target.strip(), model)
+            self._evict()
+            self.conn.commit()
+
+    def terms(self, context, text, limit=MEMORY_MAX_TERMS):
+        # 出現在本次原文中的短條目（選單、技能名稱等）作為術語表，較長的條目優先避免被較短的子字串取代
+        with self.lock:
+            found = [
+                self.entries[entry_id] for entry_id in self.short_entries.get(context, set())
+                if self.entries[entry_id]["source"] in text
+            ]
+        found.sort(key=lambda entry: -len(entry["source"]))
+        return [(entry["source"], entry["target"]) for entry in found[:limit]]
+
+    def size(self, context=None):
+        with self.lock:
+            if context is None:
+                return len(self.entries)
+            return sum(1 for entry in self.entries.values() if entry["context"] == context)
+
+    def clear(self, context=None):
+        with self.lock:
+            for entry_id, entry in list(self.entries.items()):
+                if context is None or entry["context"] == context:
+                    self._unindex(entry_id, entry)
+                    del self.entries[entry_id]
+            if context is None:
+                self.conn.execute("DELETE FROM memory")
+            else:
+                self.conn.execute("DELETE FROM memory WHERE context = ?", (context,))
+            self.conn.commit()
+            for name in self.stats:
+                self.stats[name] = 0
+
+    def _evict(self):
+        overflow = len(self.entries) - self.max_items
+        if overflow <= 0:
+            return
+        rows = self.conn.execute("SELECT id FROM memory ORDER BY accessed_at ASC LIMIT ?", (overflow,)).fetchall()
+        for (entry_id,) in rows:
+            entry = self.entries.pop(entry_id, None)
+            if entry:
+                self._unindex(entry_id, entry)
+            self.conn.execute("DELETE FROM memory WHERE id = ?", (entry_id,))
+
+def split_segments(text, max_tokens=None):
+    # 以行為單位切分（選單、技能名稱、對話通常各佔一行）；回傳格式與 chunk_text 相同，可用 join_chunk_texts 還原
+    # 超過 max_tokens 的行（如整段貼成一行的小說段落）以 chunk_text 依句子、必要時依字數切成多個片段
+    segments = []
+    sep = ""
+    for line in text.strip().split("\n"):
+        if not line.strip():
+            sep += "\n"
+            continue
+        line = line.strip()
+        if max_tokens is None or estimate_text_tokens(line) <= max_tokens:
+            segments.append((line, sep))
+            sep = "\n"
+            continue
+        for piece, _ in chunk_text(line, max_tokens):
+            segments.append((piece.strip(), sep))
+            # 同一行內的片段直接相接，英文句子之間保留原本的空白
+            sep = " " if piece[-1].isspace() else ""
+        sep = "\n"
+    return segments
+
+def segment_tail(segments, k):
+    # 第 k 個片段之前的原文結尾，作為該組的上下文（與長文分段時帶入前一段結尾相同）
+    previous = segments[max(0, k - MEMORY_CONTEXT_SEGMENTS):k]
+    if not previous:
+        return ""
+    return chunk_tail(join_chunk_texts(previous, [segment for segment, _ in previous]))
+
+def build_segment_prompt(prompt_parts, lines, terms=None, previous_tail=""):
+    contents = list(prompt_parts)
+    if terms:
+        contents.append("術語表（以下原文已有固定譯法，請沿用）：\n" + "\n".join(f"{source} → {target}" for source, target in terms))
+    if previous_tail:
+        contents.append("以下「前文」僅供理解上下文並維持用語一致，請勿翻譯或輸出前文：\n" + previous_tail)
+    contents.append(
+        f"以下共 {len(lines)} 行原文，每行開頭有編號【k】。請逐行翻譯，每行輸出「【k】譯文」，"
+        "保留編號且行數不變，不要合併、拆分或省略任何一行。"
+    )
+    contents.append("\n".join(f"【{k}】{line}" for k, line in enumerate(lines, start=1)))
+    return contents
+
+def parse_segment_response(text, count):
+    # 回傳 {編號: 譯文}；只有一行時模型常省略編號，直接採用整段回應
+    # 每個編號的譯文取到下一個編號為止：模型偶爾把一行譯成多行，不能只保留第一行
+    lines = {}
+    matches = list(SEGMENT_MARKER_RE.finditer(text or ""))
+    for n, match in enumerate(matches):
+        k = int(match.group(1))
+        end = matches[n + 1].start() if n + 1 < len(matches) else len(text)
+        line = text[match.end():end].strip()
+        if 1 <= k <= count and line and k not in lines:
+            lines[k] = line
+    if count == 1 and not lines and (text or "").strip():
+        lines[1] = text.strip()
+    return lines
+
+def group_segments(indices, segments, max_tokens):
+    groups = []
+    current = []
+    tokens = 0
+    for k in indices:
+        cost = estimate_text_tokens(segments[k][0])
+        if current and tokens + cost > max_tokens:
+            groups.append(current)
+            current, tokens = [], 0
+        current.append(k)
+        tokens += cost
+    if current:
+        groups.append(current)
+    return groups
+
+def translate_with_memory(segments, prompt_parts, safety_settings, router, memory, context, min_similarity=MEMORY_MIN_SIMILARITY,
+                          max_tokens=1000, max_workers=4, on_partial=None, on_result=None, retries=MEMORY_RETRIES):
+    # 相符或高度相似的行直接取自翻譯記憶，其餘分組並行送出（附上術語表），成功的譯文寫回記憶
+    # 回傳與 segments 對應的結果列表；取自記憶的結果帶有 memory = "exact" 或 "fuzzy"
+    results = {}
+    pending = []
+    for k, (segment, _) in enumerate(segments):
+        hit = memory.lookup(context, segment, min_similarity)
+        if hit is None:
+            pending.append(k)
+            continue
+        results[k] = {
+            "status": "ok", "text": hit["text"], "model": hit["model"], "error": None, "notices": [], "cached": False,
+            "memory": "exact" if hit["exact"] else "fuzzy",
+        }
+        if on_result is not None:
+            on_result(k, results[k])
+    
+    for attempt in range(retries + 1):
+        groups = group_segments(pending, segments, max_tokens)
+        
+        def group_job(group):
+            def job(stream):
+                lines = [segments[k][0] for k in group]
+                contents = build_segment_prompt(
+                    prompt_parts, lines, memory.terms(context, "\n".join(lines)), segment_tail(segments, group[0])
+                )
+                
+                def group_stream(partial):
+                    for n, line in parse_segment_response(partial, len(group)).items():
+                        stream((group[n - 1], line))
+                
+                return generate_with_fallback(contents, safety_settings, router, on_chunk=group_stream if stream else None)
+            return job
+        
+        def show_partial(key, payload):
+            k, line = payload
+            on_partial(k, line)
+        
+        group_results = run_streaming_jobs(
+            {n: group_job(group) for n, group in enumerate(groups)},
+            max_workers,
+            show_partial if on_partial else None
+        )
+        
+        missing = []
+        for n, group in enumerate(groups):
+            group_result = group_results[n]
+            lines = {}
+            if group_result["status"] in ["ok", "filtered"]:
+                lines = parse_segment_response(group_result["text"], len(group))
+            for position, k in enumerate(group, start=1):
+                if position in lines:
+                    results[k] = dict(group_result, text=lines[position])
+                    if group_result["status"] == "ok":
+                        memory.put(context, segments[k][0], lines[position], group_result["model"])
+                elif group_result["status"] in ["ok", "error"] and attempt < retries:
+                    # 模型漏掉或合併了某些行，或 API 暫時出錯，下一輪再送一次
+                    missing.append(k)
+                    continue
+                else:
+                    results[k] = dict(group_result, text=None)
+                    if group_result["status"] == "ok":
+                        results[k]["status"] = "error"
+                        results[k]["error"] = "回應中缺少此行的翻譯"
+                if on_result is not None:
+                    on_result(k, results[k])
+        
+        pending = missing
+        if not pending:
+            break
+    
+    return [results[k] for k in range(len(segments))]
+
+def summarize_memory(results):
+    return {
+        "exact": sum(1 for r in results if r.get("memory") == "exact"),
+        "fuzzy": sum(1 for r in results if r.get("memory") == "fuzzy"),
+        "sent": sum(1 for r in results if not r.get("memory")),
+    }
+
+# --- 共用：翻譯紀錄（SQLite 保存每次翻譯結果，FTS5 全文索引原文與譯文，分頁查詢） ---
+HISTORY_DB_PATH = "translation_history.sqlite3"
+HISTORY_PAGE_SIZE = 20
+# 紀錄只保存小縮圖，數萬筆時資料庫仍維持在數百 MB 以內
+HISTORY_THUMBNAIL_WIDTH = 240
+HISTORY_THUMBNAIL_MAX_HEIGHT = 480
+# trigram 分詞器以三個字元為單位索引，中日韓文字不需斷詞；更短的關鍵字改以 LIKE 比對
+HISTORY_FTS_MIN_CHARS = 3
+
+class TranslationHistory:
+    def __init__(self, db_path, max_items=100000):
+        self.max_items = max_items
+        self.lock = threading.Lock()
+        
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            "id INTEGER PRIMARY KEY, entry_key TEXT UNIQUE, kind TEXT, name TEXT, image_hash TEXT, "
+            "source TEXT, text TEXT, model TEXT, context TEXT, source_lang TEXT, created_at REAL, owner TEXT)"
+        )
+        # 舊版資料庫沒有 owner 欄位：補上欄位，先前的紀錄沒有擁有者，不會出現在任何人的紀錄中
+        if "owner" not in [row[1] for row in self.conn.execute("PRAGMA table_info(history)")]:
+            self.conn.execute("ALTER TABLE history ADD COLUMN owner TEXT")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_history_created ON history (created_at)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_history_owner ON history (owner, created_at)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_history_image_hash ON history (image_hash)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_history_context ON history (context, created_at)")
+        # 縮圖另外存放，搜尋與計數時不會讀到圖片資料；畫面只讀取目前這一頁的縮圖
+        self.conn.execute("CREATE TABLE IF NOT EXISTS history_thumbnails (id INTEGER PRIMARY KEY, data BLOB)")
+        try:
+            self.conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5("
+                "source, text, content='history', content_rowid='id', tokenize='trigram')"
+            )
+            self.fts = True
+        except sqlite3.OperationalError:
+            # 舊版 SQLite 沒有 FTS5 或 trigram 分詞器時，搜尋退回 LIKE 比對
+            self.fts = False
+        if self.fts:
+            # 以觸發器讓全文索引與主表同步，新增、更新（同一張圖重新翻譯）與刪除都不需另外處理
+            self.conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS history_ai AFTER INSERT ON history BEGIN "
+                "INSERT INTO history_fts (rowid, source, text) VALUES (new.id, new.source, new.text); END"
+            )
+            self.conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS history_ad AFTER DELETE ON history BEGIN "
+                "INSERT INTO history_fts (history_fts, rowid, source, text) VALUES ('delete', old.id, old.source, old.text); END"
+            )
+            self.conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS history_au AFTER UPDATE ON history BEGIN "
+                "INSERT INTO history_fts (history_fts, rowid, source, text) VALUES ('delete', old.id, old.source, old.text); "
+                "INSERT INTO history_fts (rowid, source, text) VALUES (new.id, new.source, new.text); END"
+            )
+        self.conn.commit()
+
+    def add(self, owner, entry_key, kind, name, text, model, context, source_lang, source="", image_hash=None, thumbnail=None):
+        # owner 為紀錄的擁有者（API 金鑰識別碼或工作階段），只有擁有者能搜尋與清除自己的紀錄
+        # entry_key 與快取鍵相同：同一擁有者以同一份原文與設定再次翻譯時更新原紀錄並移到最前面，不重複新增
+        if thumbnail is not None:
+            with Image.open(io.BytesIO(thumbnail)) as img:
+                thumbnail = make_thumbnail(img, HISTORY_THUMBNAIL_WIDTH, HISTORY_THUMBNAIL_MAX_HEIGHT)
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO history (entry_key, kind, name, image_hash, source, text, model, context, source_lang, created_at, owner) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (entry_key) DO UPDATE SET "
+                "name = excluded.name, source = CASE WHEN excluded.source != '' THEN excluded.source ELSE source END, "
+                "text = excluded.text, model = excluded.model, created_at = excluded.created_at",
+                (
+                    f"{owner}/{entry_key}", kind, name, f"{image_hash:016x}" if image_hash is not None else None,
+                    source or "", text, model, context, source_lang, now, owner
+                )
+            )
+            entry_id = self.conn.execute("SELECT id FROM history WHERE entry_key = ?", (f"{owner}/{entry_key}",)).fetchone()[0]
+            if thumbnail is not None:
+                self.conn.execute("INSERT OR REPLACE INTO history_thumbnails (id, data) VALUES (?, ?)", (entry_id, thumbnail))
+            self._evict()
+            self.conn.commit()
+            return entry_id
+
+    def search(self, owner, query="", context=None, offset=0, limit=HISTORY_PAGE_SIZE):
+        # 回傳 (這一頁的紀錄, 符合條件的總筆數)；依翻譯時間由新到舊排序，只讀取需要顯示的那一頁
+        where = ["owner = ?"]
+        params = [owner]
+        terms = query.split()
+        if terms and self.fts and all(len(term) >= HISTORY_FTS_MIN_CHARS for term in terms):
+            where.append("id IN (SELECT rowid FROM history_fts WHERE history_fts MATCH ?)")
+            params.append(" ".join('"' + term.replace('"', '""') + '"' for term in terms))
+        else:
+            for term in terms:
+                pattern = "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+                where.append("(source LIKE ? ESCAPE '\\' OR text LIKE ? ESCAPE '\\')")
+                params += [pattern, pattern]
+        if context:
+            where.append("context = ?")
+            params.append(context)
+        clause = " WHERE " + " AND ".join(where)
+        
+        with self.lock:
+            total = self.conn.execute("SELECT COUNT(*) FROM history" + clause, params).fetchone()[0]
+            rows = self.conn.execute(
+                "SELECT id, kind, name, image_hash, source, text, model, context, source_lang, created_at FROM history"
+                + clause + " ORDER BY created_at DESC LIMIT ? OFFSET ?",
+                params + [limit, offset]
+            ).fetchall()
+        names = ["id", "kind", "name", "image_hash", "source", "text", "model", "context", "source_lang", "created_at"]
+        return [dict(zip(names, row)) for row in rows], total
+
+    def thumbnail(self, owner, entry_id):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT data FROM history_thumbnails WHERE id = ? AND id IN (SELECT id FROM history WHERE owner = ?)",
+                (entry_id, owner)
+            ).fetchone()
+        return row[0] if row else None
+
+    def size(self, owner):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM history WHERE owner = ?", (owner,)).fetchone()[0]
+
+    def clear(self, owner):
+        with self.lock:
+            self.conn.execute("DELETE FROM history_thumbnails WHERE id IN (SELECT id FROM history WHERE owner = ?)", (owner,))
+            self.conn.execute("DELETE FROM history WHERE owner = ?", (owner,))
+            self.conn.commit()
+
+    def _evict(self):
+        overflow = self.conn.execute("SELECT COUNT(*) FROM history").fetchone()[0] - self.max_items
+        if overflow <= 0:
+            return
+        rows = self.conn.execute("SELECT id FROM history ORDER BY created_at ASC LIMIT ?", (overflow,)).fetchall()
+        for (entry_id,) in rows:
+            self.conn.execute("DELETE FROM history WHERE id = ?", (entry_id,))
+            self.conn.execute("DELETE FROM history_thumbnails WHERE id = ?", (entry_id,))